@@ -0,0 +1,119 @@
+import argparse
+import os
+import os.path as osp
+import sys
+import json
+import platform
+import subprocess
+import time
+from benchmarks.common import get_git_revision
+
+# Modules that must not be loaded merely by starting the CLI, e.g. for "--help" or an argument error. They are only
+# imported by the pipeline stages that need them: requests for URL retrieval, bdbag for building and archiving bags,
+# bdbag_ro and the RO manifest builder for "--create-ro-manifest" and the archive writers for "--archiver".
+HEAVY_MODULES = ["requests", "bdbag", "bdbag.bdbag_api", "bdbag.bdbag_ro", "encode2bag.archive_stream",
+                 "encode2bag.ro_manifest", "cProfile", "multiprocessing"]
+CASES = {"import": None,
+         "help": ["--help"],
+         "missing_argument": [],
+         "invalid_argument": ["--archiver", "rar"]}
+
+CHILD_SCRIPT = """
+import sys
+import json
+import time
+start = time.time()
+from encode2bag import encode2bag_cli
+import_time = time.time() - start
+argv = json.loads(sys.argv[1])
+heavy_modules = json.loads(sys.argv[2])
+exit_code = None
+if argv is not None:
+    sys.argv = ["encode2bag"] + argv
+    sys.stdout = sys.stderr = open("%s", "w")
+    try:
+        encode2bag_cli.parse_cli()
+    except SystemExit as e:
+        exit_code = e.code
+sys.__stdout__.write(json.dumps({"import_time": import_time,
+                                 "exit_code": exit_code,
+                                 "modules": len(sys.modules),
+                                 "heavy_modules": [m for m in heavy_modules if m in sys.modules]}))
+""" % os.devnull
+
+
+def measure(case):
+    # Each run uses a fresh interpreter, so that nothing is already imported and the process wall time includes
+    # interpreter startup as it does for each CLI invocation of a batch wrapper.
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [osp.dirname(osp.dirname(osp.abspath(__file__))),
+                                                      env.get("PYTHONPATH")]))
+    start = time.time()
+    output = subprocess.check_output([sys.executable, "-c", CHILD_SCRIPT, json.dumps(CASES[case]),
+                                      json.dumps(HEAVY_MODULES)], env=env)
+    result = json.loads(output.decode("utf-8"))
+    result.update({"case": case, "wall_time": round(time.time() - start, 4),
+                   "import_time": round(result["import_time"], 4)})
+    return result
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the start up time of the encode2bag CLI and checks that starting it does not import "
+                    "the dependencies of the pipeline stages.")
+    parser.add_argument(
+        '--cases', choices=sorted(CASES.keys()), nargs="+", default=sorted(CASES.keys()),
+        help="Benchmark cases to run. Default is all cases.")
+    parser.add_argument(
+        '--repeat', metavar="<count>", type=int, default=10, help="Number of runs per case. Default is %(default)s.")
+    parser.add_argument(
+        '--max-import-time', metavar="<seconds>", type=float,
+        help="Optional limit on the median import time of the CLI module, above which the benchmark fails.")
+    parser.add_argument(
+        '--output', metavar="<file>", default="import-benchmark-results.json",
+        help="Path of the JSON results file. Default is %(default)s.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli()
+    results = list()
+    failures = list()
+    for case in args.cases:
+        runs = [measure(case) for _ in range(args.repeat)]
+        import_times = sorted(r["import_time"] for r in runs)
+        wall_times = sorted(r["wall_time"] for r in runs)
+        result = {"case": case,
+                  "runs": len(runs),
+                  "median_import_time": import_times[len(runs) // 2],
+                  "median_wall_time": wall_times[len(runs) // 2],
+                  "modules": runs[0]["modules"],
+                  "exit_code": runs[0]["exit_code"],
+                  "heavy_modules": sorted(set(m for r in runs for m in r["heavy_modules"]))}
+        results.append(result)
+        sys.stdout.write("%-18s %8.1fms import  %8.1fms process  %4d modules  %s\n" %
+                         (case, result["median_import_time"] * 1000, result["median_wall_time"] * 1000,
+                          result["modules"], ", ".join(result["heavy_modules"]) or "no heavy modules"))
+        if result["heavy_modules"]:
+            failures.append("%s imported %s" % (case, ", ".join(result["heavy_modules"])))
+        if args.max_import_time is not None and result["median_import_time"] > args.max_import_time:
+            failures.append("%s import time %.4fs exceeds %.4fs" %
+                            (case, result["median_import_time"], args.max_import_time))
+
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "git_revision": get_git_revision(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "heavy_modules": HEAVY_MODULES,
+              "results": results,
+              "failures": failures}
+    with open(args.output, "w") as output:
+        json.dump(report, output, sort_keys=True, indent=4)
+    for failure in failures:
+        sys.stderr.write("Failed: %s\n" % failure)
+    sys.stdout.write("Results written to %s\n" % osp.abspath(args.output))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import argparse
+import os.path as osp
+import sys
+import json
+import logging
+import multiprocessing
+import platform
+import shutil
+import tempfile
+import time
+from encode2bag import encode2bag_api as e2b
+from encode2bag import synthetic
+from encode2bag.ro_manifest import ROManifestBuilder
+from benchmarks.common import get_git_revision
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_ROWS = [1000, 10000, 100000]
+CASES = ["convert", "convert_ro", "create_bag", "create_bag_ro", "create_bag_zip", "create_bag_tar", "create_bag_tgz"]
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere.
+    return usage // 1024 if sys.platform == "darwin" else usage
+
+
+def run_case(case, metadata_file, work_dir):
+    if case in ("convert", "convert_ro"):
+        ro_manifest = None
+        if case == "convert_ro":
+            ro_manifest = ROManifestBuilder(e2b.init_ro_manifest(creator_name="encode2bag benchmark"))
+        e2b.convert_tsv_metadata_to_remote_file_manifest(metadata_file,
+                                                         osp.join(work_dir, "remote-file-manifest.json"),
+                                                         ro_manifest)
+        if ro_manifest:
+            ro_manifest.write(osp.join(work_dir, "manifest.json"))
+    else:
+        archive_format = case.split("_")[-1] if case.split("_")[-1] in ("zip", "tar", "tgz") else None
+        e2b.create_bag_from_metadata_file(metadata_file,
+                                          working_dir=work_dir,
+                                          output_path=work_dir,
+                                          output_name="bag",
+                                          archive_format=archive_format,
+                                          create_ro_manifest=case == "create_bag_ro")
+
+
+def _run_case_in_child(case, metadata_file, queue):
+    work_dir = tempfile.mkdtemp(prefix="encode2bag_bench_")
+    try:
+        start = time.time()
+        run_case(case, metadata_file, work_dir)
+        queue.put({"wall_time": time.time() - start, "peak_rss_kb": peak_rss_kb()})
+    except Exception as e:
+        queue.put({"error": "%s: %s" % (type(e).__name__, e)})
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def measure(case, metadata_file, rows):
+    # Each case runs in a fresh process so that peak RSS reflects that case alone.
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_case_in_child, args=(case, metadata_file, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    result.update({"case": case, "rows": rows})
+    if "wall_time" in result:
+        result["wall_time"] = round(result["wall_time"], 4)
+        result["rows_per_sec"] = round(rows / result["wall_time"], 1) if result["wall_time"] > 0 else None
+    return result
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks for the encode2bag conversion and bag building pipeline, using synthetic "
+                    "ENCODE metadata files.")
+    parser.add_argument(
+        '--rows', metavar="<count>", type=int, nargs="+", default=DEFAULT_ROWS,
+        help="Number of metadata rows in each synthetic input. Default is %(default)s.")
+    parser.add_argument(
+        '--cases', choices=CASES, nargs="+", default=CASES, help="Benchmark cases to run. Default is all cases.")
+    parser.add_argument(
+        '--repeat', metavar="<count>", type=int, default=1, help="Number of runs per case. Default is %(default)s.")
+    parser.add_argument(
+        '--seed', type=int, default=0, help="Random seed for the synthetic metadata. Default is %(default)s.")
+    parser.add_argument(
+        '--output', metavar="<file>", default="benchmark-results.json",
+        help="Path of the JSON results file. Default is %(default)s.")
+    parser.add_argument(
+        '--debug', action="store_true", help="Enable debug logging output.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli()
+    e2b.configure_logging(level=logging.DEBUG if args.debug else logging.WARNING)
+    data_dir = tempfile.mkdtemp(prefix="encode2bag_bench_data_")
+    results = list()
+    try:
+        for rows in args.rows:
+            metadata_file = synthetic.write_metadata_file(osp.join(data_dir, "metadata-%d.tsv" % rows), rows,
+                                                          seed=args.seed)
+            for case in args.cases:
+                for _ in range(args.repeat):
+                    result = measure(case, metadata_file, rows)
+                    results.append(result)
+                    sys.stdout.write("%-16s %9d rows  %s\n" %
+                                     (case, rows, result.get("error") or
+                                      "%9.3fs  %12s rows/s  %10s KB peak RSS" %
+                                      (result["wall_time"], result["rows_per_sec"], result["peak_rss_kb"])))
+    finally:
+        shutil.rmtree(data_dir)
+
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "git_revision": get_git_revision(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "seed": args.seed,
+              "results": results}
+    with open(args.output, "w") as output:
+        json.dump(report, output, sort_keys=True, indent=4)
+    sys.stdout.write("Results written to %s\n" % osp.abspath(args.output))
+    return 1 if any("error" in r for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import argparse
+import os.path as osp
+import sys
+import json
+import logging
+import platform
+import shutil
+import tempfile
+import time
+from encode2bag import encode2bag_api as e2b
+from encode2bag import http_client as http
+from encode2bag.mock_server import MockENCODEServer
+from benchmarks.common import get_git_revision
+
+DEFAULT_ROWS = [100, 1000]
+CASES = ["fetch_metadata", "create_bag_from_url", "materialize"]
+
+
+def run_case(case, server, rows, downloader, work_dir):
+    url = server.search_url("type=Experiment&mock_rows=%d" % rows)
+    if case == "fetch_metadata":
+        e2b.retrieve_encode_metadata_file_by_url(url, work_dir, downloader, use_cache=False)
+    else:
+        e2b.create_bag_from_url(url,
+                                output_path=work_dir,
+                                output_name="bag",
+                                downloader=downloader,
+                                use_cache=False,
+                                materialize=case == "materialize")
+
+
+def measure(case, server, rows, downloader):
+    work_dir = tempfile.mkdtemp(prefix="encode2bag_bench_")
+    bytes_sent = server.bytes_sent
+    requests_sent = len(server.request_log)
+    try:
+        start = time.time()
+        run_case(case, server, rows, downloader, work_dir)
+        result = {"wall_time": round(time.time() - start, 4)}
+    except Exception as e:
+        result = {"error": "%s: %s" % (type(e).__name__, e)}
+    finally:
+        shutil.rmtree(work_dir)
+    result.update({"case": case, "rows": rows,
+                   "bytes": server.bytes_sent - bytes_sent,
+                   "requests": len(server.request_log) - requests_sent})
+    if result.get("wall_time"):
+        result["mb_per_sec"] = round(result["bytes"] / result["wall_time"] / 1024 ** 2, 2)
+    return result
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the encode2bag retrieval path, run against a local mock ENCODE server.")
+    parser.add_argument(
+        '--rows', metavar="<count>", type=int, nargs="+", default=DEFAULT_ROWS,
+        help="Number of metadata rows returned per query. Default is %(default)s.")
+    parser.add_argument(
+        '--cases', choices=CASES, nargs="+", default=CASES, help="Benchmark cases to run. Default is all cases.")
+    parser.add_argument(
+        '--repeat', metavar="<count>", type=int, default=1, help="Number of runs per case. Default is %(default)s.")
+    parser.add_argument(
+        '--min-file-size', metavar="<bytes>", type=int, default=1024,
+        help="Minimum size of served payload files. Default is %(default)s.")
+    parser.add_argument(
+        '--max-file-size', metavar="<bytes>", type=int, default=256 * 1024,
+        help="Maximum size of served payload files. Default is %(default)s.")
+    parser.add_argument(
+        '--latency', metavar="<seconds>", type=float, default=0.0,
+        help="Server delay before each response. Default is %(default)s.")
+    parser.add_argument(
+        '--bandwidth', metavar="<bytes/sec>", type=int, help="Server per-connection bandwidth limit.")
+    parser.add_argument(
+        '--error-rate', metavar="<fraction>", type=float, default=0.0,
+        help="Fraction of requests answered with an HTTP 503 error. Default is %(default)s.")
+    parser.add_argument(
+        '--drop-rate', metavar="<fraction>", type=float, default=0.0,
+        help="Fraction of responses dropped halfway through the body. Default is %(default)s.")
+    parser.add_argument(
+        '--seed', type=int, default=0, help="Seed for injected faults. Default is %(default)s.")
+    parser.add_argument(
+        '--output', metavar="<file>", default="retrieval-benchmark-results.json",
+        help="Path of the JSON results file. Default is %(default)s.")
+    parser.add_argument(
+        '--debug', action="store_true", help="Enable debug logging output.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli()
+    e2b.configure_logging(level=logging.DEBUG if args.debug else logging.WARNING)
+    server = MockENCODEServer(payload_size_range=(args.min_file_size, args.max_file_size), latency=args.latency,
+                              bandwidth=args.bandwidth, error_rate=args.error_rate, drop_rate=args.drop_rate,
+                              seed=args.seed)
+    downloader = http.HTTPDownloader(backoff_factor=0.1)
+    results = list()
+    with server:
+        for rows in args.rows:
+            for case in args.cases:
+                for _ in range(args.repeat):
+                    result = measure(case, server, rows, downloader)
+                    results.append(result)
+                    sys.stdout.write("%-20s %7d rows  %s\n" %
+                                     (case, rows, result.get("error") or
+                                      "%9.3fs  %8d requests  %9s MB/s" %
+                                      (result["wall_time"], result["requests"], result.get("mb_per_sec"))))
+    downloader.close()
+
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "git_revision": get_git_revision(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "server": {"latency": args.latency, "bandwidth": args.bandwidth, "error_rate": args.error_rate,
+                         "drop_rate": args.drop_rate, "seed": args.seed,
+                         "file_size_range": [args.min_file_size, args.max_file_size]},
+              "results": results}
+    with open(args.output, "w") as output:
+        json.dump(report, output, sort_keys=True, indent=4)
+    sys.stdout.write("Results written to %s\n" % osp.abspath(args.output))
+    return 1 if any("error" in r for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,11 @@
+import os.path as osp
+import subprocess
+
+
+def get_git_revision():
+    # Recorded with the results, so that benchmark runs can be compared across commits.
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=osp.dirname(osp.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode("utf-8").strip()
+    except Exception:
+        return None
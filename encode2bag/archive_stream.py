@@ -0,0 +1,311 @@
+import io
+import os
+import os.path as osp
+import sys
+import hashlib
+import logging
+import shutil
+import tarfile
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from bdbag import VERSION, BAGIT_VERSION, PROJECT_URL
+from encode2bag import http_client as http
+from encode2bag import materialize as mat
+from encode2bag import compression
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMATS = ["zip", "tar", "tgz", "tzst"]
+STREAM_BLOCK_SIZE = 1024 * 1024
+BAGIT_TXT = b"BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n"
+
+
+class ChecksumReader(object):
+    # Wraps a readable file object and hashes the data as it is read, so members are checksummed while being copied
+    # into the archive rather than in a separate pass.
+    def __init__(self, fileobj, algs):
+        self.fileobj = fileobj
+        self.hashers = OrderedDict((alg, hashlib.new(alg)) for alg in algs)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        return data
+
+    def hexdigests(self):
+        return dict((alg, hasher.hexdigest()) for alg, hasher in self.hashers.items())
+
+
+class BagArchiveWriter(object):
+    """
+    Writes bag members straight into a zip, tar, tgz or tzst (zstd compressed tar) archive in a single sequential pass,
+    so that the bag is never staged as a directory. Checksums of tag files are recorded as they are written and emitted
+    as the tag manifests by write_tag_manifests(). The output may be a file path or any writable binary file object,
+    including non-seekable ones such as pipes and stdout. With more than one compression worker, gzip and zip deflate
+    data is compressed block-parallel and zstd data is compressed by the multi-threaded zstd compressor.
+    """
+    def __init__(self, output, archive_format, bag_name, algs, compression_level=None,
+                 compression_workers=compression.DEFAULT_COMPRESSION_WORKERS):
+        if archive_format not in ARCHIVE_FORMATS:
+            raise RuntimeError("Unsupported archive format: %s" % archive_format)
+        if archive_format == "zip" and sys.version_info < (3, 6):
+            raise RuntimeError("Streaming zip archives requires Python 3.6 or later.")
+        if archive_format == "zip" and compression_level is not None and sys.version_info < (3, 7):
+            raise RuntimeError("Setting the compression level of zip archives requires Python 3.7 or later.")
+        self.archive_format = archive_format
+        self.bag_name = bag_name
+        self.algs = algs
+        self.compression_level = compression_level
+        self.compression_workers = compression_workers
+        self.tag_checksums = OrderedDict()
+        self.mtime = time.time()
+        self.output_path = None if hasattr(output, "write") else osp.abspath(output)
+        self.output = open(self.output_path, "wb") if self.output_path else output
+        self.compressed_output = None
+        # Number of zip members deflated by the block-parallel compressor.
+        self.parallel_members = 0
+        if archive_format == "zip":
+            kwargs = dict() if compression_level is None else dict(compresslevel=compression_level)
+            self.archive = zipfile.ZipFile(self.output, "w", zipfile.ZIP_DEFLATED, allowZip64=True, **kwargs)
+        else:
+            if archive_format == "tgz":
+                self.compressed_output = compression.ParallelGzipWriter(
+                    self.output,
+                    level=compression.DEFAULT_COMPRESSION_LEVEL if compression_level is None else compression_level,
+                    workers=compression_workers)
+            elif archive_format == "tzst":
+                self.compressed_output = compression.ZstdWriter(
+                    self.output,
+                    level=compression.DEFAULT_ZSTD_LEVEL if compression_level is None else compression_level,
+                    workers=compression_workers)
+            self.archive = tarfile.open(fileobj=self.compressed_output or self.output, mode="w|")
+        self.add_directory("")
+
+    def member_name(self, path):
+        return "/".join([self.bag_name, path]) if path else self.bag_name
+
+    def add_directory(self, path):
+        name = self.member_name(path)
+        if self.archive_format == "zip":
+            info = zipfile.ZipInfo(name + "/", time.localtime(self.mtime)[0:6])
+            info.create_system = 3
+            info.external_attr = 0o40755 << 16 | 0x10
+            self.archive.writestr(info, b"")
+        else:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = int(self.mtime)
+            self.archive.addfile(info)
+
+    def add_stream(self, path, fileobj, size):
+        reader = ChecksumReader(fileobj, self.algs)
+        name = self.member_name(path)
+        if self.archive_format == "zip":
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[0:6])
+            info.create_system = 3
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.file_size = size
+            with self.archive.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+                if self.compression_workers > 1 and size > compression.COMPRESSION_BLOCK_SIZE:
+                    self.use_parallel_compressor(member, name)
+                shutil.copyfileobj(reader, member, STREAM_BLOCK_SIZE)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mode = 0o644
+            info.mtime = int(self.mtime)
+            self.archive.addfile(info, reader)
+        return reader.hexdigests()
+
+    def use_parallel_compressor(self, member, name):
+        # zipfile has no public hook for the compressor of an entry, nor for writing data that is already compressed,
+        # so the raw deflate compressor it created is replaced with the block-parallel equivalent before any data is
+        # written. Where the zipfile implementation has no such compressor, the member is deflated by zipfile itself.
+        if getattr(member, "_compressor", None) is None:
+            logger.info("Unable to deflate zip member %s in parallel with this version of Python, using a single "
+                        "thread." % name)
+            return
+        member._compressor = compression.ParallelDeflateCompressor(
+            compression.DEFAULT_COMPRESSION_LEVEL if self.compression_level is None else self.compression_level,
+            self.compression_workers)
+        self.parallel_members += 1
+
+    def add_file(self, path, source_path):
+        with open(source_path, "rb") as source:
+            return self.add_stream(path, source, osp.getsize(source_path))
+
+    def add_tag_file(self, path, data):
+        self.tag_checksums[path] = self.add_stream(path, io.BytesIO(data), len(data))
+        return self.tag_checksums[path]
+
+    def write_tag_manifests(self):
+        for alg in self.algs:
+            lines = ''.join("%s %s\n" % (checksums[alg], path) for path, checksums in self.tag_checksums.items())
+            data = lines.encode("utf-8")
+            self.add_stream("tagmanifest-%s.txt" % alg, io.BytesIO(data), len(data))
+
+    def close(self):
+        self.archive.close()
+        if self.compressed_output:
+            self.compressed_output.close()
+        if self.output_path:
+            self.output.close()
+        else:
+            self.output.flush()
+
+    def abort(self):
+        try:
+            self.archive.close()
+            if self.compressed_output:
+                self.compressed_output.close()
+        except Exception:
+            pass
+        if self.output_path:
+            self.output.close()
+            if osp.isfile(self.output_path):
+                os.remove(self.output_path)
+
+
+def materialize_entries(entries, scratch_path, workers, max_bandwidth=None, downloader=None, payload_store=None):
+    # Yields (entry, local path, is scratch file) in the given order while downloading up to `workers` files ahead, so
+    # that at most that many payload files are in scratch space at any time. With a payload_store, files with an md5sum
+    # are read from the store (downloading them into it if needed) instead of scratch space.
+    if downloader is None:
+        downloader = http.get_default_downloader()
+    total_bytes = sum(int(entry["length"]) for entry in entries if entry.get("length"))
+    progress = mat.TransferProgress(len(entries), total_bytes)
+    rate_limiter = mat.RateLimiter(max_bandwidth) if max_bandwidth else None
+    def transfer(entry):
+        if payload_store and payload_store.make_key(entry.get("md5")):
+            return payload_store.fetch(entry, downloader, progress, rate_limiter)[0], False
+        mat.materialize_file(entry, scratch_path, downloader, progress, rate_limiter)
+        return osp.join(scratch_path, entry["filename"]), True
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for entry in entries:
+            pending.append((entry, pool.submit(transfer, entry)))
+            if len(pending) >= workers:
+                entry, future = pending.popleft()
+                local_path, scratch = future.result()
+                progress.file_done()
+                yield entry, local_path, scratch
+        while pending:
+            entry, future = pending.popleft()
+            local_path, scratch = future.result()
+            progress.file_done()
+            yield entry, local_path, scratch
+    progress.report()
+
+
+def write_bag_archive(output,
+                      archive_format,
+                      bag_name,
+                      metadata_file_path,
+                      remote_entries,
+                      algs,
+                      bag_metadata=None,
+                      ro_manifest=None,
+                      materialize=False,
+                      scratch_path=None,
+                      materialize_workers=mat.DEFAULT_MATERIALIZE_WORKERS,
+                      max_bandwidth=None,
+                      downloader=None,
+                      compression_level=None,
+                      compression_workers=compression.DEFAULT_COMPRESSION_WORKERS,
+                      metadata_compression=None,
+                      payload_store=None):
+    # Members are written in the order: bagit.txt, bag-info.txt, payload, payload manifests, fetch.txt, RO manifest,
+    # tag manifests. Every tag file is complete before its checksum is needed, so nothing is written twice. When a
+    # metadata_compression format is given, the metadata file is decompressed into the archive as it is written, named
+    # without the compression extension.
+    remote = OrderedDict(sorted(((''.join(["data/", entry["filename"]]), entry) for entry in remote_entries),
+                                key=lambda item: item[0]))
+    metadata_name = compression.strip_compression_extension(osp.basename(metadata_file_path), metadata_compression)
+    metadata_payload_path = ''.join(["data/", metadata_name])
+    metadata_size = compression.decompressed_size(metadata_file_path, metadata_compression) \
+        if metadata_compression else osp.getsize(metadata_file_path)
+    total_bytes = metadata_size + sum(int(entry["length"]) for entry in remote.values())
+
+    info = dict(bag_metadata or dict())
+    info.setdefault("Bag-Software-Agent",
+                    "BDBag version: %s (Bagit version: %s) <%s>" % (VERSION, BAGIT_VERSION, PROJECT_URL))
+    info["Bagging-Date"] = time.strftime("%Y-%m-%d")
+    info["Bagging-Time"] = time.strftime("%H:%M:%S %Z")
+    info["Payload-Oxum"] = "%d.%d" % (total_bytes, len(remote) + 1)
+
+    writer = BagArchiveWriter(output, archive_format, bag_name, algs, compression_level, compression_workers)
+    try:
+        writer.add_tag_file("bagit.txt", BAGIT_TXT)
+        writer.add_tag_file("bag-info.txt",
+                            ''.join("%s: %s\n" % (k, v) for k, v in sorted(info.items())).encode("utf-8"))
+        writer.add_directory("data")
+        if metadata_compression:
+            with compression.open_decompressed(metadata_file_path, metadata_compression) as metadata:
+                metadata_checksums = writer.add_stream(metadata_payload_path, metadata, metadata_size)
+        else:
+            metadata_checksums = writer.add_file(metadata_payload_path, metadata_file_path)
+        payload_checksums = OrderedDict([(metadata_payload_path, metadata_checksums)])
+        if materialize and remote:
+            logger.info("Streaming %d remote files (%.1f MB) into the bag archive..." %
+                        (len(remote), total_bytes / 1e6))
+            for entry, local_path, scratch in materialize_entries(list(remote.values()), scratch_path,
+                                                                  materialize_workers, max_bandwidth, downloader,
+                                                                  payload_store):
+                path = ''.join(["data/", entry["filename"]])
+                payload_checksums[path] = writer.add_file(path, local_path)
+                if scratch:
+                    os.remove(local_path)
+
+        for alg in algs:
+            lines = ["%s  %s\n" % (payload_checksums[metadata_payload_path][alg], metadata_payload_path)]
+            for path, entry in remote.items():
+                checksum = entry.get(alg) or payload_checksums.get(path, dict()).get(alg)
+                if checksum:
+                    lines.append("%s  %s\n" % (checksum, path))
+            writer.add_tag_file("manifest-%s.txt" % alg, ''.join(lines).encode("utf-8"))
+        if remote:
+            writer.add_tag_file("fetch.txt", ''.join("%s\t%s\t%s\n" % (entry["url"], entry["length"], path)
+                                                     for path, entry in remote.items()).encode("utf-8"))
+        if ro_manifest:
+            writer.add_directory("metadata")
+            writer.add_tag_file("metadata/manifest.json", ro_manifest.dumps().encode("utf-8"))
+        writer.write_tag_manifests()
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    logger.info("Streamed bag archive %s" % (writer.output_path or bag_name))
+    return writer.output_path
+
+
+def archive_bag_directory(bag_path,
+                          archive_format,
+                          compression_level=None,
+                          compression_workers=compression.DEFAULT_COMPRESSION_WORKERS):
+    # Archives an existing bag directory next to it, like bdbag's archive_bag, but using the parallel compressors.
+    bag_path = osp.abspath(bag_path).rstrip(os.sep)
+    archive_path = '.'.join([bag_path, archive_format])
+    logger.info("Archiving bag (%s): %s" % (archive_format, bag_path))
+    writer = BagArchiveWriter(archive_path, archive_format, osp.basename(bag_path), list(), compression_level,
+                              compression_workers)
+    try:
+        for root, dirs, files in os.walk(bag_path):
+            dirs.sort()
+            relative_root = osp.relpath(root, bag_path).replace(os.sep, "/")
+            relative_root = "" if relative_root == "." else relative_root + "/"
+            if relative_root:
+                writer.add_directory(relative_root.rstrip("/"))
+            for filename in sorted(files):
+                writer.add_file(relative_root + filename, osp.join(root, filename))
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    logger.info("Created bag archive: %s" % archive_path)
+    return archive_path
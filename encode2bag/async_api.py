@@ -0,0 +1,365 @@
+import os
+import os.path as osp
+import asyncio
+import logging
+import shutil
+import tempfile
+from encode2bag import encode2bag_api as e2b
+from encode2bag import http_client as http
+from encode2bag import bag_utils
+from encode2bag import materialize as mat
+from encode2bag import cache
+from encode2bag import compression
+from encode2bag import instrumentation as inst
+from encode2bag import get_named_exception as gne
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) \
+    if aiohttp else ()
+
+
+async def run_blocking(func, *args, executor=None, **kwargs):
+    # Runs func in the executor, recording its stages in the caller's metrics collector. A blocking call cannot be
+    # interrupted, so if the awaiting task is cancelled the call is waited for before the cancellation propagates,
+    # which keeps the caller's cleanup from removing files the call is still using.
+    metrics = inst.get_metrics()
+
+    def call():
+        with inst.collect(metrics):
+            return func(*args, **kwargs)
+
+    future = asyncio.get_running_loop().run_in_executor(executor, call)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+class AsyncHTTPDownloader(object):
+    """
+    aiohttp based counterpart of HTTPDownloader with the same retry, backoff and resume behavior. At most concurrency
+    requests are in flight at any time across all callers sharing an instance, which must be used (and closed) within
+    a single event loop.
+    """
+    def __init__(self,
+                 connect_timeout=http.DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=http.DEFAULT_READ_TIMEOUT,
+                 max_retries=http.DEFAULT_MAX_RETRIES,
+                 backoff_factor=http.DEFAULT_BACKOFF_FACTOR,
+                 backoff_max=http.DEFAULT_BACKOFF_MAX,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 chunk_size=http.CHUNK_SIZE,
+                 session=None):
+        if aiohttp is None:
+            raise RuntimeError("The asynchronous API requires the aiohttp package. Install it with: "
+                               "pip install encode2bag[async]")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self._session = session
+        self._semaphore = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            timeout = aiohttp.ClientTimeout(connect=self.connect_timeout, sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(timeout=timeout,
+                                                  connector=aiohttp.TCPConnector(limit=self.concurrency))
+        return self._session
+
+    @property
+    def semaphore(self):
+        # Created on first use, so that it belongs to the running event loop rather than the one current (if any)
+        # when the downloader was constructed.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _sleep_before_retry(self, url, attempt, reason, retry_after=None):
+        delay = http.backoff_delay(attempt, self.backoff_factor, self.backoff_max, retry_after)
+        logger.warning("Request for %s failed (%s), retrying in %.2f seconds (attempt %d of %d)." %
+                       (url, reason, delay, attempt + 1, self.max_retries))
+        await asyncio.sleep(delay)
+
+    async def download(self, url, output_path, resume=False, headers=None, callback=None, offset_callback=None):
+        """
+        Download url to output_path, with the same semantics as HTTPDownloader.download(). The optional callback may
+        be a coroutine function, which is awaited for each chunk of data written (e.g. to throttle the transfer).
+        Returns the HTTP status of the final response.
+        """
+        async with self.semaphore:
+            attempt = 0
+            validator = None
+            while True:
+                offset = 0
+                if (resume or attempt > 0) and osp.isfile(output_path):
+                    offset = osp.getsize(output_path)
+                request_headers = dict(headers or {})
+                if offset > 0:
+                    request_headers["Range"] = "bytes=%d-" % offset
+                    if validator:
+                        request_headers["If-Range"] = validator
+                try:
+                    async with self.session.get(url, headers=request_headers) as r:
+                        if r.status in http.RETRY_STATUS_CODES and attempt < self.max_retries:
+                            await self._sleep_before_retry(url, attempt, "HTTP %s" % r.status,
+                                                           http.get_retry_after(r.headers))
+                            attempt += 1
+                            continue
+                        if offset > 0 and r.status == 416:
+                            logger.info("File [%s] already complete." % output_path)
+                            return r.status
+                        if r.status == 304:
+                            logger.info("File [%s] not modified on server." % output_path)
+                            return r.status
+                        if r.status not in (200, 206):
+                            logger.error('HTTP GET Failed for url: %s' % url)
+                            logger.error("Host %s responded:\n\n%s" % (r.url.host, await r.text()))
+                            raise http.HTTPTransferError('File [%s] transfer failed. ' % output_path, r.status)
+                        if validator is None or r.status == 200:
+                            validator = http.get_range_validator(r.headers)
+                        mode = "ab" if r.status == 206 else "wb"
+                        if offset > 0 and mode == "ab":
+                            logger.info("Resuming transfer of [%s] at byte offset %d." % (output_path, offset))
+                        elif offset > 0:
+                            logger.info("Restarting transfer of [%s] from the start, the server sent the whole file." %
+                                        output_path)
+                        if offset_callback:
+                            offset_callback(offset if mode == "ab" else 0)
+                        with open(output_path, mode) as data_file:
+                            async for chunk in r.content.iter_chunked(self.chunk_size):
+                                data_file.write(chunk)
+                                if callback:
+                                    result = callback(chunk)
+                                    if asyncio.iscoroutine(result):
+                                        await result
+                        logger.info('File [%s] transfer successful.' % output_path)
+                        return r.status
+                except RETRY_EXCEPTIONS as e:
+                    if attempt >= self.max_retries:
+                        raise http.HTTPTransferError("HTTP Request Exception: %s" % gne(e))
+                    await self._sleep_before_retry(url, attempt, gne(e))
+                    attempt += 1
+                except aiohttp.ClientError as e:
+                    raise http.HTTPTransferError("HTTP Request Exception: %s" % gne(e))
+
+
+async def http_get_request_as_file(url, output_path, downloader, use_cache=False, executor=None):
+    if use_cache:
+        metadata_cache = cache.get_default_cache()
+        if metadata_cache:
+            # The cache revalidates entries with conditional requests through the blocking downloader.
+            await run_blocking(metadata_cache.fetch, url, output_path, executor=executor)
+            return
+    await downloader.download(url, output_path)
+
+
+async def retrieve_encode_metadata_file_by_url(url, output_path, downloader, use_cache=True, executor=None):
+    url = e2b.get_batch_download_url(url)
+    logger.info("Attempting to get ENCODE batch download manifest from: %s" % url)
+    manifest_file = osp.abspath(osp.join(output_path, "encode-manifest-file.txt"))
+    with inst.stage("manifest_fetch") as stage:
+        await http_get_request_as_file(url, manifest_file, downloader, use_cache, executor)
+        stage.bytes = osp.getsize(manifest_file)
+
+    metadata_url = None
+    with open(manifest_file, 'r') as encode_manifest:
+        metadata_url = encode_manifest.readline().strip("\r\n")
+    if not metadata_url:
+        raise RuntimeError("Unable to locate metadata file URL in batch download file manifest %s" % output_path)
+    metadata_file = osp.abspath(osp.join(output_path, metadata_url.split("/")[-1]))
+    with inst.stage("metadata_fetch") as stage:
+        await http_get_request_as_file(metadata_url, metadata_file, downloader, use_cache, executor)
+        stage.bytes = osp.getsize(metadata_file)
+
+    return metadata_file
+
+
+async def materialize_file(entry, data_path, downloader, progress=None, rate_limiter=None, executor=None):
+    output_path = osp.join(data_path, entry["filename"])
+    expected_md5 = entry.get("md5")
+    expected_length = int(entry["length"]) if entry.get("length") else None
+
+    if osp.isfile(output_path) and expected_length is not None and osp.getsize(output_path) == expected_length:
+        digest = mat.StreamingMD5(output_path)
+        if not expected_md5 or await run_blocking(digest.hexdigest, executor=executor) == expected_md5:
+            logger.debug("File [%s] already present, skipping." % output_path)
+            return 0
+        os.remove(output_path)
+
+    digest = mat.StreamingMD5(output_path)
+
+    async def on_chunk(chunk):
+        digest.update(chunk)
+        if progress:
+            progress.update(len(chunk))
+        if rate_limiter:
+            delay = rate_limiter.reserve(len(chunk))
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    await downloader.download(entry["url"], output_path, resume=True, callback=on_chunk, offset_callback=digest.reset)
+
+    if expected_md5:
+        actual_md5 = await run_blocking(digest.hexdigest, executor=executor)
+        if actual_md5 != expected_md5:
+            os.remove(output_path)
+            raise RuntimeError("Checksum mismatch for [%s]: expected md5 %s but received %s" %
+                               (entry["filename"], expected_md5, actual_md5))
+    return digest.hashed
+
+
+def get_blocking_downloader(downloader):
+    # Blocking counterpart of an AsyncHTTPDownloader, with the same timeouts, retries and pool size.
+    return http.HTTPDownloader(connect_timeout=downloader.connect_timeout,
+                               read_timeout=downloader.read_timeout,
+                               max_retries=downloader.max_retries,
+                               backoff_factor=downloader.backoff_factor,
+                               backoff_max=downloader.backoff_max,
+                               pool_size=downloader.concurrency,
+                               chunk_size=downloader.chunk_size)
+
+
+async def materialize_stored_file(entry, data_path, payload_store, blocking_downloader, progress=None,
+                                  rate_limiter=None, executor=None):
+    # Runs PayloadStore.materialize_file in the executor, so that the object is fetched into the store and linked under
+    # the store's lock, which serializes it with other threads and processes sharing the store. The lock cannot be
+    # held across awaits, so the transfer itself uses a blocking downloader rather than the event loop.
+    return await run_blocking(payload_store.materialize_file, entry, data_path, blocking_downloader, progress,
+                              rate_limiter, executor=executor)
+
+
+async def materialize_bag_payload(bag_path,
+                                  remote_file_manifest,
+                                  downloader,
+                                  max_bandwidth=None,
+                                  executor=None,
+                                  progress_interval=mat.DEFAULT_PROGRESS_INTERVAL,
+                                  payload_store=None):
+    # Concurrency is bounded by the downloader. If any transfer fails or the task is cancelled, the remaining
+    # transfers are cancelled; partially written files are kept and resumed by a later call.
+    entries = mat.read_remote_file_manifest(remote_file_manifest)
+    data_path = osp.abspath(osp.join(bag_path, "data"))
+    bag_utils.ensure_dir(data_path)
+
+    total_bytes = sum(int(entry["length"]) for entry in entries if entry.get("length"))
+    progress = mat.TransferProgress(len(entries), total_bytes, interval=progress_interval)
+    rate_limiter = mat.RateLimiter(max_bandwidth) if max_bandwidth else None
+    logger.info("Materializing %d files (%.1f MB) into %s with up to %d concurrent transfers..." %
+                (len(entries), total_bytes / 1e6, data_path, downloader.concurrency))
+
+    # Transfers into the payload store run in the executor, and are bounded by the concurrency of the downloader.
+    blocking_downloader = get_blocking_downloader(downloader) if payload_store else None
+    store_transfers = asyncio.Semaphore(downloader.concurrency)
+
+    async def transfer(entry):
+        try:
+            key = payload_store.make_key(entry.get("md5")) if payload_store else None
+            if key is None:
+                await materialize_file(entry, data_path, downloader, progress, rate_limiter, executor)
+            else:
+                async with store_transfers:
+                    await materialize_stored_file(entry, data_path, payload_store, blocking_downloader, progress,
+                                                  rate_limiter, executor)
+        except Exception as e:
+            raise RuntimeError("Failed to materialize [%s]: %s" % (entry["filename"], gne(e)))
+        progress.file_done()
+
+    tasks = [asyncio.ensure_future(transfer(entry)) for entry in entries]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if blocking_downloader:
+            blocking_downloader.close()
+    progress.report()
+    if payload_store:
+        await run_blocking(payload_store.collect_garbage, executor=executor)
+    return progress.summary()
+
+
+async def create_bag_from_url(url,
+                              output_name=None,
+                              output_path=None,
+                              archive_format=None,
+                              creator_name=None,
+                              creator_orcid=None,
+                              create_ro_manifest=False,
+                              downloader=None,
+                              use_cache=True,
+                              materialize=False,
+                              max_bandwidth=None,
+                              compression_level=None,
+                              compression_workers=compression.DEFAULT_COMPRESSION_WORKERS,
+                              row_filter=None,
+                              payload_store=None,
+                              executor=None):
+    # Without a downloader, a temporary one with the default concurrency is created and closed for this call.
+    own_downloader = downloader is None
+    if own_downloader:
+        downloader = AsyncHTTPDownloader()
+    temp_path = tempfile.mkdtemp(prefix="encode2bag_")
+    try:
+        metadata_file_path = await retrieve_encode_metadata_file_by_url(url, temp_path, downloader, use_cache,
+                                                                        executor)
+        bag_path = await run_blocking(e2b.create_bag_from_metadata_file,
+                                      metadata_file_path,
+                                      working_dir=temp_path,
+                                      output_name=output_name,
+                                      output_path=output_path,
+                                      archive_format=None if materialize else archive_format,
+                                      creator_name=creator_name,
+                                      creator_orcid=creator_orcid,
+                                      create_ro_manifest=create_ro_manifest,
+                                      compression_level=compression_level,
+                                      compression_workers=compression_workers,
+                                      row_filter=row_filter,
+                                      executor=executor)
+        if materialize:
+            remote_file_manifest = osp.join(temp_path, "remote-file-manifest.json")
+            with inst.stage("materialize") as stage:
+                summary = await materialize_bag_payload(bag_path,
+                                                        remote_file_manifest,
+                                                        downloader,
+                                                        max_bandwidth=max_bandwidth,
+                                                        executor=executor,
+                                                        payload_store=payload_store)
+                stage.bytes = summary["bytes_transferred"]
+                stage.rows = summary["files"]
+            if archive_format:
+                bag_path = await run_blocking(e2b.archive_bag,
+                                              bag_path,
+                                              archive_format,
+                                              compression_level,
+                                              compression_workers,
+                                              executor=executor)
+        return bag_path
+    finally:
+        shutil.rmtree(temp_path)
+        if own_downloader:
+            await downloader.close()
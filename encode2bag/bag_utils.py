@@ -0,0 +1,104 @@
+import os
+import os.path as osp
+import errno
+import glob
+import hashlib
+from collections import OrderedDict
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Atomically replaces the destination file on Python 3; Python 2 only has rename, which does so on POSIX.
+replace_file = getattr(os, "replace", os.rename)
+
+
+def ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def read_payload_manifests(bag_path):
+    manifests = OrderedDict()
+    for manifest_path in sorted(glob.glob(osp.join(bag_path, "manifest-*.txt"))):
+        alg = osp.basename(manifest_path)[len("manifest-"):-len(".txt")]
+        entries = OrderedDict()
+        with open(manifest_path, "r") as manifest:
+            for line in manifest:
+                line = line.rstrip("\r\n")
+                if not line:
+                    continue
+                checksum, path = line.split(None, 1)
+                entries[path.strip()] = checksum
+        manifests[alg] = entries
+    return manifests
+
+
+def read_fetch_file(bag_path):
+    entries = OrderedDict()
+    fetch_path = osp.join(bag_path, "fetch.txt")
+    if not osp.isfile(fetch_path):
+        return entries
+    with open(fetch_path, "r") as fetch:
+        for line in fetch:
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            url, length, path = line.split(None, 2)
+            entries[path] = (url, length)
+    return entries
+
+
+def read_bag_info(bag_path):
+    info = OrderedDict()
+    key = None
+    with open(osp.join(bag_path, "bag-info.txt"), "r") as bag_info:
+        for line in bag_info:
+            line = line.rstrip("\r\n")
+            if line[:1] in (" ", "\t") and key:
+                info[key] = " ".join([info[key], line.strip()])
+            elif ":" in line:
+                key, value = line.split(":", 1)
+                key = key.strip()
+                info[key] = value.strip()
+    return info
+
+
+def write_bag_info(bag_path, info):
+    with open(osp.join(bag_path, "bag-info.txt"), "w") as bag_info:
+        for key, value in sorted(info.items()):
+            bag_info.write("%s: %s\n" % (key, value))
+
+
+def compute_file_checksums(path, algs):
+    hashers = dict((alg, hashlib.new(alg)) for alg in algs)
+    with open(path, "rb") as data_file:
+        while True:
+            block = data_file.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            for hasher in hashers.values():
+                hasher.update(block)
+    return dict((alg, hasher.hexdigest()) for alg, hasher in hashers.items())
+
+
+def update_tag_manifests(bag_path, algs, changed_tag_files):
+    for alg in algs:
+        tag_manifest_path = osp.join(bag_path, "tagmanifest-%s.txt" % alg)
+        entries = OrderedDict()
+        if osp.isfile(tag_manifest_path):
+            with open(tag_manifest_path, "r") as tag_manifest:
+                for line in tag_manifest:
+                    line = line.rstrip("\r\n")
+                    if line:
+                        checksum, path = line.split(None, 1)
+                        entries[path.strip()] = checksum
+        for tag_file in changed_tag_files:
+            if osp.isfile(osp.join(bag_path, tag_file)):
+                entries[tag_file] = compute_file_checksums(osp.join(bag_path, tag_file), [alg])[alg]
+            else:
+                entries.pop(tag_file, None)
+        with open(tag_manifest_path, "w") as tag_manifest:
+            for path, checksum in entries.items():
+                tag_manifest.write("%s %s\n" % (checksum, path))
@@ -0,0 +1,104 @@
+import os.path as osp
+import json
+import logging
+import time
+import concurrent.futures
+from concurrent.futures import as_completed
+from encode2bag import encode2bag_api as e2b
+from encode2bag import instrumentation as inst
+from encode2bag import get_named_exception as gne
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_WORKERS = 4
+# Executor classes are looked up by name when a batch runs, since importing the process pool loads multiprocessing.
+BATCH_EXECUTORS = {"thread": "ThreadPoolExecutor", "process": "ProcessPoolExecutor"}
+
+
+def is_url(source):
+    return source.lower().startswith(("http://", "https://"))
+
+
+def read_batch_file(batch_file_path):
+    # Each non-empty, non-comment line contains an ENCODE search URL or a metadata file path, optionally followed by
+    # a tab and the output name for the resulting bag.
+    items = list()
+    with open(batch_file_path, "r") as batch_file:
+        for line_number, line in enumerate(batch_file, 1):
+            line = line.strip("\r\n")
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            fields = [field.strip() for field in line.split("\t")]
+            source = fields[0]
+            output_name = fields[1] if len(fields) > 1 and fields[1] else None
+            if not is_url(source):
+                source = osp.abspath(osp.join(osp.dirname(osp.abspath(batch_file_path)), source))
+            items.append({"line": line_number, "source": source, "output_name": output_name})
+    return items
+
+
+def create_bag_from_batch_item(item, output_path=None, **kwargs):
+    result = {"line": item.get("line"), "source": item["source"], "output_name": item.get("output_name")}
+    start = time.time()
+    with inst.collect() as metrics:
+        try:
+            if is_url(item["source"]):
+                bag_path = e2b.create_bag_from_url(item["source"],
+                                                   output_name=item.get("output_name"),
+                                                   output_path=output_path,
+                                                   **kwargs)
+            else:
+                bag_path = e2b.create_bag_from_metadata_file(item["source"],
+                                                             output_name=item.get("output_name"),
+                                                             output_path=output_path,
+                                                             build_id=item.get("build_id"),
+                                                             **kwargs)
+            result.update({"status": "success", "bag_path": bag_path})
+        except Exception as e:
+            logger.error("Failed to create bag for %s: %s" % (item["source"], gne(e)))
+            result.update({"status": "failure", "error": gne(e)})
+    result["elapsed"] = round(time.time() - start, 3)
+    result["stages"] = [stage.to_dict() for stage in metrics.stages]
+    return result
+
+
+def create_bags_from_batch(items, output_path=None, workers=DEFAULT_BATCH_WORKERS, executor="thread", callback=None,
+                           **kwargs):
+    # The optional callback is called with the result of each item as it completes, in the calling thread.
+    if executor not in BATCH_EXECUTORS:
+        raise ValueError("Unsupported batch executor: %s" % executor)
+    if output_path is not None:
+        output_path = osp.abspath(output_path)
+    logger.info("Creating %d bags using %d %s workers..." % (len(items), workers, executor))
+    results = list()
+    metrics = inst.get_metrics()
+    with getattr(concurrent.futures, BATCH_EXECUTORS[executor])(max_workers=workers) as pool:
+        futures = dict((pool.submit(create_bag_from_batch_item, item, output_path, **kwargs), item) for item in items)
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"line": item.get("line"), "source": item["source"], "output_name": item.get("output_name"),
+                          "status": "failure", "error": gne(e)}
+            logger.info("Batch item %s: %s" % (result["source"], result["status"]))
+            if metrics is not None:
+                # Items run in worker threads or processes, so their stages are merged into the caller's collector.
+                for stage in result.get("stages", list()):
+                    metrics.add(inst.StageRecord.from_dict(stage))
+            if callback is not None:
+                callback(result)
+            results.append(result)
+    results.sort(key=lambda r: r.get("line") or 0)
+    return results
+
+
+def write_batch_report(results, report_path):
+    failed = [r for r in results if r["status"] != "success"]
+    report = {"total": len(results),
+              "succeeded": len(results) - len(failed),
+              "failed": len(failed),
+              "items": results}
+    with open(report_path, "w") as report_file:
+        json.dump(report, report_file, sort_keys=True, indent=4)
+    return report
@@ -0,0 +1,215 @@
+import os
+import os.path as osp
+import sys
+import hashlib
+import json
+import logging
+import shutil
+import threading
+import time
+from encode2bag import http_client as http
+from encode2bag import bag_utils
+
+if sys.version_info > (3,):
+    from urllib.parse import urlsplit, urlunsplit
+else:
+    from urlparse import urlsplit, urlunsplit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = osp.join(osp.expanduser("~"), ".encode2bag", "cache")
+# Cached files are revalidated with the server on every use by default, which only saves the transfer of unchanged
+# files. A positive TTL serves younger entries without contacting the server at all.
+DEFAULT_CACHE_TTL = 0
+DEFAULT_CACHE_MAX_SIZE = 5 * 1024 * 1024 * 1024
+BATCH_DOWNLOAD_PATH = "/batch_download/"
+
+
+def normalize_url(url):
+    # ENCODE search parameters are order-insensitive, so sort them to make equivalent queries share a cache entry.
+    # Batch download URLs carry the query string in the last path segment rather than after a "?".
+    parts = urlsplit(url.strip())
+    path = parts.path
+    query = parts.query
+    if BATCH_DOWNLOAD_PATH in path and not query:
+        prefix, _, query = path.partition(BATCH_DOWNLOAD_PATH)
+        path = ''.join([prefix, BATCH_DOWNLOAD_PATH])
+    params = "&".join(sorted(p for p in query.split("&") if p))
+    if path.endswith(BATCH_DOWNLOAD_PATH):
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), ''.join([path, params]), '', ''))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, params, ''))
+
+
+class MetadataCache(object):
+    """
+    On-disk, size-bounded LRU cache of HTTP resources (ENCODE batch download manifests and metadata files). Entries
+    are revalidated with a conditional GET using the stored ETag/Last-Modified validators, unless they are younger than
+    ttl seconds, in which case they are served without any network access. Responses without validators can never
+    be revalidated, so they are only cached with a positive TTL.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_CACHE_TTL, max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.cache_dir = osp.abspath(cache_dir)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+
+    @staticmethod
+    def make_key(url):
+        return hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+
+    def _data_path(self, key):
+        return osp.join(self.cache_dir, ''.join([key, ".data"]))
+
+    def _entry_path(self, key):
+        return osp.join(self.cache_dir, ''.join([key, ".json"]))
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def _load_entry(self, key):
+        entry_path = self._entry_path(key)
+        if not (osp.isfile(entry_path) and osp.isfile(self._data_path(key))):
+            return None
+        try:
+            with open(entry_path) as entry_file:
+                return json.load(entry_file)
+        except ValueError:
+            logger.warning("Ignoring corrupt cache entry: %s" % entry_path)
+            return None
+
+    def _save_entry(self, key, entry):
+        entry_path = self._entry_path(key)
+        temp_path = ''.join([entry_path, ".tmp"])
+        with open(temp_path, "w") as entry_file:
+            json.dump(entry, entry_file, sort_keys=True)
+        bag_utils.replace_file(temp_path, entry_path)
+
+    def _remove_entry(self, key):
+        for path in (self._entry_path(key), self._data_path(key)):
+            if osp.isfile(path):
+                os.remove(path)
+
+    def fetch(self, url, output_path, downloader=None):
+        # Returns True if the content was served from the cache without transferring the body over the network.
+        if downloader is None:
+            downloader = http.get_default_downloader()
+        bag_utils.ensure_dir(self.cache_dir)
+        key = self.make_key(url)
+        with self._key_lock(key):
+            entry = self._load_entry(key)
+            now = time.time()
+            headers = dict()
+            if entry:
+                if now - entry["fetched_on"] < self.ttl:
+                    logger.info("Served %s from cache without revalidation (age %d seconds)." %
+                                (url, now - entry["fetched_on"]))
+                    return self._deliver(key, entry, output_path, now)
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
+
+            temp_path = ''.join([self._data_path(key), ".part"])
+            if osp.isfile(temp_path):
+                os.remove(temp_path)
+            try:
+                r = downloader.download(url, temp_path, headers=headers)
+            except http.HTTPTransferError as e:
+                if not entry:
+                    raise
+                logger.warning("Unable to revalidate cached copy of %s, serving stale copy from cache: %s" % (url, e))
+                return self._deliver(key, entry, output_path, now)
+            if entry and r.status_code == 304:
+                logger.info("Served %s from cache after revalidation with the server." % url)
+                entry["fetched_on"] = now
+                return self._deliver(key, entry, output_path, now)
+
+            etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+            if not (etag or last_modified or self.ttl > 0):
+                logger.info("Not caching %s, since the response has neither an ETag nor a Last-Modified header." % url)
+                self._remove_entry(key)
+                shutil.move(temp_path, output_path)
+                return False
+
+            bag_utils.replace_file(temp_path, self._data_path(key))
+            entry = {"url": url,
+                     "etag": etag,
+                     "last_modified": last_modified,
+                     "size": osp.getsize(self._data_path(key)),
+                     "fetched_on": now}
+            self._deliver(key, entry, output_path, now)
+        self.evict()
+        return False
+
+    def _deliver(self, key, entry, output_path, now):
+        entry["last_access"] = now
+        self._save_entry(key, entry)
+        shutil.copyfile(self._data_path(key), output_path)
+        return True
+
+    def entries(self):
+        if not osp.isdir(self.cache_dir):
+            return list()
+        result = list()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            entry = self._load_entry(key)
+            if entry:
+                result.append((key, entry))
+        return result
+
+    def size(self):
+        return sum(entry.get("size", 0) for _, entry in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(entry.get("size", 0) for _, entry in entries)
+        if total <= self.max_size:
+            return 0
+        removed = 0
+        for key, entry in sorted(entries, key=lambda e: e[1].get("last_access", 0)):
+            if total <= self.max_size:
+                break
+            with self._key_lock(key):
+                self._remove_entry(key)
+            total -= entry.get("size", 0)
+            removed += 1
+            logger.debug("Evicted cache entry for %s" % entry.get("url"))
+        logger.info("Evicted %d entries from cache %s" % (removed, self.cache_dir))
+        return removed
+
+    def purge(self):
+        if osp.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        logger.info("Purged cache directory %s" % self.cache_dir)
+
+
+_default_cache = None
+_default_cache_enabled = True
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    global _default_cache
+    if not _default_cache_enabled:
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = MetadataCache()
+    return _default_cache
+
+
+def configure_default_cache(enabled=True, **kwargs):
+    global _default_cache, _default_cache_enabled
+    with _default_cache_lock:
+        _default_cache_enabled = enabled
+        _default_cache = MetadataCache(**kwargs) if enabled else None
+    return _default_cache
@@ -0,0 +1,237 @@
+import sys
+import io
+import bz2
+import gzip
+import shutil
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+DEFAULT_COMPRESSION_WORKERS = 1
+DEFAULT_COMPRESSION_LEVEL = 6
+DEFAULT_ZSTD_LEVEL = 3
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+DICTIONARY_SIZE = 32 * 1024
+COPY_BLOCK_SIZE = 1024 * 1024
+MAGIC_LENGTH = 6
+
+# Compression formats accepted for input (metadata) files, identified by their magic bytes rather than the file name.
+INPUT_COMPRESSION_FORMATS = [("gzip", b"\x1f\x8b", ".gz"),
+                             ("bz2", b"BZh", ".bz2"),
+                             ("xz", b"\xfd7zXZ\x00", ".xz"),
+                             ("zstd", b"\x28\xb5\x2f\xfd", ".zst")]
+
+
+def _deflate_block(block, level, dictionary, last):
+    # Compresses one block as raw deflate data. Non-final blocks end with a sync flush so that they are byte aligned
+    # and the concatenation of all blocks is a single valid deflate stream. Priming the compressor with the tail of the
+    # preceding block keeps the compression ratio close to that of a serial compressor.
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(block)
+    return data + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelDeflateCompressor(object):
+    """
+    Block-parallel raw deflate compressor in the style of pigz, exposing the compress()/flush() interface of a zlib
+    compression object. Input is split into fixed size blocks which are compressed concurrently by a pool of threads
+    (zlib releases the GIL while compressing); compressed blocks are returned strictly in input order and at most
+    2 * workers blocks are held in memory at a time.
+    """
+    def __init__(self, level=DEFAULT_COMPRESSION_LEVEL, workers=DEFAULT_COMPRESSION_WORKERS,
+                 block_size=COMPRESSION_BLOCK_SIZE):
+        self.level = level
+        self.workers = max(1, workers)
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._dictionary = None
+        self._pending = deque()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+
+    def _submit(self, block, last=False):
+        block = bytes(block)
+        if self._pool:
+            self._pending.append(self._pool.submit(_deflate_block, block, self.level, self._dictionary, last))
+        else:
+            self._pending.append(_deflate_block(block, self.level, self._dictionary, last))
+        if sys.version_info > (3,):
+            self._dictionary = block[-DICTIONARY_SIZE:]
+
+    def _collect(self, wait=False):
+        output = list()
+        while self._pending:
+            head = self._pending[0]
+            if self._pool is None:
+                output.append(head)
+            elif wait or head.done() or len(self._pending) > 2 * self.workers:
+                output.append(head.result())
+            else:
+                break
+            self._pending.popleft()
+        return b''.join(output)
+
+    def compress(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+        return self._collect()
+
+    def flush(self):
+        self._submit(self._buffer, last=True)
+        self._buffer = bytearray()
+        output = self._collect(wait=True)
+        if self._pool:
+            self._pool.shutdown()
+        return output
+
+
+class ParallelGzipWriter(object):
+    """
+    Write-only file object producing a single member gzip stream from the output of a ParallelDeflateCompressor, so
+    that the result can be read by gzip, tar and any other standard tool.
+    """
+    def __init__(self, fileobj, level=DEFAULT_COMPRESSION_LEVEL, workers=DEFAULT_COMPRESSION_WORKERS,
+                 block_size=COMPRESSION_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.compressor = ParallelDeflateCompressor(level, workers, block_size)
+        self.crc = zlib.crc32(b"")
+        self.size = 0
+        self.closed = False
+        extra_flags = 2 if level == 9 else (4 if level == 1 else 0)
+        self.fileobj.write(struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, int(time.time()), extra_flags, 255))
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.fileobj.write(self.compressor.compress(data))
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.fileobj.write(self.compressor.flush())
+        self.fileobj.write(struct.pack("<II", self.crc & 0xffffffff, self.size & 0xffffffff))
+        self.fileobj.flush()
+
+
+class ZstdWriter(object):
+    # Write-only file object producing a zstd frame, using the multi-threaded compressor of the zstandard package.
+    def __init__(self, fileobj, level=DEFAULT_ZSTD_LEVEL, workers=DEFAULT_COMPRESSION_WORKERS):
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is required for zstd compression. "
+                               "Install it with: pip install zstandard")
+        self.fileobj = fileobj
+        self.closed = False
+        compressor = zstandard.ZstdCompressor(level=level, threads=workers if workers > 1 else 0)
+        self.writer = compressor.stream_writer(fileobj, closefd=False)
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        self.fileobj.flush()
+
+
+def detect_compression(header):
+    for name, magic, _ in INPUT_COMPRESSION_FORMATS:
+        if header.startswith(magic):
+            return name
+    return None
+
+
+def get_file_compression(path):
+    with open(path, "rb") as f:
+        return detect_compression(f.read(MAGIC_LENGTH))
+
+
+def get_compression_extension(compression):
+    for name, _, extension in INPUT_COMPRESSION_FORMATS:
+        if name == compression:
+            return extension
+    return ''
+
+
+def strip_compression_extension(filename, compression):
+    extension = get_compression_extension(compression)
+    if extension and filename.endswith(extension):
+        return filename[:-len(extension)]
+    return filename
+
+
+def open_decompressed(path, compression=None):
+    # Returns a binary file object reading the decompressed content of path, which is streamed rather than
+    # decompressed up front.
+    if compression is None:
+        compression = get_file_compression(path)
+    if compression is None:
+        return open(path, "rb")
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "bz2":
+        return bz2.BZ2File(path, "rb")
+    if compression == "xz":
+        if lzma is None:
+            raise RuntimeError("The lzma module is required to read xz compressed files.")
+        return lzma.open(path, "rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is required to read zstd compressed files. "
+                               "Install it with: pip install zstandard")
+        source = open(path, "rb")
+        return zstandard.ZstdDecompressor().stream_reader(source, closefd=True)
+    raise RuntimeError("Unsupported compression format: %s" % compression)
+
+
+def open_text(path, compression=None):
+    # Text mode counterpart of open_decompressed(), equivalent to open(path, "r") for uncompressed files.
+    if compression is None:
+        compression = get_file_compression(path)
+    if compression is None:
+        return open(path, "r")
+    stream = open_decompressed(path, compression)
+    if sys.version_info > (3,):
+        return io.TextIOWrapper(io.BufferedReader(stream) if compression == "zstd" else stream)
+    return stream
+
+
+def decompressed_size(path, compression=None):
+    size = 0
+    with open_decompressed(path, compression) as stream:
+        while True:
+            block = stream.read(COPY_BLOCK_SIZE)
+            if not block:
+                return size
+            size += len(block)
+
+
+def copy_decompressed(path, output_path, compression=None):
+    with open_decompressed(path, compression) as stream, open(output_path, "wb") as output:
+        shutil.copyfileobj(stream, output, COPY_BLOCK_SIZE)
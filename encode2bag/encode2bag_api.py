@@ -2,29 +2,46 @@ import sys
 import os
 import logging
 import copy
-import csv
 import json
-import requests
 import shutil
 import time
 import tempfile
-from bdbag import bdbag_api as bdb
-from bdbag import bdbag_ro as ro
+import threading
 import os.path as osp
-import encode2bag.ontology_mappings as om
-
-if sys.version_info > (3,):
-    from urllib.parse import urlsplit
-else:
-    from urlparse import urlsplit
+from json.encoder import encode_basestring_ascii as encode_json_string
+from encode2bag import http_client as http
+from encode2bag import cache
+from encode2bag import materialize as mat
+from encode2bag import bag_utils
+from encode2bag import compression
+from encode2bag import instrumentation as inst
+from encode2bag import filters
+from encode2bag import journal as jnl
+from encode2bag import search_api
+from encode2bag.metadata_reader import MetadataReader
+
+# bdbag (which imports requests), bdbag_ro, the RO manifest builder and the archive writers are imported by the
+# functions that use them rather than here, so that the CLI only loads them for the stages that actually run.
 
 logger = logging.getLogger(__name__)
 
 ENCODE_FILE_URL = "File download URL"
 ENCODE_FILE_SIZE = "Size"
 ENCODE_FILE_MD5SUM = "md5sum"
+ENCODE_FILE_FORMAT = "File format"
 REQUIRED_COLUMNS = {ENCODE_FILE_URL, ENCODE_FILE_SIZE, ENCODE_FILE_MD5SUM}
 CHUNK_SIZE = 1024 * 1024
+BAG_ALGORITHMS = ["md5", "sha256"]
+DEFAULT_SHARD_WORKERS = 4
+STDIN_PATH = "-"
+DEFAULT_METADATA_FILE_NAME = "metadata.tsv"
+RO_MANIFEST_JOURNAL_NAME = "ro-manifest.json"
+REMOTE_FILE_ENTRY_FORMAT = '{\n    "filename": %s,\n    "length": %s,\n    "md5": %s,\n    "url": %s\n}'
+BDBAG_RO_PROFILE_ID = "http://raw.githubusercontent.com/ini-bdds/bdbag/master/profiles/bdbag-ro-profile.json"
+
+# bagit changes the process working directory while creating and archiving bags, so these operations must not run
+# concurrently in threads of the same process.
+BAG_BUILD_LOCK = threading.RLock()
 
 
 def configure_logging(level=logging.INFO, logpath=None):
@@ -61,30 +78,31 @@ def ensure_bag_path_exists(bag_path, overwrite=False):
         os.makedirs(bag_path)
 
 
-def http_get_request_as_file(url, output_path):
-    try:
-        r = requests.get(url, stream=True)
-        if r.status_code != 200:
-            logger.error('HTTP GET Failed for url: %s' % url)
-            logger.error("Host %s responded:\n\n%s" % (urlsplit(url).netloc,  r.text))
-            raise RuntimeError('File [%s] transfer failed. ' % output_path)
-        else:
-            with open(output_path, 'wb') as data_file:
-                for chunk in r.iter_content(CHUNK_SIZE):
-                    data_file.write(chunk)
-                data_file.flush()
-            logger.info('File [%s] transfer successful.' % output_path)
-    except requests.exceptions.RequestException as e:
-        raise RuntimeError('HTTP Request Exception: %s %s' % (e.errno, e.message))
+def http_get_request_as_file(url, output_path, downloader=None, resume=False, use_cache=False):
+    if use_cache:
+        metadata_cache = cache.get_default_cache()
+        if metadata_cache:
+            metadata_cache.fetch(url, output_path, downloader)
+            return
+    if downloader is None:
+        downloader = http.get_default_downloader()
+    downloader.download(url, output_path, resume=resume)
 
 
-def retrieve_encode_metadata_file_by_url(url, output_path):
+def get_batch_download_url(url):
     url = url.replace("/search/?", "/batch_download/")
     url = url.replace("/report/?", "/batch_download/")
     url = url.replace("/matrix/?", "/batch_download/")
+    return url
+
+
+def retrieve_encode_metadata_file_by_url(url, output_path, downloader=None, use_cache=True, resume=False):
+    url = get_batch_download_url(url)
     logger.info("Attempting to get ENCODE batch download manifest from: %s" % url)
     manifest_file = osp.abspath(osp.join(output_path, "encode-manifest-file.txt"))
-    http_get_request_as_file(url, manifest_file)
+    with inst.stage("manifest_fetch") as stage:
+        http_get_request_as_file(url, manifest_file, downloader, resume=resume, use_cache=use_cache)
+        stage.bytes = osp.getsize(manifest_file)
 
     metadata_url = None
     with open(manifest_file, 'r') as encode_manifest:
@@ -94,43 +112,182 @@ def retrieve_encode_metadata_file_by_url(url, output_path):
     if not metadata_url:
         raise RuntimeError("Unable to locate metadata file URL in batch download file manifest %s" % output_path)
     metadata_file = osp.abspath(osp.join(output_path, metadata_url.split("/")[-1]))
-    http_get_request_as_file(metadata_url, metadata_file)
+    with inst.stage("metadata_fetch") as stage:
+        http_get_request_as_file(metadata_url, metadata_file, downloader, resume=resume, use_cache=use_cache)
+        stage.bytes = osp.getsize(metadata_file)
 
     return metadata_file
 
 
-def convert_tsv_metadata_to_remote_file_manifest(input_path, output_path, ro_manifest=None):
+def write_json_array(entries, output_file, indent=4, encode=None):
+    # Writes each element as soon as it is produced, so memory use is bounded by a single element. The output is
+    # byte-identical to json.dump(list(entries), output_file, sort_keys=True, indent=indent). The optional encode
+    # function returns the text of an element as formatted by json.dumps(element, sort_keys=True, indent=indent).
+    padding = " " * indent
+    count = 0
+    for entry in entries:
+        text = encode(entry) if encode else json.dumps(entry, sort_keys=True, indent=indent, separators=(',', ': '))
+        output_file.write(''.join(["[\n" if count == 0 else ",\n", padding, text.replace("\n", "\n" + padding)]))
+        count += 1
+    output_file.write("\n]" if count > 0 else "[]")
+    return count
+
+
+def encode_remote_file_entry(entry):
+    # Formats a (url, length, filename, md5) tuple of strings exactly as json.dumps would format the corresponding
+    # remote file manifest entry dict with sort_keys=True and indent=4. When indenting, json falls back to its pure
+    # Python encoder, which otherwise dominates the conversion time of large metadata files.
+    url, length, filename, md5 = entry
+    return REMOTE_FILE_ENTRY_FORMAT % (encode_json_string(filename), encode_json_string(length),
+                                       encode_json_string(md5), encode_json_string(url))
+
+
+def spool_metadata_stream(stream, output_dir, name=DEFAULT_METADATA_FILE_NAME):
+    # Writes a binary metadata stream (e.g. stdin) to output_dir unchanged, adding the extension of the compression
+    # format detected from its first bytes to the file name.
+    header = stream.read(compression.MAGIC_LENGTH)
+    output_path = osp.join(output_dir, name + compression.get_compression_extension(
+        compression.detect_compression(header)))
+    with open(output_path, "wb") as output:
+        output.write(header)
+        shutil.copyfileobj(stream, output, compression.COPY_BLOCK_SIZE)
+    return output_path
+
+
+def get_bag_metadata_file_name(metadata_file_path, decompress=False):
+    name = osp.basename(metadata_file_path)
+    if decompress:
+        name = compression.strip_compression_extension(name, compression.get_file_compression(metadata_file_path))
+    return name
+
+
+def copy_metadata_file(metadata_file_path, output_dir, decompress=False, move=False):
+    # Places the metadata file into output_dir, decompressing it on the way if requested. Temporary metadata files
+    # owned by the caller are moved rather than copied.
+    file_compression = compression.get_file_compression(metadata_file_path) if decompress else None
+    output_path = osp.join(output_dir, get_bag_metadata_file_name(metadata_file_path, decompress))
+    if file_compression:
+        compression.copy_decompressed(metadata_file_path, output_path, file_compression)
+        if move:
+            os.remove(metadata_file_path)
+    elif move:
+        shutil.move(metadata_file_path, output_path)
+    else:
+        shutil.copy(osp.abspath(metadata_file_path), output_path)
+    return output_path
+
+
+def filter_metadata_file(metadata_file_path, working_dir, row_filter):
+    # The filtered metadata file keeps the original (uncompressed) file name, since it is the one bundled into the bag.
+    filtered_dir = osp.join(working_dir, "filtered")
+    if not osp.isdir(filtered_dir):
+        os.makedirs(filtered_dir)
+    filtered_path = osp.join(filtered_dir, get_bag_metadata_file_name(metadata_file_path, decompress=True))
+    with inst.stage("row_filter") as stage:
+        stage.rows = filters.filter_metadata_file(metadata_file_path, filtered_path, row_filter)
+        stage.bytes = osp.getsize(metadata_file_path)
+    return filtered_path
+
+
+def convert_tsv_metadata_to_remote_file_manifest(input_path, output_path, ro_manifest=None, row_filter=None,
+                                                 metadata_name=None):
     logger.info("Converting ENCODE metadata file to BDBag remote file manifest...")
-    file_list = list()
-    with open(input_path, "r") as metadata:
-        reader = csv.DictReader(metadata, delimiter='\t')
-        found = REQUIRED_COLUMNS.intersection(set(reader.fieldnames))
-        if found != REQUIRED_COLUMNS:
-            not_found = REQUIRED_COLUMNS - found
-            raise RuntimeError("One or more required column names %s was not found in the column header %s" %
-                               (not_found, str(reader.fieldnames)))
-        with open(output_path, "w") as rfm:
-            entries = list()
-            for row in reader:
-                entry = dict()
-                url = row[ENCODE_FILE_URL]
-                filename = url.split("/")[-1]
-                entry["url"] = url
-                entry["length"] = row[ENCODE_FILE_SIZE]
-                entry["filename"] = filename
-                entry["md5"] = row[ENCODE_FILE_MD5SUM]
-                entries.append(entry)
-                if ro_manifest:
-                    uri = ''.join(["../data/", filename])
-                    file_list.append(uri)
-                    file_format = row["File format"]
-                    conforms_to = om.FILETYPE_ONTOLOGY_MAP.get(file_format, None)
-                    ro.add_aggregate(ro_manifest, uri,
-                                     mediatype=''.join(["application/x-", file_format]),
-                                     conforms_to=conforms_to if conforms_to else None)
-            json.dump(entries, rfm, sort_keys=True, indent=4)
-    if ro_manifest and len(file_list) > 0:
-        ro.add_annotation(ro_manifest, file_list, content=''.join(["../data/", os.path.basename(input_path)]))
+    start = time.time()
+    ro_builder = None
+    if ro_manifest is not None:
+        from encode2bag.ro_manifest import ROManifestBuilder
+        ro_builder = ro_manifest if isinstance(ro_manifest, ROManifestBuilder) else ROManifestBuilder(ro_manifest)
+    columns = [ENCODE_FILE_URL, ENCODE_FILE_SIZE, ENCODE_FILE_MD5SUM]
+    if ro_builder:
+        columns.append(ENCODE_FILE_FORMAT)
+    with compression.open_text(input_path) as metadata:
+        reader = MetadataReader(metadata, columns, REQUIRED_COLUMNS, row_filter)
+
+        # Parsing, RO building and writing are interleaved, so the time spent producing each entry is accumulated
+        # separately to attribute the total to the individual stages.
+        timings = {"tsv_parse": 0.0, "ro_build": 0.0}
+        # The same file may be listed by several rows (e.g. once per experiment or replicate it belongs to). Rows are
+        # collapsed on the payload file name, which is derived from the URL, and checked against the md5 of the first
+        # row naming the file, since different content under one name would collide under data/.
+        checksums = dict()
+        duplicates = {"rows": 0, "bytes": 0}
+        conflicts = list()
+
+        def entries():
+            resumed = time.time()
+            for record in reader:
+                url, size, md5 = record[0], record[1], record[2]
+                filename = url.rpartition("/")[2]
+                seen_md5 = checksums.get(filename)
+                if seen_md5 is not None:
+                    if seen_md5 == md5:
+                        duplicates["rows"] += 1
+                        duplicates["bytes"] += int(size or 0)
+                    else:
+                        conflicts.append(filename)
+                    continue
+                checksums[filename] = md5
+                if ro_builder:
+                    ro_start = time.time()
+                    ro_builder.add_file(filename, record[3])
+                    timings["ro_build"] += time.time() - ro_start
+                timings["tsv_parse"] += time.time() - resumed
+                yield url, size, filename, md5
+                resumed = time.time()
+            timings["tsv_parse"] += time.time() - resumed
+
+        # The manifest is written to a temporary file that only replaces output_path once the conversion succeeds,
+        # so that a failed conversion does not leave a manifest behind.
+        temp_path = ''.join([output_path, ".tmp"])
+        try:
+            with open(temp_path, "w") as rfm:
+                count = write_json_array(entries(), rfm, encode=encode_remote_file_entry)
+            if duplicates["rows"] or conflicts:
+                logger.info("Removed %d duplicate metadata rows, saving %d bytes of downloads; found %d rows with "
+                            "conflicting md5sums." % (duplicates["rows"], duplicates["bytes"], len(conflicts)))
+            if conflicts:
+                raise RuntimeError("Found %d metadata rows whose file name is listed with a different md5sum by an "
+                                   "earlier row: %s" % (len(conflicts), ", ".join(sorted(set(conflicts)))))
+            bag_utils.replace_file(temp_path, output_path)
+        except BaseException:
+            if osp.isfile(temp_path):
+                os.remove(temp_path)
+            raise
+        write_time = time.time() - start - timings["tsv_parse"]
+    logger.info("Wrote %d entries to remote file manifest: %s" % (count, output_path))
+    inst.record("tsv_parse", timings["tsv_parse"] - timings["ro_build"], osp.getsize(input_path), count)
+    inst.record("rfm_write", write_time, osp.getsize(output_path), count)
+    if ro_builder:
+        ro_start = time.time()
+        ro_builder.add_files_annotation(''.join(["../data/", metadata_name or os.path.basename(input_path)]))
+        if ro_builder is not ro_manifest:
+            ro_builder.update_manifest()
+        inst.record("ro_build", timings["ro_build"] + time.time() - ro_start, rows=len(ro_builder.aggregates))
+
+    return {"entries": count, "duplicate_rows": duplicates["rows"], "duplicate_bytes": duplicates["bytes"]}
+
+
+def get_build_journal(output_name, output_path, archive_output=None, resume=False, **parameters):
+    # Only resumable builds are journaled, so that other builds leave nothing behind when they fail. A resumable build
+    # needs an output location known in advance, since a restarted build has to find the journal of the interrupted
+    # one. The parameters identify the build, so that a journal is only resumed by the same build.
+    if not resume:
+        return None
+    if output_name is None or output_path is None or archive_output is not None:
+        raise RuntimeError("Only builds with both an output name and an output path, that are not streamed to an "
+                           "archive output, can be resumed.")
+    parameters["row_filter"] = repr(parameters["row_filter"]) if parameters.get("row_filter") is not None else None
+    return jnl.BuildJournal(get_target_bag_path(output_name, output_path), parameters, resume)
+
+
+def list_partial_payload_files(remote_file_manifest, data_path):
+    # Lists the payload files of a remote file manifest that were only partially transferred into data_path.
+    partial = list()
+    for entry in mat.read_remote_file_manifest(remote_file_manifest):
+        path = osp.join(data_path, entry["filename"])
+        if osp.isfile(path) and (not entry.get("length") or osp.getsize(path) < int(entry["length"])):
+            partial.append(path)
+    return partial
 
 
 def create_bag_from_url(url,
@@ -139,20 +296,97 @@ def create_bag_from_url(url,
                         archive_format=None,
                         creator_name=None,
                         creator_orcid=None,
-                        create_ro_manifest=False):
-
-    temp_path = tempfile.mkdtemp(prefix="encode2bag_")
-    metadata_file_path = retrieve_encode_metadata_file_by_url(url, temp_path)
-
-    bag_path = create_bag_from_metadata_file(metadata_file_path,
-                                             working_dir=temp_path,
-                                             output_name=output_name,
-                                             output_path=output_path,
-                                             archive_format=archive_format,
-                                             creator_name=creator_name,
-                                             creator_orcid=creator_orcid,
-                                             create_ro_manifest=create_ro_manifest)
-    shutil.rmtree(temp_path)
+                        create_ro_manifest=False,
+                        downloader=None,
+                        use_cache=True,
+                        materialize=False,
+                        materialize_workers=mat.DEFAULT_MATERIALIZE_WORKERS,
+                        max_bandwidth=None,
+                        stream_archive=False,
+                        archive_output=None,
+                        compression_level=None,
+                        compression_workers=compression.DEFAULT_COMPRESSION_WORKERS,
+                        shard_max_files=None,
+                        shard_max_bytes=None,
+                        shard_group_by=None,
+                        shard_workers=DEFAULT_SHARD_WORKERS,
+                        shard_executor="thread",
+                        row_filter=None,
+                        decompress_metadata=False,
+                        payload_store=None,
+                        resume=False,
+                        use_search_api=False,
+                        search_page_size=search_api.DEFAULT_PAGE_SIZE,
+                        search_workers=search_api.DEFAULT_PAGE_WORKERS):
+    # With resume, the build is journaled (see encode2bag.journal) and continues from the journal of an interrupted
+    # run of the same build, if there is one. With use_search_api, the metadata file is generated from the paged JSON
+    # results of the search (see encode2bag.search_api) instead of being downloaded from the batch download endpoint.
+
+    journal = get_build_journal(output_name, output_path, archive_output, resume,
+                                source=url,
+                                archive_format=archive_format,
+                                creator_name=creator_name,
+                                creator_orcid=creator_orcid,
+                                create_ro_manifest=create_ro_manifest,
+                                materialize=materialize,
+                                stream_archive=stream_archive,
+                                shard_max_files=shard_max_files,
+                                shard_max_bytes=shard_max_bytes,
+                                shard_group_by=shard_group_by,
+                                row_filter=row_filter,
+                                decompress_metadata=decompress_metadata,
+                                use_search_api=use_search_api)
+    temp_path = None if journal else tempfile.mkdtemp(prefix="encode2bag_")
+    working_dir = journal.path if journal else temp_path
+    try:
+        if jnl.completed(journal, "metadata_fetch"):
+            metadata_file_path = journal.result("metadata_fetch", "metadata_file")
+        else:
+            with jnl.checkpoint(journal, "metadata_fetch",
+                                lambda: [osp.join(working_dir, name) for name in os.listdir(working_dir)
+                                         if name != jnl.JOURNAL_FILE_NAME]) as results:
+                if use_search_api:
+                    metadata_file_path = search_api.retrieve_encode_metadata_file_by_search(url,
+                                                                                            working_dir,
+                                                                                            downloader,
+                                                                                            search_page_size,
+                                                                                            search_workers)
+                else:
+                    metadata_file_path = retrieve_encode_metadata_file_by_url(url, working_dir, downloader,
+                                                                              use_cache, resume=journal is not None)
+                results["metadata_file"] = metadata_file_path
+
+        bag_path = create_bag_from_metadata_file(metadata_file_path,
+                                                 working_dir=working_dir,
+                                                 output_name=output_name,
+                                                 output_path=output_path,
+                                                 archive_format=archive_format,
+                                                 creator_name=creator_name,
+                                                 creator_orcid=creator_orcid,
+                                                 create_ro_manifest=create_ro_manifest,
+                                                 downloader=downloader,
+                                                 materialize=materialize,
+                                                 materialize_workers=materialize_workers,
+                                                 max_bandwidth=max_bandwidth,
+                                                 stream_archive=stream_archive,
+                                                 archive_output=archive_output,
+                                                 compression_level=compression_level,
+                                                 compression_workers=compression_workers,
+                                                 shard_max_files=shard_max_files,
+                                                 shard_max_bytes=shard_max_bytes,
+                                                 shard_group_by=shard_group_by,
+                                                 shard_workers=shard_workers,
+                                                 shard_executor=shard_executor,
+                                                 row_filter=row_filter,
+                                                 decompress_metadata=decompress_metadata,
+                                                 payload_store=payload_store,
+                                                 resume=resume,
+                                                 journal=journal)
+    finally:
+        if temp_path:
+            shutil.rmtree(temp_path)
+    if journal:
+        journal.finish()
     return bag_path
 
 
@@ -164,54 +398,282 @@ def create_bag_from_metadata_file(metadata_file_path,
                                   archive_format=None,
                                   creator_name=None,
                                   creator_orcid=None,
-                                  create_ro_manifest=False):
+                                  create_ro_manifest=False,
+                                  downloader=None,
+                                  materialize=False,
+                                  materialize_workers=mat.DEFAULT_MATERIALIZE_WORKERS,
+                                  max_bandwidth=None,
+                                  stream_archive=False,
+                                  archive_output=None,
+                                  compression_level=None,
+                                  compression_workers=compression.DEFAULT_COMPRESSION_WORKERS,
+                                  shard_max_files=None,
+                                  shard_max_bytes=None,
+                                  shard_group_by=None,
+                                  shard_workers=DEFAULT_SHARD_WORKERS,
+                                  shard_executor="thread",
+                                  row_filter=None,
+                                  decompress_metadata=False,
+                                  metadata_stream=None,
+                                  payload_store=None,
+                                  resume=False,
+                                  journal=None,
+                                  build_id=None):
+    # The metadata file may be compressed with gzip, bz2, xz or zstd, and is read as a stream. When metadata_file_path
+    # is "-", the metadata is read from metadata_stream (by default stdin). The bag receives the metadata file as
+    # given, or decompressed if decompress_metadata is set. With a payload_store, materialized files are linked from
+    # that shared store rather than downloaded for this bag alone. With resume, the build is journaled and continues
+    # from the journal of an interrupted run; a journal passed by the caller (e.g. create_bag_from_url) is used, but
+    # not removed, by this function. The journal is keyed on build_id if given, or else on the metadata file path.
+
+    stream_archive = stream_archive or archive_output is not None
+    if stream_archive and not archive_format:
+        raise RuntimeError("An archive format must be specified in order to stream the bag to an archive.")
+
+    sharded = shard_max_files is not None or shard_max_bytes is not None or shard_group_by is not None
+    own_journal = journal is None
+    if own_journal:
+        journal = get_build_journal(output_name, output_path, archive_output, resume,
+                                    source=build_id or (metadata_file_path if metadata_file_path == STDIN_PATH else
+                                                        osp.abspath(metadata_file_path)),
+                                    archive_format=archive_format,
+                                    creator_name=creator_name,
+                                    creator_orcid=creator_orcid,
+                                    create_ro_manifest=create_ro_manifest,
+                                    materialize=materialize,
+                                    stream_archive=stream_archive,
+                                    shard_max_files=shard_max_files,
+                                    shard_max_bytes=shard_max_bytes,
+                                    shard_group_by=shard_group_by,
+                                    row_filter=row_filter,
+                                    decompress_metadata=decompress_metadata)
 
     temp_path = None
-    if remote_file_manifest is None:
-        if working_dir is None:
+    if working_dir is None:
+        if journal:
+            working_dir = journal.path
+        else:
             working_dir = temp_path = tempfile.mkdtemp(prefix="encode2bag_")
-        remote_file_manifest = osp.abspath(osp.join(working_dir, "remote-file-manifest.json"))
-
-    ro_manifest = None
-    if create_ro_manifest:
-        ro_manifest = init_ro_manifest(creator_name=creator_name, creator_orcid=creator_orcid)
-
-    convert_tsv_metadata_to_remote_file_manifest(metadata_file_path, remote_file_manifest, ro_manifest)
-
-    bag_path = get_target_bag_path(output_name=output_name, output_path=output_path)
-    ensure_bag_path_exists(bag_path)
-    shutil.copy(osp.abspath(metadata_file_path), bag_path)
+    try:
+        temporary_metadata = False
+        if metadata_file_path == STDIN_PATH:
+            # A stream can only be read once, so it is spooled (still compressed) to the file that is later moved into
+            # the bag, rather than to an additional temporary copy. A resumed build reuses the spooled file.
+            if jnl.completed(journal, "metadata_spool"):
+                metadata_file_path = journal.result("metadata_spool", "metadata_file")
+            else:
+                with jnl.checkpoint(journal, "metadata_spool") as results:
+                    if metadata_stream is None:
+                        metadata_stream = getattr(sys.stdin, "buffer", sys.stdin)
+                    metadata_file_path = results["metadata_file"] = spool_metadata_stream(metadata_stream,
+                                                                                          working_dir)
+            temporary_metadata = True
+        if row_filter is not None:
+            # Unselected rows are dropped from the metadata file bundled into the bag as well, so that the metadata,
+            # the remote file manifest and the RO aggregates all describe the same set of files.
+            if jnl.completed(journal, "row_filter"):
+                metadata_file_path = journal.result("row_filter", "metadata_file")
+            else:
+                with jnl.checkpoint(journal, "row_filter") as results:
+                    metadata_file_path = results["metadata_file"] = filter_metadata_file(metadata_file_path,
+                                                                                         working_dir, row_filter)
+            temporary_metadata = True
+
+        if sharded:
+            if archive_output is not None:
+                raise RuntimeError("Sharded bags cannot be streamed to a single archive output.")
+            # Imported here since the sharding module builds each shard by calling back into this module.
+            from encode2bag import sharding
+            index_bag_path = sharding.create_sharded_bags_from_metadata_file(metadata_file_path,
+                                                                   output_name=output_name,
+                                                                   output_path=output_path,
+                                                                   max_files=shard_max_files,
+                                                                   max_bytes=shard_max_bytes,
+                                                                   group_by=shard_group_by,
+                                                                   workers=shard_workers,
+                                                                   executor=shard_executor,
+                                                                   archive_format=archive_format,
+                                                                   creator_name=creator_name,
+                                                                   creator_orcid=creator_orcid,
+                                                                   create_ro_manifest=create_ro_manifest,
+                                                                   downloader=downloader,
+                                                                   materialize=materialize,
+                                                                   materialize_workers=materialize_workers,
+                                                                   max_bandwidth=max_bandwidth,
+                                                                   stream_archive=stream_archive,
+                                                                   compression_level=compression_level,
+                                                                   compression_workers=compression_workers,
+                                                                   payload_store=payload_store,
+                                                                   resume=resume,
+                                                                   journal=journal)
+            if own_journal and journal:
+                journal.finish()
+            return index_bag_path
+
+        if remote_file_manifest is None:
+            remote_file_manifest = osp.abspath(osp.join(working_dir, "remote-file-manifest.json"))
+
+        ro_manifest = None
+        if create_ro_manifest:
+            from encode2bag.ro_manifest import ROManifestBuilder
+            if jnl.completed(journal, "convert"):
+                # The RO manifest is built during the conversion, so a resumed build restores it from the journal.
+                with open(journal.working_path(RO_MANIFEST_JOURNAL_NAME)) as ro_manifest_file:
+                    ro_manifest = ROManifestBuilder(json.load(ro_manifest_file))
+            else:
+                ro_manifest = ROManifestBuilder(init_ro_manifest(creator_name=creator_name,
+                                                                 creator_orcid=creator_orcid))
+        if not jnl.completed(journal, "convert"):
+            with jnl.checkpoint(journal, "convert"):
+                convert_tsv_metadata_to_remote_file_manifest(metadata_file_path, remote_file_manifest, ro_manifest,
+                                                             metadata_name=get_bag_metadata_file_name(
+                                                                 metadata_file_path, decompress_metadata))
+                if journal and ro_manifest:
+                    ro_manifest.write(journal.working_path(RO_MANIFEST_JOURNAL_NAME))
+
+        bag_path = get_target_bag_path(output_name=output_name, output_path=output_path)
+
+        bag_metadata = dict()
+        if creator_name:
+            bag_metadata["Contact-Name"] = creator_name
+        if creator_orcid:
+            bag_metadata["Contact-Orcid"] = creator_orcid
+
+        if create_ro_manifest:
+            bag_metadata["BagIt-Profile-Identifier"] = BDBAG_RO_PROFILE_ID
+
+        if stream_archive:
+            # The bag members are written directly into the archive (or the given file object), so no bag directory
+            # is staged on disk. Materialized payload files are downloaded into scratch space and removed once
+            # archived. A journaled build keeps its scratch space in the journal, so that a resumed build continues
+            # the downloads of files that were not yet archived; the archive itself is rewritten.
+            archive_path = None
+            if archive_output is None:
+                archive_output = archive_path = '.'.join([bag_path, archive_format])
+                if not osp.isdir(osp.dirname(archive_path)):
+                    os.makedirs(osp.dirname(archive_path))
+            from encode2bag import archive_stream
+            scratch_path = None
+            if materialize:
+                if journal:
+                    scratch_path = journal.working_path("scratch")
+                    if not osp.isdir(scratch_path):
+                        os.makedirs(scratch_path)
+                else:
+                    scratch_path = tempfile.mkdtemp(prefix="encode2bag_")
+            try:
+                with jnl.checkpoint(journal, "stream_archive",
+                                    lambda: [osp.join(scratch_path, name) for name in os.listdir(scratch_path)]
+                                    if scratch_path else list()), \
+                        inst.stage("stream_archive") as stage:
+                    archive_stream.write_bag_archive(archive_output,
+                                                     archive_format,
+                                                     osp.basename(bag_path),
+                                                     metadata_file_path,
+                                                     mat.read_remote_file_manifest(remote_file_manifest),
+                                                     BAG_ALGORITHMS,
+                                                     bag_metadata=bag_metadata,
+                                                     ro_manifest=ro_manifest,
+                                                     materialize=materialize,
+                                                     scratch_path=scratch_path,
+                                                     materialize_workers=materialize_workers,
+                                                     max_bandwidth=max_bandwidth,
+                                                     downloader=downloader,
+                                                     compression_level=compression_level,
+                                                     compression_workers=compression_workers,
+                                                     metadata_compression=compression.get_file_compression(
+                                                         metadata_file_path) if decompress_metadata else None,
+                                                     payload_store=payload_store)
+                    if archive_path:
+                        stage.bytes = osp.getsize(archive_path)
+            finally:
+                if scratch_path and not journal:
+                    shutil.rmtree(scratch_path)
+            if own_journal and journal:
+                journal.finish()
+            return archive_path
+
+        if not jnl.completed(journal, "make_bag"):
+            with jnl.checkpoint(journal, "make_bag"):
+                # A bag directory left behind by an interrupted run of this build is replaced rather than moved
+                # aside. The metadata file is only moved into the bag if it does not have to survive for a resume.
+                ensure_bag_path_exists(bag_path, overwrite=jnl.completed(journal, "bag_path"))
+                if journal:
+                    journal.complete("bag_path")
+                copy_metadata_file(metadata_file_path, bag_path, decompress=decompress_metadata,
+                                   move=temporary_metadata and not journal)
+
+                from bdbag import bdbag_api as bdb
+                with BAG_BUILD_LOCK, inst.stage("make_bag"):
+                    bdb.make_bag(bag_path,
+                                 algs=BAG_ALGORITHMS,
+                                 metadata=bag_metadata,
+                                 remote_file_manifest=remote_file_manifest)
+
+        if create_ro_manifest and not jnl.completed(journal, "ro_update"):
+            # The profile identifier is already in bag-info.txt, so adding the RO manifest only requires hashing it
+            # into the tag manifests rather than a second full make_bag(update=True) pass over the bag.
+            with jnl.checkpoint(journal, "ro_update"), inst.stage("ro_update") as stage:
+                bag_metadata_dir = os.path.abspath(os.path.join(bag_path, "metadata"))
+                if not os.path.exists(bag_metadata_dir):
+                    os.mkdir(bag_metadata_dir)
+                ro_manifest_path = osp.join(bag_metadata_dir, "manifest.json")
+                ro_manifest.write(ro_manifest_path)
+                bag_utils.update_tag_manifests(bag_path, BAG_ALGORITHMS, ["metadata/manifest.json"])
+                stage.bytes = osp.getsize(ro_manifest_path)
+                stage.rows = len(ro_manifest.aggregates)
+        if materialize and not jnl.completed(journal, "materialize"):
+            # The bag manifests were generated from the remote file manifest checksums, so the payload only needs to
+            # be verified against them as it is streamed in and the bag is not rehashed afterwards. Files already
+            # materialized by an interrupted run are skipped and partial files are resumed.
+            with jnl.checkpoint(journal, "materialize",
+                                lambda: list_partial_payload_files(remote_file_manifest, osp.join(bag_path, "data"))), \
+                    inst.stage("materialize") as stage:
+                summary = mat.materialize_bag_payload(bag_path,
+                                                      remote_file_manifest,
+                                                      workers=materialize_workers,
+                                                      max_bandwidth=max_bandwidth,
+                                                      downloader=downloader,
+                                                      payload_store=payload_store)
+                stage.bytes = summary["bytes_transferred"]
+                stage.rows = summary["files"]
+        if archive_format:
+            if jnl.completed(journal, "archive"):
+                bag_path = journal.result("archive", "archive_path")
+            else:
+                with jnl.checkpoint(journal, "archive") as results:
+                    bag_path = results["archive_path"] = archive_bag(bag_path, archive_format, compression_level,
+                                                                     compression_workers)
+    finally:
+        if temp_path:
+            shutil.rmtree(temp_path)
+
+    if own_journal and journal:
+        journal.finish()
+    return bag_path
 
-    bag_metadata = dict()
-    if creator_name:
-        bag_metadata["Contact-Name"] = creator_name
-    if creator_orcid:
-        bag_metadata["Contact-Orcid"] = creator_orcid
-
-    bag = bdb.make_bag(bag_path,
-                       algs=["md5", "sha256"],
-                       metadata=bag_metadata,
-                       remote_file_manifest=remote_file_manifest)
-
-    if create_ro_manifest:
-        bag_metadata_dir = os.path.abspath(os.path.join(bag_path, "metadata"))
-        if not os.path.exists(bag_metadata_dir):
-            os.mkdir(bag_metadata_dir)
-        ro_manifest_path = osp.join(bag_metadata_dir, "manifest.json")
-        ro.write_ro_manifest(ro_manifest, ro_manifest_path)
-        bag_metadata.update({'BagIt-Profile-Identifier':
-                            "http://raw.githubusercontent.com/ini-bdds/bdbag/master/profiles/bdbag-ro-profile.json"})
-        bdb.make_bag(bag_path, update=True, metadata=bag_metadata)
-    if archive_format:
-        bag_path = bdb.archive_bag(bag_path, archive_format)
-
-    if temp_path:
-        shutil.rmtree(temp_path)
 
-    return bag_path
+def archive_bag(bag_path,
+                archive_format,
+                compression_level=None,
+                compression_workers=compression.DEFAULT_COMPRESSION_WORKERS):
+    with inst.stage("archive") as stage:
+        if compression_workers > 1 or compression_level is not None or archive_format == "tzst":
+            from encode2bag import archive_stream
+            archive_path = archive_stream.archive_bag_directory(bag_path,
+                                                                archive_format,
+                                                                compression_level=compression_level,
+                                                                compression_workers=compression_workers)
+        else:
+            from bdbag import bdbag_api as bdb
+            with BAG_BUILD_LOCK:
+                archive_path = bdb.archive_bag(bag_path, archive_format)
+        stage.bytes = osp.getsize(archive_path)
+    return archive_path
 
 
 def init_ro_manifest(creator_name=None, creator_uri=None, creator_orcid=None):
+    from bdbag import bdbag_ro as ro
     manifest = copy.deepcopy(ro.DEFAULT_RO_MANIFEST)
     created_on = ro.make_created_on()
     created_by = None
@@ -3,6 +3,17 @@ import os
 import sys
 import logging
 from encode2bag import encode2bag_api as e2b
+from encode2bag import http_client as http
+from encode2bag import cache
+from encode2bag import batch
+from encode2bag import materialize as mat
+from encode2bag import refresh
+from encode2bag import compression
+from encode2bag import instrumentation as inst
+from encode2bag import filters
+from encode2bag import verify
+from encode2bag import payload_store as store
+from encode2bag import search_api
 from encode2bag import get_named_exception as gne
 
 
@@ -20,9 +31,49 @@ def parse_cli():
 
     metadata_file_arg = parser.add_argument(
         '--metadata-file', metavar='<file>',
-        help="Optional path to a ENCODE format metadata file e.g., \"metadata.tsv\". "
+        help="Optional path to a ENCODE format metadata file e.g., \"metadata.tsv\", which may be compressed with "
+             "gzip, bz2, xz or zstd, or \"-\" to read the metadata from stdin. "
              "Either this argument or the \"--url\" argument must be supplied.")
 
+    parser.add_argument(
+        '--search-api', action="store_true",
+        help="Generate the metadata file of \"--url\" from the paged JSON results of the ENCODE search endpoint, "
+             "fetching the pages concurrently and requesting only the file properties needed for the metadata "
+             "columns, instead of downloading the metadata file of the batch download endpoint in one request. The "
+             "generated metadata file has a reduced schema of %d file columns (%s), rather than the full column set "
+             "of the batch download metadata file; the remote file manifest is the same." %
+             (len(search_api.FILE_COLUMNS), ", ".join("\"%s\"" % column for column, _ in search_api.FILE_COLUMNS)))
+
+    parser.add_argument(
+        '--search-page-size', metavar="<count>", type=int, default=search_api.DEFAULT_PAGE_SIZE,
+        help="Number of search results per page fetched by \"--search-api\". Default is %(default)s.")
+
+    parser.add_argument(
+        '--search-workers', metavar="<count>", type=int, default=search_api.DEFAULT_PAGE_WORKERS,
+        help="Number of search result pages fetched concurrently by \"--search-api\". Default is %(default)s.")
+
+    batch_file_arg = parser.add_argument(
+        '--batch-file', metavar='<file>',
+        help="Optional path to a file listing one ENCODE search url or metadata file path per line, each optionally "
+             "followed by a tab and the output name for that bag. All bags are created in a single process.")
+
+    parser.add_argument(
+        '--batch-workers', metavar="<count>", type=int, default=batch.DEFAULT_BATCH_WORKERS,
+        help="Number of bags created concurrently in batch mode. Default is %(default)s.")
+
+    parser.add_argument(
+        '--batch-executor', choices=sorted(batch.BATCH_EXECUTORS.keys()), default="thread",
+        help="Use a pool of threads or of processes for batch mode. Default is %(default)s.")
+
+    parser.add_argument(
+        '--batch-report', metavar="<file>",
+        help="Optional path of a JSON file recording the success or failure of each batch item.")
+
+    parser.add_argument(
+        '--update', metavar="<bag path>",
+        help="Optional path to an existing bag to be updated in place from \"--url\" or \"--metadata-file\". Only "
+             "added, removed or changed remote files are processed.")
+
     parser.add_argument(
         '--output-name', metavar="<directory name>",
         help="Optional name for the output bag directory/bag archive file. "
@@ -34,12 +85,124 @@ def parse_cli():
              "If not specified, a temporary directory will be created.")
 
     parser.add_argument(
-        "--archiver", choices=['zip', 'tar', 'tgz'], help="Archive the output bag using the specified format.")
+        '--resume', action="store_true",
+        help="Resume an interrupted build of the bag named by \"--output-name\" in \"--output-path\" from the last "
+             "completed stage, continuing partial downloads from the last byte written. The build keeps a journal of "
+             "its progress in a \"<output name>.journal\" directory next to the bag until it completes, so that an "
+             "interrupted build rerun with \"--resume\" continues where it stopped. Builds without this option "
+             "keep no journal.")
+
+    parser.add_argument(
+        "--archiver", choices=['zip', 'tar', 'tgz', 'tzst'],
+        help="Archive the output bag using the specified format. The \"tzst\" format (zstd compressed tar) requires "
+             "the zstandard package.")
+
+    parser.add_argument(
+        '--compression-level', metavar="<level>", type=int,
+        help="Optional compression level of the archive: 0-9 for zip and tgz, 1-22 for tzst. If not specified, the "
+             "default level of the format is used.")
+
+    parser.add_argument(
+        '--compression-workers', metavar="<count>", type=int, default=compression.DEFAULT_COMPRESSION_WORKERS,
+        help="Number of threads used to compress the archive. Values greater than one enable block-parallel gzip "
+             "and zip compression and multi-threaded zstd compression. Default is %(default)s.")
+
+    parser.add_argument(
+        '--stream', action="store_true",
+        help="Write the bag directly into the archive specified by \"--archiver\" without first creating the bag "
+             "directory, computing checksums as the bag members are written.")
+
+    parser.add_argument(
+        '--stdout', action="store_true",
+        help="Stream the bag archive to standard output instead of a file, e.g. for piping to an upload command. "
+             "Implies \"--stream\" and requires \"--archiver\".")
+
+    parser.add_argument(
+        '--shard-max-files', metavar="<count>", type=int,
+        help="Optional maximum number of remote files per bag. When specified, the metadata rows are partitioned into "
+             "several shard bags, built concurrently and listed in a top-level index bag.")
+
+    parser.add_argument(
+        '--shard-max-bytes', metavar="<bytes>", type=int,
+        help="Optional maximum total \"Size\" of the remote files per bag. Partitions the metadata rows into shard "
+             "bags as with \"--shard-max-files\".")
+
+    parser.add_argument(
+        '--shard-by', metavar="<column name>",
+        help="Optional metadata column, e.g. \"Experiment accession\", whose rows with equal values are always "
+             "placed in the same shard bag. Without a maximum file count or size, each value gets its own bag.")
+
+    parser.add_argument(
+        '--shard-workers', metavar="<count>", type=int, default=e2b.DEFAULT_SHARD_WORKERS,
+        help="Number of shard bags built concurrently. Default is %(default)s.")
+
+    parser.add_argument(
+        '--shard-executor', choices=sorted(batch.BATCH_EXECUTORS.keys()), default="thread",
+        help="Use a pool of threads or of processes to build shard bags. Default is %(default)s.")
+
+    parser.add_argument(
+        '--decompress-metadata', action="store_true",
+        help="Store a compressed metadata file in the bag decompressed, rather than in its original compressed form.")
+
+    parser.add_argument(
+        '--include', metavar="<column>=<value>[,<value>...]", action="append",
+        help="Only include metadata rows whose column matches one of the given values, which may be shell-style "
+             "patterns, e.g. \"File format=fastq\". May be specified more than once, in which case every "
+             "expression must match.")
+
+    parser.add_argument(
+        '--exclude', metavar="<column>=<value>[,<value>...]", action="append",
+        help="Exclude metadata rows whose column matches one of the given values, which may be shell-style "
+             "patterns, e.g. \"File Status=revoked,archived\". May be specified more than once.")
+
+    parser.add_argument(
+        '--min-file-size', metavar="<bytes>", type=int,
+        help="Exclude metadata rows for files smaller than the given size in bytes.")
+
+    parser.add_argument(
+        '--max-file-size', metavar="<bytes>", type=int,
+        help="Exclude metadata rows for files larger than the given size in bytes.")
 
     parser.add_argument(
         '--create-ro-manifest', action="store_true",
         help="Generate a Research Object compatible manifest. See http://www.researchobject.org for more information.")
 
+    parser.add_argument(
+        '--materialize', action="store_true",
+        help="Download the remote files referenced by the bag into its payload directory, verifying the md5 checksum "
+             "of each file as it is transferred.")
+
+    parser.add_argument(
+        '--materialize-workers', metavar="<count>", type=int, default=mat.DEFAULT_MATERIALIZE_WORKERS,
+        help="Number of files downloaded concurrently with \"--materialize\". Default is %(default)s.")
+
+    parser.add_argument(
+        '--max-bandwidth', metavar="<bytes per second>", type=int,
+        help="Optional cap on the aggregate download rate of \"--materialize\".")
+
+    parser.add_argument(
+        '--payload-store', metavar="<path>", nargs="?", const=store.DEFAULT_STORE_DIR,
+        help="Materialize remote files through a content-addressed store shared between bags and keyed by md5sum, so "
+             "that each file is only downloaded once and then linked into the payload of every bag listing it. "
+             "Default path is %(const)s.")
+
+    parser.add_argument(
+        '--payload-store-max-size', metavar="<bytes>", type=int, default=store.DEFAULT_STORE_MAX_SIZE,
+        help="Size in bytes beyond which files of the payload store that are no longer part of any bag are removed, "
+             "least recently used first. Default is %(default)s.")
+
+    parser.add_argument(
+        '--payload-link-mode', choices=store.LINK_MODES, default=store.DEFAULT_LINK_MODE,
+        help="How files are placed from the payload store into a bag. \"auto\" uses a reflink where the file "
+             "system supports it, and a copy otherwise. Hardlinked payload files are the store objects themselves, so "
+             "modifying one in place modifies it for every bag sharing it. Bags containing symlinks depend on the "
+             "store and cannot be archived with their payload. Default is %(default)s.")
+
+    parser.add_argument(
+        '--gc-payload-store', action="store_true",
+        help="Remove all files of the payload store that are no longer part of any bag. May be specified without "
+             "\"--url\" or \"--metadata-file\".")
+
     parser.add_argument(
         '--creator-name', metavar="<person or entity name>",
         help="Optional name of the person or entity responsible for the creation of this bag, "
@@ -49,6 +212,76 @@ def parse_cli():
         '--creator-orcid', metavar="<orcid>",
         help="Optional ORCID identifier of the bag creator, for inclusion in the bag metadata.")
 
+    parser.add_argument(
+        '--connect-timeout', metavar="<seconds>", type=float, default=http.DEFAULT_CONNECT_TIMEOUT,
+        help="Timeout in seconds for establishing HTTP connections. Default is %(default)s.")
+
+    parser.add_argument(
+        '--read-timeout', metavar="<seconds>", type=float, default=http.DEFAULT_READ_TIMEOUT,
+        help="Timeout in seconds between bytes received from the server. Default is %(default)s.")
+
+    parser.add_argument(
+        '--max-retries', metavar="<count>", type=int, default=http.DEFAULT_MAX_RETRIES,
+        help="Maximum number of times a failed HTTP request (connection errors and 5xx responses) is retried, "
+             "using exponential backoff with jitter. Default is %(default)s.")
+
+    parser.add_argument(
+        '--cache-dir', metavar="<path>", default=cache.DEFAULT_CACHE_DIR,
+        help="Directory used to cache ENCODE batch download manifests and metadata files. "
+             "Default is %(default)s.")
+
+    parser.add_argument(
+        '--cache-ttl', metavar="<seconds>", type=int, default=cache.DEFAULT_CACHE_TTL,
+        help="Age in seconds up to which a cached file is used without revalidating it with the server. With 0, "
+             "cached files are always revalidated and only their transfer is saved. Default is %(default)s.")
+
+    parser.add_argument(
+        '--cache-max-size', metavar="<bytes>", type=int, default=cache.DEFAULT_CACHE_MAX_SIZE,
+        help="Maximum total size in bytes of the cache, beyond which the least recently used entries are evicted. "
+             "Default is %(default)s.")
+
+    parser.add_argument(
+        '--no-cache', action="store_true",
+        help="Bypass the cache and always retrieve ENCODE manifests and metadata files from the server.")
+
+    parser.add_argument(
+        '--purge-cache', action="store_true",
+        help="Remove all cached files before running. May be specified without \"--url\" or \"--metadata-file\".")
+
+    parser.add_argument(
+        '--verify', metavar="<bag path>",
+        help="Verify an existing bag: fetch.txt and the payload manifest are cross-checked against the bundled ENCODE "
+             "metadata file, and payload files present on disk are checked against their md5 checksums. May be "
+             "specified without \"--url\" or \"--metadata-file\".")
+
+    parser.add_argument(
+        '--verify-workers', metavar="<count>", type=int, default=verify.DEFAULT_VERIFY_WORKERS,
+        help="Number of payload files hashed concurrently by \"--verify\". Default is %(default)s.")
+
+    parser.add_argument(
+        '--checksum-cache', metavar="<file>", default=verify.DEFAULT_CHECKSUM_CACHE,
+        help="File caching the checksums of verified payload files by path, size and modification time, so that "
+             "repeated verifications skip unchanged files. Default is %(default)s.")
+
+    parser.add_argument(
+        '--no-checksum-cache', action="store_true",
+        help="Hash every payload file present on disk when verifying a bag, without using the checksum cache.")
+
+    parser.add_argument(
+        '--stage-report', metavar="<file>",
+        help="Optional path of a JSON file recording the wall time, bytes transferred, rows processed and peak memory "
+             "of each pipeline stage.")
+
+    parser.add_argument(
+        '--prometheus-textfile', metavar="<file>",
+        help="Optional path of a Prometheus textfile (e.g. for the node_exporter textfile collector) to which the "
+             "per-stage metrics are written.")
+
+    parser.add_argument(
+        '--profile', metavar="<file>", nargs="?", const="encode2bag.prof",
+        help="Run under cProfile, writing the profile statistics to the given file and a summary of the most "
+             "expensive functions to stderr. Default file is %(const)s.")
+
     parser.add_argument(
         '--quiet', action="store_true", help="Suppress logging output.")
 
@@ -59,44 +292,185 @@ def parse_cli():
 
     e2b.configure_logging(level=logging.ERROR if args.quiet else (logging.DEBUG if args.debug else logging.INFO))
 
-    if not args.url and not args.metadata_file:
-        sys.stderr.write("Error: Required argument missing: either the %s argument "
+    if not args.url and not args.metadata_file and not args.batch_file and not args.purge_cache and not args.verify \
+            and not args.gc_payload_store:
+        sys.stderr.write("Error: Required argument missing: either the %s argument, the %s argument "
                          "or the %s argument must be specified.\n\n" %
-                         (url_arg.option_strings, metadata_file_arg.option_strings))
+                         (url_arg.option_strings, metadata_file_arg.option_strings, batch_file_arg.option_strings))
+        sys.exit(2)
+
+    if args.resume and not (args.output_path and (args.output_name or args.batch_file)):
+        sys.stderr.write("Error: The --resume argument requires the --output-name and --output-path arguments.\n\n")
+        sys.exit(2)
+
+    if (args.stream or args.stdout) and not args.archiver:
+        sys.stderr.write("Error: The --stream and --stdout arguments require the --archiver argument.\n\n")
         sys.exit(2)
 
     return args
 
 
+def get_row_filter(args):
+    if not (args.include or args.exclude or args.min_file_size is not None or args.max_file_size is not None):
+        return None
+    return filters.RowFilter(include=args.include,
+                             exclude=args.exclude,
+                             min_size=args.min_file_size,
+                             max_size=args.max_file_size)
+
+
+def get_payload_store(args):
+    if not args.payload_store:
+        return None
+    return store.PayloadStore(args.payload_store,
+                              max_size=args.payload_store_max_size,
+                              link_mode=args.payload_link_mode)
+
+
+def run(args, archive_output=None):
+    row_filter = get_row_filter(args)
+    payload_store = get_payload_store(args)
+    http.configure_default_downloader(connect_timeout=args.connect_timeout,
+                                      read_timeout=args.read_timeout,
+                                      max_retries=args.max_retries)
+    metadata_cache = cache.configure_default_cache(enabled=not args.no_cache,
+                                                   cache_dir=args.cache_dir,
+                                                   ttl=args.cache_ttl,
+                                                   max_size=args.cache_max_size)
+    if args.purge_cache:
+        (metadata_cache or cache.MetadataCache(args.cache_dir)).purge()
+    if args.gc_payload_store:
+        (payload_store or store.PayloadStore()).collect_garbage(max_size=0)
+    if args.verify:
+        report = verify.verify_bag(args.verify,
+                                   workers=args.verify_workers,
+                                   checksum_cache=None if args.no_checksum_cache else
+                                   verify.ChecksumCache(args.checksum_cache))
+        if report["errors"]:
+            raise RuntimeError("Bag verification failed with %d errors." % len(report["errors"]))
+    elif args.batch_file:
+        results = batch.create_bags_from_batch(batch.read_batch_file(args.batch_file),
+                                               output_path=args.output_path,
+                                               workers=args.batch_workers,
+                                               executor=args.batch_executor,
+                                               archive_format=args.archiver,
+                                               creator_name=args.creator_name,
+                                               creator_orcid=args.creator_orcid,
+                                               create_ro_manifest=args.create_ro_manifest,
+                                               materialize=args.materialize,
+                                               materialize_workers=args.materialize_workers,
+                                               max_bandwidth=args.max_bandwidth,
+                                               compression_level=args.compression_level,
+                                               compression_workers=args.compression_workers,
+                                               row_filter=row_filter,
+                                               decompress_metadata=args.decompress_metadata,
+                                               payload_store=payload_store,
+                                               resume=args.resume)
+        if args.batch_report:
+            batch.write_batch_report(results, args.batch_report)
+        failed = [r for r in results if r["status"] != "success"]
+        for r in failed:
+            sys.stderr.write("Failed: %s (%s)\n" % (r["source"], r["error"]))
+        if failed:
+            raise RuntimeError("%d of %d batch items failed." % (len(failed), len(results)))
+    elif args.update:
+        kwargs = dict(creator_name=args.creator_name,
+                      creator_orcid=args.creator_orcid,
+                      create_ro_manifest=args.create_ro_manifest,
+                      materialize=args.materialize,
+                      materialize_workers=args.materialize_workers,
+                      max_bandwidth=args.max_bandwidth,
+                      row_filter=row_filter,
+                      payload_store=payload_store)
+        if args.url:
+            refresh.update_bag_from_url(args.url, args.update, **kwargs)
+        elif args.metadata_file:
+            refresh.update_bag_from_metadata_file(args.update, args.metadata_file, **kwargs)
+    elif args.url:
+        e2b.create_bag_from_url(args.url,
+                                output_name=args.output_name,
+                                output_path=args.output_path,
+                                archive_format=args.archiver,
+                                creator_name=args.creator_name,
+                                creator_orcid=args.creator_orcid,
+                                create_ro_manifest=args.create_ro_manifest,
+                                materialize=args.materialize,
+                                materialize_workers=args.materialize_workers,
+                                max_bandwidth=args.max_bandwidth,
+                                stream_archive=args.stream,
+                                archive_output=archive_output,
+                                compression_level=args.compression_level,
+                                compression_workers=args.compression_workers,
+                                shard_max_files=args.shard_max_files,
+                                shard_max_bytes=args.shard_max_bytes,
+                                shard_group_by=args.shard_by,
+                                shard_workers=args.shard_workers,
+                                shard_executor=args.shard_executor,
+                                row_filter=row_filter,
+                                decompress_metadata=args.decompress_metadata,
+                                payload_store=payload_store,
+                                resume=args.resume,
+                                use_search_api=args.search_api,
+                                search_page_size=args.search_page_size,
+                                search_workers=args.search_workers)
+    elif args.metadata_file:
+        e2b.create_bag_from_metadata_file(args.metadata_file,
+                                          output_name=args.output_name,
+                                          output_path=args.output_path,
+                                          archive_format=args.archiver,
+                                          creator_name=args.creator_name,
+                                          creator_orcid=args.creator_orcid,
+                                          create_ro_manifest=args.create_ro_manifest,
+                                          materialize=args.materialize,
+                                          materialize_workers=args.materialize_workers,
+                                          max_bandwidth=args.max_bandwidth,
+                                          stream_archive=args.stream,
+                                          archive_output=archive_output,
+                                          compression_level=args.compression_level,
+                                          compression_workers=args.compression_workers,
+                                          shard_max_files=args.shard_max_files,
+                                          shard_max_bytes=args.shard_max_bytes,
+                                          shard_group_by=args.shard_by,
+                                          shard_workers=args.shard_workers,
+                                          shard_executor=args.shard_executor,
+                                          row_filter=row_filter,
+                                          decompress_metadata=args.decompress_metadata,
+                                          payload_store=payload_store,
+                                          resume=args.resume)
+
+
 def main():
 
     sys.stderr.write('\n')
     args = parse_cli()
     error = None
     result = 0
+    archive_output = getattr(sys.stdout, "buffer", sys.stdout) if args.stdout else None
+
+    metrics = inst.PipelineMetrics()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
 
     try:
-        if args.url:
-            e2b.create_bag_from_url(args.url,
-                                    output_name=args.output_name,
-                                    output_path=args.output_path,
-                                    archive_format=args.archiver,
-                                    creator_name=args.creator_name,
-                                    creator_orcid=args.creator_orcid,
-                                    create_ro_manifest=args.create_ro_manifest)
-        elif args.metadata_file:
-            e2b.create_bag_from_metadata_file(args.metadata_file,
-                                              output_name=args.output_name,
-                                              output_path=args.output_path,
-                                              archive_format=args.archiver,
-                                              creator_name=args.creator_name,
-                                              creator_orcid=args.creator_orcid,
-                                              create_ro_manifest=args.create_ro_manifest)
+        with inst.collect(metrics):
+            run(args, archive_output)
     except Exception as e:
         result = 1
         error = "Error: %s" % gne(e)
 
     finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            import pstats
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+        if args.stage_report:
+            metrics.write_json_report(args.stage_report)
+        if args.prometheus_textfile:
+            metrics.write_prometheus_textfile(args.prometheus_textfile)
         if result != 0:
             sys.stderr.write("\n%s" % error)
 
@@ -0,0 +1,170 @@
+import os.path as osp
+import csv
+import fnmatch
+import logging
+from itertools import chain
+from encode2bag import compression
+
+logger = logging.getLogger(__name__)
+
+ENCODE_FILE_SIZE = "Size"
+GLOB_CHARACTERS = set("*?[")
+QUOTE_CHARACTER = '"'
+
+
+def parse_metadata_line(line):
+    return next(csv.reader([line], delimiter='\t'))
+
+
+def iter_metadata_records(metadata, field_count, header_field_count):
+    """
+    Yields (line number, fields, text) for each record of an ENCODE metadata file whose header line has already been
+    read, skipping blank lines. Lines are split only as far as field_count fields, except that records starting on a
+    line that contains a quote character are parsed with the csv module, including quoted fields spanning several
+    lines, in which case text holds all the lines of the record. Raises a RuntimeError naming the line of a record
+    with fewer than field_count fields.
+    """
+    lines = iter(metadata)
+    line_number = 1
+
+    def consume(record_lines):
+        for line in lines:
+            record_lines.append(line)
+            yield line
+
+    for line in lines:
+        line_number += 1
+        start = line_number
+        if QUOTE_CHARACTER in line:
+            # A quoted field may span several lines, which the csv reader takes from the same iterator.
+            record_lines = [line]
+            fields = next(csv.reader(chain([line], consume(record_lines)), delimiter="\t"))
+            line_number += len(record_lines) - 1
+            text = "".join(record_lines)
+            if not fields:
+                continue
+        else:
+            text = line
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            fields = line.split("\t", field_count)
+        if len(fields) < field_count:
+            raise RuntimeError("Metadata row at line %d has %d fields, but the column header has %d" %
+                               (start, len(fields), header_field_count))
+        yield start, fields, text
+
+
+class ColumnPredicate(object):
+    """
+    Matches a metadata column against one or more values. Values containing glob characters (*, ? or [) are matched
+    as case-sensitive shell-style patterns, all other values must be equal to the column value.
+    """
+    def __init__(self, column, values):
+        self.column = column
+        self.values = set(v for v in values if not GLOB_CHARACTERS.intersection(v))
+        self.patterns = [v for v in values if GLOB_CHARACTERS.intersection(v)]
+
+    @classmethod
+    def parse(cls, expression):
+        # Parses "<column>=<value>[,<value>...]".
+        column, separator, values = expression.partition("=")
+        if not separator or not column.strip():
+            raise RuntimeError("Invalid column filter expression \"%s\", expected <column>=<value>[,<value>...]" %
+                               expression)
+        return cls(column.strip(), [v.strip() for v in values.split(",")])
+
+    def matches(self, value):
+        if value in self.values:
+            return True
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(value, pattern):
+                return True
+        return False
+
+    def __repr__(self):
+        return "%s=%s" % (self.column, ",".join(sorted(self.values) + self.patterns))
+
+
+class RowFilter(object):
+    """
+    Selects ENCODE metadata rows: a row is kept when it matches every include predicate, no exclude predicate, and its
+    "Size" is within the optional bounds. A RowFilter holds no per-file state, so one instance may be shared by
+    concurrent bag builds.
+    """
+    def __init__(self, include=None, exclude=None, min_size=None, max_size=None):
+        self.include = [p if isinstance(p, ColumnPredicate) else ColumnPredicate.parse(p) for p in include or list()]
+        self.exclude = [p if isinstance(p, ColumnPredicate) else ColumnPredicate.parse(p) for p in exclude or list()]
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def columns(self):
+        columns = set(p.column for p in self.include + self.exclude)
+        if self.min_size is not None or self.max_size is not None:
+            columns.add(ENCODE_FILE_SIZE)
+        return columns
+
+    def validate_columns(self, fieldnames):
+        missing = self.columns() - set(fieldnames)
+        if missing:
+            raise RuntimeError("One or more filter column names %s was not found in the column header %s" %
+                               (sorted(missing), str(fieldnames)))
+
+    def size_matches(self, size):
+        if self.min_size is None and self.max_size is None:
+            return True
+        size = int(size or 0)
+        return (self.min_size is None or size >= self.min_size) and (self.max_size is None or size <= self.max_size)
+
+    def field_count(self, fieldnames):
+        # The number of leading fields of a row that hold every filtered column.
+        return max([fieldnames.index(column) for column in self.columns()] or [-1]) + 1
+
+    def compile(self, fieldnames):
+        # Resolves the predicates to column positions once per file and returns a function matching a list of row
+        # fields, which only touches the filtered columns of each row.
+        self.validate_columns(fieldnames)
+        include = [(fieldnames.index(p.column), p) for p in self.include]
+        exclude = [(fieldnames.index(p.column), p) for p in self.exclude]
+        size_index = fieldnames.index(ENCODE_FILE_SIZE) if ENCODE_FILE_SIZE in self.columns() else None
+
+        def matches_fields(fields):
+            for index, predicate in include:
+                if not predicate.matches(fields[index]):
+                    return False
+            for index, predicate in exclude:
+                if predicate.matches(fields[index]):
+                    return False
+            return size_index is None or self.size_matches(fields[size_index])
+        return matches_fields
+
+    def matches(self, row):
+        for predicate in self.include:
+            if not predicate.matches(row[predicate.column]):
+                return False
+        for predicate in self.exclude:
+            if predicate.matches(row[predicate.column]):
+                return False
+        return ENCODE_FILE_SIZE not in row or self.size_matches(row[ENCODE_FILE_SIZE])
+
+    def __repr__(self):
+        return "RowFilter(include=%s, exclude=%s, min_size=%s, max_size=%s)" % \
+            (self.include, self.exclude, self.min_size, self.max_size)
+
+
+def filter_metadata_file(input_path, output_path, row_filter):
+    # Streams the rows of input_path selected by row_filter to output_path, preserving the header and the original
+    # text of each row, including quoted fields spanning several lines. Returns the number of rows written.
+    with compression.open_text(input_path) as metadata, open(output_path, "w") as filtered:
+        header_line = metadata.readline()
+        fieldnames = parse_metadata_line(header_line.rstrip("\r\n"))
+        matches = row_filter.compile(fieldnames)
+        filtered.write(header_line)
+        count = total = 0
+        for _, fields, text in iter_metadata_records(metadata, row_filter.field_count(fieldnames), len(fieldnames)):
+            total += 1
+            if matches(fields):
+                filtered.write(text if text.endswith("\n") else text + "\n")
+                count += 1
+    logger.info("Selected %d of %d rows of %s using %s" % (count, total, osp.basename(input_path), row_filter))
+    return count
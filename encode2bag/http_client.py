@@ -0,0 +1,228 @@
+import os
+import sys
+import logging
+import random
+import threading
+import time
+from encode2bag import get_named_exception as gne
+
+if sys.version_info > (3,):
+    from urllib.parse import urlsplit
+else:
+    from urlparse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 1.0
+DEFAULT_BACKOFF_MAX = 60
+DEFAULT_POOL_SIZE = 16
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_retry_exceptions():
+    # requests is only imported once a transfer is made, so that the defaults above can be used (e.g. by the CLI)
+    # without loading it.
+    import requests
+    return (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError)
+
+
+def backoff_delay(attempt, backoff_factor=DEFAULT_BACKOFF_FACTOR, backoff_max=DEFAULT_BACKOFF_MAX, retry_after=None):
+    # "Full jitter" exponential backoff: a uniformly random delay between zero and the capped exponential bound.
+    delay = random.uniform(0, min(backoff_max, backoff_factor * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(backoff_max, retry_after))
+    return delay
+
+
+def get_retry_after(headers):
+    value = headers.get("Retry-After")
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return None
+
+
+class HTTPTransferError(RuntimeError):
+    def __init__(self, message, status_code=None):
+        super(HTTPTransferError, self).__init__(message)
+        self.status_code = status_code
+
+
+class HTTPDownloader(object):
+    """
+    Pooled, retrying HTTP client used for all encode2bag fetches. A single instance holds one requests.Session (and
+    therefore one keep-alive connection pool per host) and is safe to share between threads.
+    """
+    def __init__(self,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                 backoff_max=DEFAULT_BACKOFF_MAX,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 chunk_size=CHUNK_SIZE,
+                 session=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.chunk_size = chunk_size
+        self._session = session
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def backoff_delay(self, attempt, retry_after=None):
+        return backoff_delay(attempt, self.backoff_factor, self.backoff_max, retry_after)
+
+    def _sleep_before_retry(self, url, attempt, reason, retry_after=None):
+        delay = self.backoff_delay(attempt, retry_after)
+        logger.warning("Request for %s failed (%s), retrying in %.2f seconds (attempt %d of %d)." %
+                       (url, reason, delay, attempt + 1, self.max_retries))
+        time.sleep(delay)
+
+    @staticmethod
+    def _get_retry_after(response):
+        return get_retry_after(response.headers)
+
+    def get(self, url, headers=None, stream=True):
+        import requests
+        retry_exceptions = get_retry_exceptions()
+        attempt = 0
+        while True:
+            try:
+                r = self.session.get(url, headers=headers, stream=stream, timeout=self.timeout)
+            except retry_exceptions as e:
+                if attempt >= self.max_retries:
+                    raise HTTPTransferError("HTTP Request Exception: %s" % gne(e))
+                self._sleep_before_retry(url, attempt, gne(e))
+                attempt += 1
+                continue
+            except requests.exceptions.RequestException as e:
+                raise HTTPTransferError("HTTP Request Exception: %s" % gne(e))
+
+            if r.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                retry_after = self._get_retry_after(r)
+                r.close()
+                self._sleep_before_retry(url, attempt, "HTTP %s" % r.status_code, retry_after)
+                attempt += 1
+                continue
+            return r
+
+    def download(self, url, output_path, resume=False, headers=None, callback=None, offset_callback=None):
+        """
+        Download url to output_path. If resume is True and a partial file already exists, only the missing bytes are
+        requested using an HTTP Range request. Transfers interrupted mid-stream are retried from the last byte written,
+        with an If-Range header holding the validator of the first response, so that a file that changed on the server
+        in the meantime is transferred again from the start rather than appended to. The optional callback is invoked with each chunk of data written, and the optional offset_callback with the
+        file offset at which each (re)started transfer begins writing. Returns the final response object.
+        """
+        retry_exceptions = get_retry_exceptions()
+        attempt = 0
+        validator = None
+        while True:
+            offset = 0
+            if (resume or attempt > 0) and os.path.isfile(output_path):
+                offset = os.path.getsize(output_path)
+            request_headers = dict(headers or {})
+            if offset > 0:
+                request_headers["Range"] = "bytes=%d-" % offset
+                if validator:
+                    request_headers["If-Range"] = validator
+
+            r = self.get(url, headers=request_headers, stream=True)
+            try:
+                if offset > 0 and r.status_code == 416:
+                    logger.info("File [%s] already complete." % output_path)
+                    return r
+                if r.status_code == 304:
+                    logger.info("File [%s] not modified on server." % output_path)
+                    return r
+                if r.status_code not in (200, 206):
+                    logger.error('HTTP GET Failed for url: %s' % url)
+                    logger.error("Host %s responded:\n\n%s" % (urlsplit(url).netloc, r.text))
+                    raise HTTPTransferError('File [%s] transfer failed. ' % output_path, r.status_code)
+                if validator is None or r.status_code == 200:
+                    validator = get_range_validator(r.headers)
+                mode = "ab" if r.status_code == 206 else "wb"
+                if offset > 0 and mode == "ab":
+                    logger.info("Resuming transfer of [%s] at byte offset %d." % (output_path, offset))
+                elif offset > 0:
+                    logger.info("Restarting transfer of [%s] from the start, the server sent the whole file." %
+                                output_path)
+                if offset_callback:
+                    offset_callback(offset if mode == "ab" else 0)
+                with open(output_path, mode) as data_file:
+                    for chunk in r.iter_content(self.chunk_size):
+                        if not chunk:
+                            continue
+                        data_file.write(chunk)
+                        if callback:
+                            callback(chunk)
+                    data_file.flush()
+                logger.info('File [%s] transfer successful.' % output_path)
+                return r
+            except retry_exceptions as e:
+                if attempt >= self.max_retries:
+                    raise HTTPTransferError("HTTP Request Exception: %s" % gne(e))
+                self._sleep_before_retry(url, attempt, gne(e))
+                attempt += 1
+            finally:
+                r.close()
+
+
+def get_range_validator(response_headers):
+    # The validator sent in the If-Range header of a resumed request: a strong ETag, or else the Last-Modified date.
+    etag = response_headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response_headers.get("Last-Modified")
+
+
+_default_downloader = None
+_default_downloader_lock = threading.Lock()
+
+
+def get_default_downloader():
+    global _default_downloader
+    if _default_downloader is None:
+        with _default_downloader_lock:
+            if _default_downloader is None:
+                _default_downloader = HTTPDownloader()
+    return _default_downloader
+
+
+def configure_default_downloader(**kwargs):
+    global _default_downloader
+    with _default_downloader_lock:
+        if _default_downloader is not None:
+            _default_downloader.close()
+        _default_downloader = HTTPDownloader(**kwargs)
+    return _default_downloader
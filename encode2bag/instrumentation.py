@@ -0,0 +1,154 @@
+import os
+import os.path as osp
+import sys
+import json
+import logging
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from encode2bag import bag_utils
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_METRICS = [
+    ("encode2bag_stage_duration_seconds", "wall_time", "Wall time spent in each encode2bag pipeline stage."),
+    ("encode2bag_stage_bytes", "bytes", "Bytes transferred or written by each encode2bag pipeline stage."),
+    ("encode2bag_stage_rows", "rows", "Metadata rows or files processed by each encode2bag pipeline stage."),
+    ("encode2bag_stage_peak_rss_bytes", "peak_rss_bytes",
+     "Peak resident set size of the process at the end of each encode2bag pipeline stage.")]
+
+_local = threading.local()
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere.
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+class StageRecord(object):
+
+    def __init__(self, name, wall_time=0.0, bytes=0, rows=0):
+        self.name = name
+        self.wall_time = wall_time
+        self.bytes = bytes
+        self.rows = rows
+        self.peak_rss_bytes = None
+
+    @classmethod
+    def from_dict(cls, value):
+        stage_record = cls(value["stage"], value["wall_time"], value["bytes"], value["rows"])
+        stage_record.peak_rss_bytes = value.get("peak_rss_bytes")
+        return stage_record
+
+    def to_dict(self):
+        return OrderedDict([("stage", self.name),
+                            ("wall_time", round(self.wall_time, 6)),
+                            ("bytes", self.bytes),
+                            ("rows", self.rows),
+                            ("peak_rss_bytes", self.peak_rss_bytes)])
+
+
+class PipelineMetrics(object):
+    """
+    Collects a StageRecord for each pipeline stage run by the thread that activated it with collect(). Peak memory is
+    the peak RSS of the whole process at the end of the stage, since that is what the operating system reports.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.stages = list()
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        if record.peak_rss_bytes is None:
+            record.peak_rss_bytes = peak_rss_bytes()
+        with self._lock:
+            self.stages.append(record)
+
+    def totals(self):
+        # Stages that ran more than once (e.g. in batch mode) are summed, keeping the highest peak memory.
+        totals = OrderedDict()
+        for record in self.stages:
+            total = totals.get(record.name)
+            if total is None:
+                total = totals[record.name] = StageRecord(record.name)
+            total.wall_time += record.wall_time
+            total.bytes += record.bytes
+            total.rows += record.rows
+            total.peak_rss_bytes = max(total.peak_rss_bytes, record.peak_rss_bytes) \
+                if total.peak_rss_bytes is not None else record.peak_rss_bytes
+        return totals
+
+    def report(self):
+        return OrderedDict([("timestamp", time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start))),
+                            ("total_wall_time", round(time.time() - self.start, 6)),
+                            ("peak_rss_bytes", peak_rss_bytes()),
+                            ("stages", [record.to_dict() for record in self.stages])])
+
+    def write_json_report(self, output_path):
+        with open(output_path, "w") as output:
+            json.dump(self.report(), output, indent=4)
+        logger.info("Wrote stage timing report to %s" % output_path)
+
+    def write_prometheus_textfile(self, output_path):
+        # The textfile is written to a temporary file and renamed into place, so that a node_exporter textfile
+        # collector never reads a partially written file.
+        lines = list()
+        totals = self.totals()
+        for metric, attribute, description in PROMETHEUS_METRICS:
+            lines.append("# HELP %s %s\n" % (metric, description))
+            lines.append("# TYPE %s gauge\n" % metric)
+            for record in totals.values():
+                value = getattr(record, attribute)
+                if value is not None:
+                    lines.append("%s{stage=\"%s\"} %s\n" % (metric, record.name, value))
+        output_dir = osp.dirname(osp.abspath(output_path))
+        fd, temp_path = tempfile.mkstemp(prefix=".encode2bag_metrics_", dir=output_dir)
+        with os.fdopen(fd, "w") as output:
+            output.write(''.join(lines))
+        bag_utils.replace_file(temp_path, output_path)
+        logger.info("Wrote stage metrics textfile to %s" % output_path)
+
+
+def get_metrics():
+    return getattr(_local, "metrics", None)
+
+
+@contextmanager
+def collect(metrics=None):
+    # Activates a PipelineMetrics collector for the stages run by the current thread.
+    if metrics is None:
+        metrics = PipelineMetrics()
+    previous = get_metrics()
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+
+def record(name, wall_time, bytes=0, rows=0):
+    stage_record = StageRecord(name, wall_time, bytes, rows)
+    logger.info("Stage [%s] completed in %.3f seconds (%d bytes, %d rows)." % (name, wall_time, bytes, rows))
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.add(stage_record)
+    return stage_record
+
+
+@contextmanager
+def stage(name):
+    # Times the enclosed block as the named stage. The yielded StageRecord may be used to set bytes and rows.
+    stage_record = StageRecord(name)
+    start = time.time()
+    yield stage_record
+    record(name, time.time() - start, stage_record.bytes, stage_record.rows)
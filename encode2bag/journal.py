@@ -0,0 +1,131 @@
+import os
+import os.path as osp
+import json
+import logging
+import shutil
+import time
+from contextlib import contextmanager
+from encode2bag import bag_utils
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE_NAME = "journal.json"
+JOURNAL_VERSION = 1
+
+
+def get_journal_path(bag_path):
+    return ''.join([bag_path, ".journal"])
+
+
+class BuildJournal(object):
+    """
+    On-disk journal of a resumable bag build, kept in a "<bag name>.journal" directory next to the output bag. The
+    directory also serves as the working directory of the build, so the downloaded metadata, the remote file manifest
+    and other intermediate files survive an interrupted run. Each completed stage is recorded with its results, and the
+    byte offsets reached by the files of a stage that failed are recorded as well. A build restarted with resume=True
+    skips the completed stages and resumes interrupted downloads from the last byte written; without resume, or when
+    the build parameters differ from the journaled ones, any previous journal is discarded. The journal is removed
+    once the build completes.
+    """
+    def __init__(self, bag_path, parameters=None, resume=False):
+        self.bag_path = bag_path
+        self.path = get_journal_path(bag_path)
+        self.parameters = parameters or dict()
+        self.state = None
+        if resume:
+            self.state = self._load()
+            if self.state is not None and self.state.get("parameters") != self.parameters:
+                logger.warning("The build journal %s was written with different build parameters and is discarded."
+                               % self.path)
+                self.state = None
+            elif self.state is not None:
+                logger.info("Resuming build of %s after the completed stages: %s" %
+                            (bag_path, ", ".join(self.state["stages"].keys()) or "none"))
+        if self.state is None:
+            if osp.isdir(self.path):
+                shutil.rmtree(self.path)
+            os.makedirs(self.path)
+            self.state = {"version": JOURNAL_VERSION, "parameters": self.parameters, "stages": dict(),
+                          "partial": dict()}
+            self.save()
+
+    def _load(self):
+        journal_file = osp.join(self.path, JOURNAL_FILE_NAME)
+        if not osp.isfile(journal_file):
+            return None
+        try:
+            with open(journal_file) as journal:
+                state = json.load(journal)
+        except ValueError:
+            logger.warning("Ignoring corrupt build journal: %s" % journal_file)
+            return None
+        return state if state.get("version") == JOURNAL_VERSION else None
+
+    def save(self):
+        journal_file = osp.join(self.path, JOURNAL_FILE_NAME)
+        temp_path = ''.join([journal_file, ".tmp"])
+        self.state["updated_on"] = time.time()
+        with open(temp_path, "w") as journal:
+            json.dump(self.state, journal, sort_keys=True, indent=4)
+        bag_utils.replace_file(temp_path, journal_file)
+
+    def working_path(self, *names):
+        return osp.join(self.path, *names)
+
+    def completed(self, stage):
+        return stage in self.state["stages"]
+
+    def result(self, stage, name, default=None):
+        return self.state["stages"].get(stage, dict()).get(name, default)
+
+    def offsets(self, stage):
+        return self.state["partial"].get(stage, dict())
+
+    def complete(self, stage, **results):
+        results["completed_on"] = time.time()
+        self.state["stages"][stage] = results
+        self.state["partial"].pop(stage, None)
+        self.save()
+
+    @contextmanager
+    def checkpoint(self, stage, partial_files=None):
+        """
+        Runs the body of the with statement as a journaled stage, yielding a dict of results that are recorded when
+        the stage completes. If the stage fails, the sizes of the files listed by partial_files (a list of paths or a
+        function returning one) are recorded as the offsets from which a resumed run continues.
+        """
+        results = dict()
+        offsets = self.offsets(stage)
+        if offsets:
+            logger.info("Resuming stage %s with %d partial files (%d bytes already transferred)." %
+                        (stage, len(offsets), sum(offsets.values())))
+        for path, offset in sorted(offsets.items()):
+            logger.debug("Resuming %s at byte offset %d." % (path, offset))
+        try:
+            yield results
+        except BaseException:
+            if partial_files is not None:
+                paths = partial_files() if callable(partial_files) else partial_files
+                offsets = dict((path, osp.getsize(path)) for path in paths if osp.isfile(path))
+                self.state["partial"][stage] = offsets
+                self.save()
+            raise
+        self.complete(stage, **results)
+
+    def finish(self):
+        if osp.isdir(self.path):
+            shutil.rmtree(self.path)
+
+
+def completed(journal, stage):
+    return journal is not None and journal.completed(stage)
+
+
+@contextmanager
+def checkpoint(journal, stage, partial_files=None):
+    # Runs a stage under journal.checkpoint, or unjournaled if journal is None.
+    if journal is None:
+        yield dict()
+        return
+    with journal.checkpoint(stage, partial_files) as results:
+        yield results
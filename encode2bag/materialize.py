@@ -0,0 +1,196 @@
+import os
+import os.path as osp
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from encode2bag import http_client as http
+from encode2bag import bag_utils
+from encode2bag import get_named_exception as gne
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MATERIALIZE_WORKERS = 4
+DEFAULT_PROGRESS_INTERVAL = 10
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class RateLimiter(object):
+    """
+    Thread-safe limiter capping the aggregate throughput of all callers to rate bytes per second. Each caller reserves
+    a slot on a shared virtual clock and sleeps until that slot has elapsed; up to one second of burst is allowed.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        # Returns the number of seconds the caller has to wait before its amount may be transferred.
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now - 1.0) + amount / self.rate
+            return self._next - now
+
+    def consume(self, amount):
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TransferProgress(object):
+
+    def __init__(self, total_files, total_bytes, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.files_done = 0
+        self.bytes_transferred = 0
+        self.start = time.time()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+
+    def update(self, amount):
+        with self._lock:
+            self.bytes_transferred += amount
+            now = time.time()
+            if now - self._last_report < self.interval:
+                return
+            self._last_report = now
+        self.report()
+
+    def file_done(self):
+        with self._lock:
+            self.files_done += 1
+
+    def throughput(self):
+        elapsed = time.time() - self.start
+        return self.bytes_transferred / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        logger.info("Materialized %d of %d files, transferred %.1f MB of %.1f MB (%.2f MB/s)." %
+                    (self.files_done, self.total_files, self.bytes_transferred / 1e6, self.total_bytes / 1e6,
+                     self.throughput() / 1e6))
+
+    def summary(self):
+        return {"files": self.files_done,
+                "bytes_transferred": self.bytes_transferred,
+                "elapsed": round(time.time() - self.start, 3),
+                "throughput": round(self.throughput(), 3)}
+
+
+class StreamingMD5(object):
+    # Tracks the md5 of a file as it is being written. When a transfer restarts at an offset other than the number of
+    # bytes hashed so far, the already-written prefix of the file is rehashed so the digest stays consistent.
+    def __init__(self, path):
+        self.path = path
+        self.hasher = hashlib.md5()
+        self.hashed = 0
+
+    def update(self, data):
+        self.hasher.update(data)
+        self.hashed += len(data)
+
+    def reset(self, offset):
+        if offset == self.hashed:
+            return
+        self.hasher = hashlib.md5()
+        self.hashed = 0
+        if offset > 0:
+            with open(self.path, "rb") as data_file:
+                remaining = offset
+                while remaining > 0:
+                    block = data_file.read(min(HASH_BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    self.update(block)
+                    remaining -= len(block)
+
+    def hexdigest(self):
+        if osp.isfile(self.path) and osp.getsize(self.path) != self.hashed:
+            self.reset(osp.getsize(self.path))
+        return self.hasher.hexdigest()
+
+
+def read_remote_file_manifest(remote_file_manifest):
+    with open(remote_file_manifest, "r") as rfm:
+        return json.load(rfm)
+
+
+def materialize_file(entry, data_path, downloader, progress=None, rate_limiter=None, resume=True):
+    output_path = osp.join(data_path, entry["filename"])
+    expected_md5 = entry.get("md5")
+    expected_length = int(entry["length"]) if entry.get("length") else None
+
+    if osp.isfile(output_path) and expected_length is not None and osp.getsize(output_path) == expected_length:
+        digest = StreamingMD5(output_path)
+        if not expected_md5 or digest.hexdigest() == expected_md5:
+            logger.debug("File [%s] already present, skipping." % output_path)
+            return 0
+        os.remove(output_path)
+
+    digest = StreamingMD5(output_path)
+
+    def on_chunk(chunk):
+        digest.update(chunk)
+        if rate_limiter:
+            rate_limiter.consume(len(chunk))
+        if progress:
+            progress.update(len(chunk))
+
+    downloader.download(entry["url"], output_path, resume=resume, callback=on_chunk, offset_callback=digest.reset)
+
+    if expected_md5:
+        actual_md5 = digest.hexdigest()
+        if actual_md5 != expected_md5:
+            os.remove(output_path)
+            raise RuntimeError("Checksum mismatch for [%s]: expected md5 %s but received %s" %
+                               (entry["filename"], expected_md5, actual_md5))
+    return digest.hashed
+
+
+def materialize_bag_payload(bag_path,
+                            remote_file_manifest,
+                            workers=DEFAULT_MATERIALIZE_WORKERS,
+                            max_bandwidth=None,
+                            downloader=None,
+                            resume=True,
+                            progress_interval=DEFAULT_PROGRESS_INTERVAL,
+                            payload_store=None):
+    # With a payload_store (see encode2bag.payload_store), files are linked into the payload directory from the store,
+    # which downloads each file only once across bags.
+    if downloader is None:
+        downloader = http.get_default_downloader()
+    entries = read_remote_file_manifest(remote_file_manifest)
+    data_path = osp.abspath(osp.join(bag_path, "data"))
+    bag_utils.ensure_dir(data_path)
+
+    total_bytes = sum(int(entry["length"]) for entry in entries if entry.get("length"))
+    progress = TransferProgress(len(entries), total_bytes, interval=progress_interval)
+    rate_limiter = RateLimiter(max_bandwidth) if max_bandwidth else None
+    logger.info("Materializing %d files (%.1f MB) into %s using %d workers..." %
+                (len(entries), total_bytes / 1e6, data_path, workers))
+
+    transfer = payload_store.materialize_file if payload_store else materialize_file
+    failures = list()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = dict((pool.submit(transfer, entry, data_path, downloader, progress, rate_limiter, resume),
+                        entry) for entry in entries)
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                future.result()
+                progress.file_done()
+            except Exception as e:
+                logger.error("Failed to materialize [%s]: %s" % (entry["filename"], gne(e)))
+                failures.append((entry["filename"], gne(e)))
+
+    progress.report()
+    if failures:
+        raise RuntimeError("Failed to materialize %d of %d files: %s" %
+                           (len(failures), len(entries), ", ".join(f for f, _ in failures)))
+    if payload_store:
+        payload_store.collect_garbage()
+    return progress.summary()
@@ -0,0 +1,39 @@
+from operator import itemgetter
+from encode2bag.filters import iter_metadata_records, parse_metadata_line
+
+
+class MetadataReader(object):
+    """
+    Reads the rows of an ENCODE metadata file as tuples holding only the projected columns, in the given order. Column
+    positions are resolved once from the header and each line is split only as far as the last column needed, so no
+    per-row dict of all the ENCODE columns is built. Rows starting on a line that contains a quote character are parsed
+    with the csv module, including quoted fields spanning several lines, so fields are identical to those of
+    csv.DictReader. Rows rejected by the optional RowFilter are skipped.
+    """
+    def __init__(self, metadata, columns, required_columns=None, row_filter=None):
+        self.metadata = metadata
+        self.fieldnames = parse_metadata_line(metadata.readline().rstrip("\r\n"))
+        self.columns = list(columns)
+        required = set(required_columns or list()).union(self.columns)
+        missing = required - set(self.fieldnames)
+        if missing:
+            raise RuntimeError("One or more required column names %s was not found in the column header %s" %
+                               (missing, str(self.fieldnames)))
+        self.indexes = [self.fieldnames.index(column) for column in self.columns]
+        self.matches = row_filter.compile(self.fieldnames) if row_filter is not None else None
+        # Fields beyond the last projected or filtered column are left unsplit.
+        self.field_count = max(max(self.indexes) + 1, row_filter.field_count(self.fieldnames) if row_filter else 0)
+
+    def project(self):
+        if len(self.indexes) == 1:
+            index = self.indexes[0]
+            return lambda fields: (fields[index],)
+        return itemgetter(*self.indexes)
+
+    def __iter__(self):
+        project = self.project()
+        matches = self.matches
+        for _, fields, _ in iter_metadata_records(self.metadata, self.field_count, len(self.fieldnames)):
+            if matches is not None and not matches(fields):
+                continue
+            yield project(fields)
@@ -0,0 +1,326 @@
+import argparse
+import sys
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from encode2bag import synthetic
+from encode2bag import search_api
+
+if sys.version_info > (3,):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qsl
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qsl
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROWS = 100
+DEFAULT_PAYLOAD_SIZE_RANGE = (1024, 64 * 1024)
+WRITE_BLOCK_SIZE = 64 * 1024
+SEARCH_PATHS = ("/search/", "/report/", "/matrix/")
+BATCH_DOWNLOAD_PATH = "/batch_download/"
+METADATA_PATH = "/metadata/"
+FILES_PATH = "/files/"
+
+
+class MockENCODEServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for www.encodeproject.org implementing the batch download contract used by encode2bag:
+
+        /search/?<query>, /report/?<query>, /matrix/?<query>   placeholder search result pages
+        /search/?<query>&format=json                            JSON search results, paged by the "from" and "limit"
+                                                                parameters and projected to the "field" parameters
+        /batch_download/<query>                                 manifest listing the metadata URL and file URLs
+        /metadata/<query>/metadata.tsv                          generated ENCODE metadata TSV for the query
+        /files/<accession>/@@download/<filename>                generated payload files (with Range support)
+
+    Each query yields a deterministic metadata file (seeded from the query) of `rows` rows, or of the number given by
+    a "mock_rows" query parameter. Latency, a per-connection bandwidth limit, a rate of injected 5xx responses and a
+    rate of connections dropped mid-response can be configured to exercise retry and resume behaviour.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, rows=DEFAULT_ROWS, payload_size_range=DEFAULT_PAYLOAD_SIZE_RANGE,
+                 latency=0.0, bandwidth=None, error_rate=0.0, drop_rate=0.0, error_status=503, seed=0):
+        HTTPServer.__init__(self, (host, port), MockENCODERequestHandler)
+        self.rows = rows
+        self.payload_size_range = payload_size_range
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.files = dict()
+        self.request_log = list()
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://%s:%d" % (self.server_address[0], self.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def chance(self, rate):
+        with self._lock:
+            return rate > 0 and self.random.random() < rate
+
+    def record_request(self, path):
+        with self._lock:
+            self.request_log.append(path)
+
+    def record_bytes(self, count):
+        with self._lock:
+            self.bytes_sent += count
+
+    def search_url(self, query, endpoint="search"):
+        return "%s/%s/?%s" % (self.base_url, endpoint, query)
+
+    def generate_metadata(self, query):
+        params = dict(parse_qsl(query))
+        rows = int(params.get("mock_rows", self.rows))
+        seed = zlib.crc32(query.encode("utf-8")) & 0xffffffff
+        lines = list()
+        for row in synthetic.generate_metadata_rows(rows, seed=seed, base_url=self.base_url,
+                                                    payload_size_range=self.payload_size_range):
+            with self._lock:
+                self.files[row["File download URL"].split("/")[-1]] = (row["File accession"], int(row["Size"]))
+            lines.append(row)
+        return ''.join(synthetic.format_metadata_rows(lines)).encode("utf-8"), lines
+
+    def search(self, query):
+        # Serves the rows of the metadata file of a query as File objects, which other search types (e.g. Experiment)
+        # return embedded in the "files" of their results. Like ENCODE, such a search selects the results with a file
+        # matching the "files.*" terms of the query but embeds all of their files.
+        params = parse_qsl(query, keep_blank_values=True)
+        options = dict(params)
+        base_query = "&".join(p for p in query.split("&")
+                              if p and p.partition("=")[0] not in search_api.PAGING_PARAMETERS)
+        _, rows = self.generate_metadata(base_query)
+        results = [make_file_object(row, self.base_url) for row in rows]
+        if options.get("type") != search_api.FILE_TYPE:
+            file_filters = search_api.get_file_filters(base_query, options.get("type"))
+            experiments = OrderedDict()
+            for file_object in results:
+                experiment = experiments.setdefault(file_object["dataset"], {"@id": file_object["dataset"],
+                                                                             "@type": ["Experiment"],
+                                                                             "files": list()})
+                experiment["files"].append(file_object)
+            results = [experiment for experiment in experiments.values()
+                       if any(search_api.file_matches(f, file_filters) for f in experiment["files"])]
+        fields = [value for key, value in params if key == "field"]
+        if fields:
+            results = [project_fields(result, fields + ["@id", "@type"]) for result in results]
+        start = int(options.get("from", 0))
+        limit = len(results) if options.get("limit") == "all" else int(options.get("limit", 25))
+        return {"@graph": results[start:start + limit], "total": len(results)}
+
+
+def make_file_object(row, base_url):
+    # Inverse of search_api.make_metadata_row for the synthetic metadata rows.
+    file_object = {"@id": "/files/%s/" % row["File accession"], "@type": ["File"]}
+    for column, prop in search_api.FILE_COLUMNS:
+        value = row.get(column)
+        if not value:
+            continue
+        if prop in ("file_size", "read_length"):
+            value = int(value)
+        elif prop == "biological_replicates":
+            value = [int(v) for v in value.split(", ")]
+        elif prop == "technical_replicates":
+            value = value.split(", ")
+        elif prop == "dataset":
+            value = "/experiments/%s/" % value
+        elif prop == "href":
+            value = value[len(base_url):]
+        target = file_object
+        names = prop.split(".")
+        for name in names[:-1]:
+            target = target.setdefault(name, dict())
+        target[names[-1]] = value
+    return file_object
+
+
+def project_fields(obj, fields):
+    # Keeps only the (dotted) fields of obj, applying the remainder of a dotted field to every element of a list.
+    if isinstance(obj, list):
+        return [project_fields(element, fields) for element in obj]
+    if not isinstance(obj, dict):
+        return obj
+    projected = dict()
+    nested = OrderedDict()
+    for field in fields:
+        name, _, rest = field.partition(".")
+        if name not in obj:
+            continue
+        if rest:
+            nested.setdefault(name, list()).append(rest)
+        else:
+            projected[name] = obj[name]
+    for name, rest in nested.items():
+        if name not in projected:
+            projected[name] = project_fields(obj[name], rest)
+    return projected
+
+
+class MockENCODERequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("MockENCODEServer: " + format % args)
+
+    def do_GET(self):
+        server = self.server
+        server.record_request(self.path)
+        if server.latency:
+            time.sleep(server.latency)
+        if server.chance(server.error_rate):
+            return self.send_body(b"Injected server error", status=server.error_status)
+
+        path = urlsplit(self.path).path
+        if path in SEARCH_PATHS and dict(parse_qsl(urlsplit(self.path).query)).get("format") == "json":
+            return self.send_body(json.dumps(server.search(urlsplit(self.path).query)).encode("utf-8"),
+                                  content_type="application/json")
+        if path in SEARCH_PATHS:
+            return self.send_body(b"<html><body>encode2bag mock search results</body></html>",
+                                  content_type="text/html")
+        if path.startswith(BATCH_DOWNLOAD_PATH):
+            query = self.path[len(BATCH_DOWNLOAD_PATH):]
+            _, rows = server.generate_metadata(query)
+            lines = ["%s%s%s/metadata.tsv" % (server.base_url, METADATA_PATH, query)]
+            lines.extend(row["File download URL"] for row in rows)
+            return self.send_body(("\n".join(lines) + "\n").encode("utf-8"), conditional=True)
+        if path.startswith(METADATA_PATH) and path.endswith("/metadata.tsv"):
+            query = self.path[len(METADATA_PATH):-len("/metadata.tsv")]
+            body, _ = server.generate_metadata(query)
+            return self.send_body(body, content_type="text/tab-separated-values", conditional=True)
+        if path.startswith(FILES_PATH) and "/@@download/" in path:
+            entry = server.files.get(path.split("/")[-1])
+            if entry:
+                accession, size = entry
+                return self.send_body(synthetic.make_payload(accession, size),
+                                      content_type="application/octet-stream")
+        return self.send_body(b"Not Found", status=404)
+
+    def send_body(self, body, status=200, content_type="text/plain", conditional=False):
+        headers = {"Content-Type": content_type, "Accept-Ranges": "bytes"}
+        if conditional:
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if status == 200 and range_header and range_header.startswith("bytes=") and \
+                (if_range is None or if_range == headers.get("ETag")):
+            start, _, end = range_header[len("bytes="):].partition("-")
+            start = int(start)
+            end = int(end) if end else len(body) - 1
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(body))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(body))
+            body = body[start:end + 1]
+            status = 206
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        server = self.server
+        drop_at = len(body) // 2 if status in (200, 206) and server.chance(server.drop_rate) else None
+        # With a bandwidth limit, blocks are small enough for the limit to apply to files smaller than a full block.
+        block_size = min(WRITE_BLOCK_SIZE, max(1, server.bandwidth // 10)) if server.bandwidth else WRITE_BLOCK_SIZE
+        sent = 0
+        while sent < len(body):
+            block = body[sent:sent + block_size]
+            if drop_at is not None and sent + len(block) > drop_at:
+                self.wfile.write(block[:drop_at - sent])
+                self.wfile.flush()
+                server.record_bytes(drop_at - sent)
+                self.close_connection = True
+                return
+            self.wfile.write(block)
+            sent += len(block)
+            server.record_bytes(len(block))
+            if server.bandwidth:
+                time.sleep(float(len(block)) / server.bandwidth)
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(
+        description="Local mock of the ENCODE search and batch download endpoints used by encode2bag.")
+    parser.add_argument('--host', default="127.0.0.1", help="Address to listen on. Default is %(default)s.")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on. Default is %(default)s.")
+    parser.add_argument('--rows', type=int, default=DEFAULT_ROWS,
+                        help="Default number of metadata rows per query. Default is %(default)s.")
+    parser.add_argument('--min-file-size', type=int, default=DEFAULT_PAYLOAD_SIZE_RANGE[0],
+                        help="Minimum size in bytes of generated payload files. Default is %(default)s.")
+    parser.add_argument('--max-file-size', type=int, default=DEFAULT_PAYLOAD_SIZE_RANGE[1],
+                        help="Maximum size in bytes of generated payload files. Default is %(default)s.")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Delay in seconds before each response. Default is %(default)s.")
+    parser.add_argument('--bandwidth', type=int, help="Per-connection bandwidth limit in bytes per second.")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of requests answered with an HTTP 5xx error. Default is %(default)s.")
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help="Fraction of responses whose connection is dropped halfway through the body. "
+                             "Default is %(default)s.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for injected faults. Default is %(default)s.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    server = MockENCODEServer(host=args.host, port=args.port, rows=args.rows,
+                              payload_size_range=(args.min_file_size, args.max_file_size),
+                              latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate,
+                              drop_rate=args.drop_rate, seed=args.seed)
+    logger.info("Mock ENCODE server listening at %s" % server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,330 @@
+import os
+import os.path as osp
+import errno
+import json
+import logging
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from encode2bag import bag_utils
+from encode2bag import materialize as mat
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_DIR = osp.join(osp.expanduser("~"), ".encode2bag", "payloads")
+DEFAULT_STORE_MAX_SIZE = 100 * 1024 * 1024 * 1024
+DEFAULT_LINK_MODE = "auto"
+LINK_MODES = ["auto", "hardlink", "reflink", "symlink", "copy"]
+# Hardlinks are only used when requested, since a hardlinked bag payload file is the store object itself, so that
+# modifying it in place modifies the object shared by every other bag.
+AUTO_LINK_MODES = ["reflink", "copy"]
+PARTIAL_MAX_AGE = 24 * 60 * 60
+MD5_PATTERN = re.compile("^[0-9a-f]{32}$")
+# Linux ioctl making a file share the extents of another on copy-on-write file systems such as Btrfs or XFS.
+FICLONE = 0x40049409
+
+
+def reflink_file(source, destination):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    try:
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    except (IOError, OSError):
+        if osp.isfile(destination):
+            os.remove(destination)
+        raise
+
+
+class KeyLock(object):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.depth = 0
+
+
+class PayloadStore(object):
+    """
+    Local content-addressed store of payload files keyed by their ENCODE md5sum, shared by the bags built on a host so
+    that each file is downloaded once. Objects are placed into bag payload directories by hardlink, reflink, symlink
+    or copy ("auto" uses a reflink where the file system supports it, and a copy otherwise), and every placement is
+    recorded as a reference of the object. Objects without live references are garbage collected, least recently used first, when the store grows
+    beyond max_size. File modes are left unchanged, so bag payload files stay writable. An object whose size no longer
+    matches its remote file (e.g. one modified through a hardlinked bag file) is discarded and fetched again.
+    """
+    def __init__(self, store_dir=DEFAULT_STORE_DIR, max_size=DEFAULT_STORE_MAX_SIZE, link_mode=DEFAULT_LINK_MODE):
+        if link_mode not in LINK_MODES:
+            raise RuntimeError("Unknown payload link mode %s, expected one of %s" % (link_mode, LINK_MODES))
+        self.store_dir = osp.abspath(store_dir)
+        self.max_size = max_size
+        self.link_mode = link_mode
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+
+    def __getstate__(self):
+        # Allows a store to be passed to process pool workers, which create their own locks.
+        state = dict(self.__dict__)
+        del state["_lock"]
+        del state["_key_locks"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+
+    @staticmethod
+    def make_key(md5):
+        key = (md5 or "").strip().lower()
+        return key if MD5_PATTERN.match(key) else None
+
+    def object_path(self, key):
+        return osp.join(self.store_dir, "objects", key[:2], key)
+
+    def partial_path(self, key):
+        return osp.join(self.store_dir, "partial", ''.join([key, ".part"]))
+
+    def _entry_path(self, key):
+        return ''.join([self.object_path(key), ".json"])
+
+    def _lock_path(self, key):
+        return osp.join(self.store_dir, "locks", ''.join([key, ".lock"]))
+
+    @contextmanager
+    def locked(self, key):
+        # Serializes access to an object between the threads of this process and, where file locks are available,
+        # between processes sharing the store. The lock is reentrant; only the outermost acquisition in a thread takes
+        # the file lock, since a process would otherwise block on its own lock.
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = KeyLock()
+        with lock.lock:
+            if fcntl is None or lock.depth > 0:
+                lock.depth += 1
+                try:
+                    yield
+                finally:
+                    lock.depth -= 1
+                return
+            lock_path = self._lock_path(key)
+            bag_utils.ensure_dir(osp.dirname(lock_path))
+            while True:
+                lock_file = open(lock_path, "a")
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                # The lock file of a collected object is removed while it is locked, so a lock taken on a file that
+                # was removed meanwhile is taken again on the current one.
+                try:
+                    if osp.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path)):
+                        break
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        lock_file.close()
+                        raise
+                lock_file.close()
+            with lock_file:
+                lock.depth += 1
+                try:
+                    yield
+                finally:
+                    lock.depth -= 1
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def contains(self, key):
+        return osp.isfile(self.object_path(key))
+
+    def _load_entry(self, key):
+        entry_path = self._entry_path(key)
+        if not (osp.isfile(entry_path) and self.contains(key)):
+            return None
+        try:
+            with open(entry_path) as entry_file:
+                return json.load(entry_file)
+        except ValueError:
+            logger.warning("Ignoring corrupt payload store entry: %s" % entry_path)
+            return None
+
+    def _save_entry(self, key, entry):
+        entry_path = self._entry_path(key)
+        temp_path = ''.join([entry_path, ".tmp"])
+        with open(temp_path, "w") as entry_file:
+            json.dump(entry, entry_file, sort_keys=True)
+        bag_utils.replace_file(temp_path, entry_path)
+
+    def _get_entry(self, key):
+        entry = self._load_entry(key)
+        if entry is None:
+            entry = {"size": osp.getsize(self.object_path(key)), "refs": dict()}
+        entry["last_access"] = time.time()
+        return entry
+
+    def add(self, key, path):
+        # Moves a verified file into the store as the object of key.
+        with self.locked(key):
+            object_path = self.object_path(key)
+            bag_utils.ensure_dir(osp.dirname(object_path))
+            bag_utils.replace_file(path, object_path)
+            self._save_entry(key, self._get_entry(key))
+        return object_path
+
+    def fetch(self, entry, downloader, progress=None, rate_limiter=None, resume=True):
+        """
+        Ensures the object for a remote file manifest entry is in the store, downloading and verifying it if needed.
+        Interrupted downloads are kept in the store and resumed by a later fetch. Returns the object path and the
+        number of bytes transferred.
+        """
+        key = self.make_key(entry.get("md5"))
+        if key is None:
+            raise RuntimeError("The remote file %s has no valid md5sum and cannot be stored by checksum." %
+                               entry["filename"])
+        with self.locked(key):
+            if self.contains(key):
+                object_path = self.object_path(key)
+                if entry.get("length") and osp.getsize(object_path) != int(entry["length"]):
+                    logger.warning("Discarding payload store object %s of [%s], whose size no longer matches the "
+                                   "remote file." % (key, entry["filename"]))
+                    for path in (object_path, self._entry_path(key)):
+                        if osp.isfile(path):
+                            os.remove(path)
+                else:
+                    self._save_entry(key, self._get_entry(key))
+                    logger.debug("File [%s] found in payload store as %s." % (entry["filename"], key))
+                    return object_path, 0
+            partial_path = self.partial_path(key)
+            bag_utils.ensure_dir(osp.dirname(partial_path))
+            transferred = mat.materialize_file(dict(entry, filename=osp.basename(partial_path)),
+                                               osp.dirname(partial_path), downloader, progress, rate_limiter, resume)
+            return self.add(key, partial_path), transferred
+
+    def link(self, key, destination):
+        # Places the object of key at destination and records destination as a reference. Returns the link mode used.
+        destination = osp.abspath(destination)
+        with self.locked(key):
+            object_path = self.object_path(key)
+            modes = AUTO_LINK_MODES if self.link_mode == "auto" else [self.link_mode]
+            if osp.lexists(destination):
+                if osp.exists(destination) and osp.samefile(destination, object_path):
+                    modes = list()
+                    mode = "symlink" if osp.islink(destination) else "hardlink"
+                else:
+                    os.remove(destination)
+            for mode in modes:
+                try:
+                    if mode == "hardlink":
+                        os.link(object_path, destination)
+                    elif mode == "reflink":
+                        reflink_file(object_path, destination)
+                    elif mode == "symlink":
+                        os.symlink(object_path, destination)
+                    else:
+                        shutil.copyfile(object_path, destination)
+                    break
+                except (IOError, OSError) as e:
+                    if mode == modes[-1]:
+                        raise
+                    logger.debug("Unable to %s %s, trying next link mode: %s" % (mode, destination, e))
+            entry = self._get_entry(key)
+            entry["refs"][destination] = mode
+            self._save_entry(key, entry)
+        return mode
+
+    def materialize_file(self, entry, data_path, downloader, progress=None, rate_limiter=None, resume=True):
+        # Drop-in replacement of materialize.materialize_file populating data_path from the store. Entries without a
+        # valid md5sum cannot be looked up and are downloaded directly.
+        key = self.make_key(entry.get("md5"))
+        if key is None:
+            return mat.materialize_file(entry, data_path, downloader, progress, rate_limiter, resume)
+        with self.locked(key):
+            _, transferred = self.fetch(entry, downloader, progress, rate_limiter, resume)
+            self.link(key, osp.join(data_path, entry["filename"]))
+        return transferred
+
+    def is_live_reference(self, key, path, mode):
+        object_path = self.object_path(key)
+        if mode == "symlink":
+            return osp.islink(path) and osp.realpath(path) == osp.realpath(object_path)
+        if not osp.isfile(path):
+            return False
+        if mode == "hardlink":
+            return osp.samefile(path, object_path)
+        return osp.getsize(path) == osp.getsize(object_path)
+
+    def entries(self):
+        objects_dir = osp.join(self.store_dir, "objects")
+        if not osp.isdir(objects_dir):
+            return list()
+        result = list()
+        for prefix in os.listdir(objects_dir):
+            for name in os.listdir(osp.join(objects_dir, prefix)):
+                key = self.make_key(name)
+                if key is None:
+                    continue
+                entry = self._load_entry(key)
+                if entry is None:
+                    entry = {"size": osp.getsize(self.object_path(key)), "refs": dict(), "last_access": 0}
+                result.append((key, entry))
+        return result
+
+    def size(self):
+        return sum(entry["size"] for _, entry in self.entries())
+
+    def collect_garbage(self, max_size=None):
+        """
+        Drops references to bag files that were deleted or replaced, then removes objects without references, least
+        recently used first, until the store is within max_size (by default the store's max_size; 0 removes every
+        unreferenced object). Stale partial downloads are removed as well. Returns a summary dict.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        total = 0
+        unreferenced = list()
+        entries = self.entries()
+        for key, entry in entries:
+            with self.locked(key):
+                entry = self._load_entry(key) or entry
+                refs = dict((path, mode) for path, mode in entry["refs"].items()
+                            if self.is_live_reference(key, path, mode))
+                if refs != entry["refs"]:
+                    entry["refs"] = refs
+                    self._save_entry(key, entry)
+            total += entry["size"]
+            if not refs:
+                unreferenced.append((key, entry))
+
+        removed = freed = 0
+        for key, entry in sorted(unreferenced, key=lambda e: e[1].get("last_access", 0)):
+            if total <= max_size:
+                break
+            with self.locked(key):
+                current = self._load_entry(key)
+                if current and current["refs"]:
+                    continue
+                os.remove(self.object_path(key))
+                for path in (self._entry_path(key), self._lock_path(key)):
+                    if osp.isfile(path):
+                        os.remove(path)
+            total -= entry["size"]
+            freed += entry["size"]
+            removed += 1
+
+        partial_dir = osp.join(self.store_dir, "partial")
+        if osp.isdir(partial_dir):
+            now = time.time()
+            for name in os.listdir(partial_dir):
+                path = osp.join(partial_dir, name)
+                if now - osp.getmtime(path) > PARTIAL_MAX_AGE:
+                    os.remove(path)
+
+        if removed:
+            logger.info("Removed %d unreferenced objects (%.1f MB) from payload store %s" %
+                        (removed, freed / 1e6, self.store_dir))
+        if total > max_size:
+            logger.warning("Payload store %s holds %.1f MB of referenced objects, more than its maximum size of "
+                           "%.1f MB" % (self.store_dir, total / 1e6, max_size / 1e6))
+        return {"objects": len(entries) - removed, "removed": removed, "bytes_freed": freed, "size": total}
@@ -0,0 +1,160 @@
+import os
+import os.path as osp
+import json
+import logging
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from encode2bag import encode2bag_api as e2b
+from encode2bag import materialize as mat
+from encode2bag.bag_utils import read_payload_manifests, read_fetch_file, read_bag_info, write_bag_info, \
+    compute_file_checksums, update_tag_manifests
+
+logger = logging.getLogger(__name__)
+
+
+def diff_remote_entries(old_fetch, old_md5, new_entries):
+    added, removed, changed = list(), list(), list()
+    for path, entry in new_entries.items():
+        if path not in old_fetch:
+            added.append(path)
+        elif (old_fetch[path][0] != entry["url"] or old_fetch[path][1] != str(entry["length"]) or
+              old_md5.get(path) != entry.get("md5")):
+            changed.append(path)
+    for path in old_fetch:
+        if path not in new_entries:
+            removed.append(path)
+    return added, removed, changed
+
+
+def update_bag_manifests(bag_path, algs, manifests, metadata_payload_path, metadata_checksums, new_entries,
+                         added, changed, ro_manifest=None, ro_manifest_path=None):
+    # Remote entries are written sorted by path, matching the layout bdbag uses when creating a bag.
+    remote_paths = sorted(new_entries.keys())
+    for alg in algs:
+        entries = OrderedDict([(metadata_payload_path, metadata_checksums[alg])])
+        for path in remote_paths:
+            entry = new_entries[path]
+            if alg in entry:
+                entries[path] = entry[alg]
+            elif path not in added and path not in changed and path in manifests[alg]:
+                entries[path] = manifests[alg][path]
+        with open(osp.join(bag_path, "manifest-%s.txt" % alg), "w") as manifest:
+            for path, checksum in entries.items():
+                manifest.write("%s  %s\n" % (checksum, path))
+
+    with open(osp.join(bag_path, "fetch.txt"), "w") as fetch:
+        for path in remote_paths:
+            entry = new_entries[path]
+            fetch.write("%s\t%s\t%s\n" % (entry["url"], entry["length"], path))
+
+    info = read_bag_info(bag_path)
+    total_bytes = os.path.getsize(osp.join(bag_path, metadata_payload_path)) + \
+        sum(int(entry["length"]) for entry in new_entries.values())
+    info["Bagging-Date"] = time.strftime("%Y-%m-%d")
+    info["Bagging-Time"] = time.strftime("%H:%M:%S %Z")
+    info["Payload-Oxum"] = "%d.%d" % (total_bytes, len(new_entries) + 1)
+    if ro_manifest:
+        info["BagIt-Profile-Identifier"] = e2b.BDBAG_RO_PROFILE_ID
+    write_bag_info(bag_path, info)
+
+    changed_tag_files = ["bag-info.txt", "fetch.txt"] + ["manifest-%s.txt" % alg for alg in algs]
+    if ro_manifest:
+        if not osp.isdir(osp.dirname(ro_manifest_path)):
+            os.mkdir(osp.dirname(ro_manifest_path))
+        ro_manifest.write(ro_manifest_path)
+        changed_tag_files.append("metadata/manifest.json")
+    update_tag_manifests(bag_path, algs, changed_tag_files)
+
+
+def update_bag_from_metadata_file(bag_path,
+                                  metadata_file_path,
+                                  creator_name=None,
+                                  creator_orcid=None,
+                                  create_ro_manifest=False,
+                                  downloader=None,
+                                  materialize=False,
+                                  materialize_workers=mat.DEFAULT_MATERIALIZE_WORKERS,
+                                  max_bandwidth=None,
+                                  row_filter=None,
+                                  payload_store=None):
+    bag_path = osp.abspath(bag_path)
+    if not osp.isfile(osp.join(bag_path, "bagit.txt")):
+        raise RuntimeError("The directory %s is not a bag and cannot be updated." % bag_path)
+    logger.info("Updating bag %s from metadata file %s" % (bag_path, metadata_file_path))
+
+    manifests = read_payload_manifests(bag_path)
+    algs = list(manifests.keys())
+    old_fetch = read_fetch_file(bag_path)
+    old_md5 = manifests.get("md5", dict())
+    ro_manifest_path = osp.join(bag_path, "metadata", "manifest.json")
+    ro_manifest_added = create_ro_manifest and not osp.isfile(ro_manifest_path)
+    create_ro_manifest = create_ro_manifest or osp.isfile(ro_manifest_path)
+
+    temp_path = tempfile.mkdtemp(prefix="encode2bag_")
+    try:
+        if row_filter is not None:
+            metadata_file_path = e2b.filter_metadata_file(metadata_file_path, temp_path, row_filter)
+        ro_manifest = None
+        if create_ro_manifest:
+            from encode2bag.ro_manifest import ROManifestBuilder
+            ro_manifest = ROManifestBuilder(e2b.init_ro_manifest(creator_name=creator_name,
+                                                                 creator_orcid=creator_orcid))
+        remote_file_manifest = osp.join(temp_path, "remote-file-manifest.json")
+        e2b.convert_tsv_metadata_to_remote_file_manifest(metadata_file_path, remote_file_manifest, ro_manifest)
+        with open(remote_file_manifest, "r") as rfm:
+            new_entries = OrderedDict((''.join(["data/", entry["filename"]]), entry) for entry in json.load(rfm))
+
+        added, removed, changed = diff_remote_entries(old_fetch, old_md5, new_entries)
+        logger.info("Bag update: %d added, %d removed, %d changed, %d unchanged remote files." %
+                    (len(added), len(removed), len(changed), len(new_entries) - len(added) - len(changed)))
+
+        # Remove payload files that are no longer referenced or whose content changed.
+        for path in removed + changed:
+            local_path = osp.join(bag_path, path)
+            if osp.isfile(local_path):
+                os.remove(local_path)
+
+        # Replace the bundled metadata file, rehashing only that file.
+        metadata_payload_path = ''.join(["data/", osp.basename(metadata_file_path)])
+        local_paths = [path for path in manifests.get(algs[0], dict()) if path not in old_fetch]
+        for path in local_paths:
+            if path != metadata_payload_path and osp.isfile(osp.join(bag_path, path)):
+                os.remove(osp.join(bag_path, path))
+        shutil.copy(osp.abspath(metadata_file_path), osp.join(bag_path, "data"))
+        metadata_checksums = compute_file_checksums(osp.join(bag_path, metadata_payload_path), algs)
+        metadata_changed = any(manifests[alg].get(metadata_payload_path) != metadata_checksums[alg] for alg in algs)
+
+        if added or removed or changed or metadata_changed or ro_manifest_added:
+            update_bag_manifests(bag_path, algs, manifests, metadata_payload_path, metadata_checksums,
+                                 new_entries, added, changed, ro_manifest, ro_manifest_path)
+        else:
+            logger.info("Bag %s is already up to date." % bag_path)
+
+        # Only new, changed or missing files are transferred; files already present are not rehashed.
+        missing = [path for path in new_entries if not osp.isfile(osp.join(bag_path, path))]
+        if materialize and missing:
+            delta_manifest = osp.join(temp_path, "remote-file-manifest-delta.json")
+            with open(delta_manifest, "w") as rfm:
+                e2b.write_json_array((new_entries[path] for path in missing), rfm)
+            mat.materialize_bag_payload(bag_path,
+                                        delta_manifest,
+                                        workers=materialize_workers,
+                                        max_bandwidth=max_bandwidth,
+                                        downloader=downloader,
+                                        payload_store=payload_store)
+
+        return {"added": len(added), "removed": len(removed), "changed": len(changed),
+                "unchanged": len(new_entries) - len(added) - len(changed)}
+    finally:
+        shutil.rmtree(temp_path)
+
+
+def update_bag_from_url(url, bag_path, downloader=None, use_cache=True, **kwargs):
+    temp_path = tempfile.mkdtemp(prefix="encode2bag_")
+    try:
+        metadata_file_path = e2b.retrieve_encode_metadata_file_by_url(url, temp_path, downloader, use_cache)
+        return update_bag_from_metadata_file(bag_path, metadata_file_path, downloader=downloader, **kwargs)
+    finally:
+        shutil.rmtree(temp_path)
@@ -0,0 +1,123 @@
+import sys
+import copy
+import json
+import logging
+from collections import OrderedDict
+from bdbag import bdbag_ro as ro
+import encode2bag.ontology_mappings as om
+
+if sys.version_info > (3,):
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
+logger = logging.getLogger(__name__)
+
+INDENT = 4
+
+
+def _write_json(output_file, value, level):
+    # Streams value to output_file formatted exactly as json.dumps(value, sort_keys=True, indent=INDENT) would at the
+    # given nesting level. Dicts and lists are written element by element; list elements that do not themselves
+    # contain lists are encoded with a single json.dumps call.
+    padding = " " * (INDENT * (level + 1))
+    if isinstance(value, dict):
+        if not value:
+            output_file.write("{}")
+            return
+        output_file.write("{")
+        for i, key in enumerate(sorted(value.keys())):
+            output_file.write(",\n" if i else "\n")
+            output_file.write(padding)
+            output_file.write(json.dumps(key))
+            output_file.write(": ")
+            _write_json(output_file, value[key], level + 1)
+        output_file.write("\n%s}" % (" " * (INDENT * level)))
+    elif isinstance(value, (list, tuple)):
+        count = 0
+        for element in value:
+            output_file.write(",\n" if count else "[\n")
+            output_file.write(padding)
+            if isinstance(element, dict) and any(isinstance(v, (list, tuple)) for v in element.values()):
+                _write_json(output_file, element, level + 1)
+            else:
+                output_file.write(json.dumps(element, sort_keys=True, indent=INDENT, separators=(',', ': '))
+                                  .replace("\n", "\n" + padding))
+            count += 1
+        output_file.write("\n%s]" % (" " * (INDENT * level)) if count else "[]")
+    else:
+        output_file.write(json.dumps(value))
+
+
+class ROManifestBuilder(object):
+    """
+    Incremental builder for the bag's Research Object manifest. Aggregates are indexed by URI so that repeated files
+    are detected in constant time, the mediatype and conformsTo values are computed once per ENCODE file format, and
+    the manifest is streamed to disk by write() rather than serialized from one large nested dict.
+    """
+    def __init__(self, manifest=None):
+        self.manifest = manifest if manifest is not None else copy.deepcopy(ro.DEFAULT_RO_MANIFEST)
+        self.aggregates = OrderedDict((a["uri"], a) for a in self.manifest.get("aggregates", list()))
+        self.annotations = list(self.manifest.get("annotations", list()))
+        self.file_uris = list()
+        self._format_properties = dict()
+
+    def get_format_properties(self, file_format):
+        properties = self._format_properties.get(file_format)
+        if properties is None:
+            properties = self._format_properties[file_format] = \
+                (''.join(["application/x-", file_format]), om.FILETYPE_ONTOLOGY_MAP.get(file_format, None))
+        return properties
+
+    def add_aggregate(self, uri, mediatype=None, conforms_to=None):
+        if uri in self.aggregates:
+            return self.aggregates[uri]
+        aggregate = {"uri": uri}
+        if mediatype:
+            aggregate["mediatype"] = mediatype
+        if conforms_to:
+            aggregate["conformsTo"] = conforms_to
+        self.aggregates[uri] = aggregate
+        return aggregate
+
+    def add_file(self, filename, file_format):
+        uri = ''.join(["../data/", filename])
+        if uri in self.aggregates:
+            return uri
+        mediatype, conforms_to = self.get_format_properties(file_format)
+        self.add_aggregate(uri, mediatype=mediatype, conforms_to=conforms_to)
+        self.file_uris.append(uri)
+        return uri
+
+    def add_annotation(self, about, content=None):
+        annotation = {"about": about}
+        if content:
+            annotation["content"] = content
+        self.annotations.append(annotation)
+        return annotation
+
+    def add_files_annotation(self, content):
+        if self.file_uris:
+            self.add_annotation(self.file_uris, content=content)
+
+    def to_dict(self):
+        manifest = dict(self.manifest)
+        manifest["aggregates"] = list(self.aggregates.values())
+        manifest["annotations"] = self.annotations
+        return manifest
+
+    def update_manifest(self):
+        # Copies the indexed aggregates and annotations back into the wrapped manifest dict.
+        self.manifest["aggregates"] = list(self.aggregates.values())
+        self.manifest["annotations"] = self.annotations
+        return self.manifest
+
+    def dumps(self):
+        output = StringIO()
+        _write_json(output, self.to_dict(), 0)
+        return output.getvalue()
+
+    def write(self, output_path):
+        with open(output_path, "w") as output_file:
+            _write_json(output_file, self.to_dict(), 0)
+        logger.info("Wrote RO manifest with %d aggregates to %s" % (len(self.aggregates), output_path))
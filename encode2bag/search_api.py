@@ -0,0 +1,221 @@
+import sys
+import csv
+import logging
+import os.path as osp
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from encode2bag import http_client as http
+from encode2bag import instrumentation as inst
+
+if sys.version_info > (3,):
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+else:
+    from urlparse import urlsplit, urlunsplit, parse_qsl
+    from urllib import urlencode
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_PAGE_WORKERS = 4
+SEARCH_PATH = "/search/"
+FILE_TYPE = "File"
+FILES_PROPERTY = "files"
+PAGING_PARAMETERS = {"format", "limit", "from", "field"}
+ANY_VALUE = "*"
+
+# The ENCODE metadata TSV columns that can be produced from File objects, in the column order of the batch download
+# metadata file, with the (possibly dotted) File property each one is read from. Only these properties are requested
+# from the search endpoint. This is a reduced schema: the batch download metadata file has further columns (e.g. the
+# experiment target, biosample details and audits) that are not properties of File objects.
+FILE_COLUMNS = [
+    ("File accession", "accession"),
+    ("File format", "file_type"),
+    ("Output type", "output_type"),
+    ("Experiment accession", "dataset"),
+    ("Assay", "assay_term_name"),
+    ("Biosample term id", "biosample_ontology.term_id"),
+    ("Biosample term name", "biosample_ontology.term_name"),
+    ("Biosample type", "biosample_ontology.classification"),
+    ("Biological replicate(s)", "biological_replicates"),
+    ("Technical replicate", "technical_replicates"),
+    ("Read length", "read_length"),
+    ("Run type", "run_type"),
+    ("Paired end", "paired_end"),
+    ("Paired with", "paired_with"),
+    ("Size", "file_size"),
+    ("Lab", "lab.title"),
+    ("md5sum", "md5sum"),
+    ("File download URL", "href"),
+    ("Assembly", "assembly"),
+    ("Platform", "platform.title")]
+
+
+def get_search_url(url):
+    # Report and matrix views of a query select the same objects as its search view.
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, SEARCH_PATH, parts.query, ""))
+
+
+def get_search_type(url):
+    return dict(parse_qsl(urlsplit(url).query)).get("type")
+
+
+def get_file_filters(query, search_type):
+    """
+    Returns the "files.<property>=<value>" terms of the query of a search for another object type than File, as an
+    ordered mapping of (File property, negated) to the set of values. Such a search selects the results that have a
+    matching file, but embeds every file of each result, so these terms have to be applied to the embedded files as
+    well. Terms with the same key match any of their values, "!=" terms match none of them and "*" matches any value.
+    """
+    file_filters = OrderedDict()
+    if search_type == FILE_TYPE:
+        return file_filters
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        negated = key.endswith("!")
+        name, _, prop = key.rstrip("!").partition(".")
+        if name == FILES_PROPERTY and prop:
+            file_filters.setdefault((prop, negated), set()).add(value)
+    return file_filters
+
+
+def file_matches(file_object, file_filters):
+    for (prop, negated), values in file_filters.items():
+        value = get_property(file_object, prop)
+        found = set(format_value(v) for v in (value if isinstance(value, list) else [value]) if v is not None)
+        matched = bool(found & values or (ANY_VALUE in values and found))
+        if matched == negated:
+            return False
+    return True
+
+
+def get_fields(search_type, file_filters=None):
+    # Searches for other object types (e.g. Experiment) list the files of each result in its "files" property, so
+    # the projection is applied to the embedded File objects. The properties the files are filtered on are requested
+    # as well.
+    prefix = "" if search_type == FILE_TYPE else FILES_PROPERTY + "."
+    props = [prop for _, prop in FILE_COLUMNS]
+    props.extend(prop for prop, _ in file_filters or dict() if prop not in props)
+    return [''.join([prefix, prop]) for prop in props]
+
+
+def get_page_url(search_url, start, limit, fields):
+    # The query of the search is kept as given, without any paging or projection parameters it may have.
+    parts = urlsplit(search_url)
+    query = [p for p in parts.query.split("&") if p and p.partition("=")[0] not in PAGING_PARAMETERS]
+    paging = [("format", "json"), ("limit", str(limit)), ("from", str(start))] + [("field", f) for f in fields]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, "&".join(query + [urlencode(paging)]), ""))
+
+
+def get_property(obj, path):
+    for name in path.split("."):
+        if not isinstance(obj, dict):
+            # Linked objects that are not embedded are represented by their path.
+            return obj
+        obj = obj.get(name)
+    return obj
+
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        return ", ".join(format_value(v) for v in value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return value
+
+
+def get_accession(path):
+    # "/experiments/ENCSR000AAA/" -> "ENCSR000AAA"
+    return path.rstrip("/").rpartition("/")[2] if path else ""
+
+
+def make_metadata_row(file_object, base_url):
+    row = list()
+    for column, prop in FILE_COLUMNS:
+        value = get_property(file_object, prop)
+        if prop == "dataset":
+            value = get_accession(value)
+        elif prop == "href" and value:
+            value = ''.join([base_url, value])
+        row.append(format_value(value))
+    return row
+
+
+def iter_file_objects(page, search_type, file_filters=None):
+    for item in page.get("@graph", list()):
+        if search_type == FILE_TYPE:
+            yield item
+            continue
+        for file_object in item.get(FILES_PROPERTY) or list():
+            if isinstance(file_object, dict) and (not file_filters or file_matches(file_object, file_filters)):
+                yield file_object
+
+
+def fetch_page(downloader, page_url):
+    r = downloader.get(page_url, headers={"Accept": "application/json"}, stream=False)
+    try:
+        if r.status_code != 200:
+            raise http.HTTPTransferError("ENCODE search request %s failed with HTTP status %s" %
+                                         (page_url, r.status_code), r.status_code)
+        return r.json(), len(r.content)
+    finally:
+        r.close()
+
+
+def iter_search_pages(search_url, downloader, fields, page_size=DEFAULT_PAGE_SIZE, workers=DEFAULT_PAGE_WORKERS):
+    """
+    Yields (page, size in bytes) for each page of the JSON results of an ENCODE search, in result order. The first page
+    gives the total number of results; the remaining pages are fetched concurrently over the downloader's pooled
+    session, at most `workers` pages ahead of the consumer.
+    """
+    page, size = fetch_page(downloader, get_page_url(search_url, 0, page_size, fields))
+    total = int(page.get("total", 0))
+    logger.info("ENCODE search %s matched %d results, fetching %d pages of up to %d results." %
+                (search_url, total, max(1, (total + page_size - 1) // page_size), page_size))
+    yield page, size
+
+    starts = list(range(page_size, total, page_size))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in starts:
+            pending.append(pool.submit(fetch_page, downloader, get_page_url(search_url, start, page_size, fields)))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def retrieve_encode_metadata_file_by_search(url,
+                                            output_path,
+                                            downloader=None,
+                                            page_size=DEFAULT_PAGE_SIZE,
+                                            workers=DEFAULT_PAGE_WORKERS,
+                                            output_name="metadata.tsv"):
+    # Alternative to retrieving the batch download metadata file: the File objects matched by the search are fetched
+    # from the paged JSON search endpoint, requesting only the properties of FILE_COLUMNS, and streamed page by page
+    # into an ENCODE format metadata file with only those columns. The remote file manifest converted from it is the
+    # same as the one of the batch download metadata file.
+    if downloader is None:
+        downloader = http.get_default_downloader()
+    search_url = get_search_url(url)
+    search_type = get_search_type(search_url)
+    parts = urlsplit(search_url)
+    file_filters = get_file_filters(parts.query, search_type)
+    base_url = urlunsplit((parts.scheme, parts.netloc, "", "", ""))
+    metadata_file = osp.abspath(osp.join(output_path, output_name))
+    with inst.stage("metadata_fetch") as stage, open(metadata_file, "w") as metadata:
+        writer = csv.writer(metadata, delimiter="\t", lineterminator="\n")
+        writer.writerow([column for column, _ in FILE_COLUMNS])
+        rows = 0
+        fields = get_fields(search_type, file_filters)
+        for page, size in iter_search_pages(search_url, downloader, fields, page_size, workers):
+            stage.bytes += size
+            for file_object in iter_file_objects(page, search_type, file_filters):
+                writer.writerow(make_metadata_row(file_object, base_url))
+                rows += 1
+        stage.rows = rows
+    logger.info("Wrote %d files of ENCODE search %s to metadata file %s" % (rows, search_url, metadata_file))
+    return metadata_file
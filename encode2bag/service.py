@@ -0,0 +1,428 @@
+import argparse
+import importlib
+import os
+import os.path as osp
+import sys
+import json
+import logging
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from encode2bag import encode2bag_api as e2b
+from encode2bag import http_client as http
+from encode2bag import cache
+from encode2bag import batch
+from encode2bag import filters
+from encode2bag import payload_store as store
+from encode2bag import get_named_exception as gne
+
+if sys.version_info > (3,):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, TCPServer
+    from urllib.parse import urlsplit, parse_qsl
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, TCPServer
+    from urlparse import urlsplit, parse_qsl
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8642
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_QUEUED_JOBS = 100
+DEFAULT_MAX_FINISHED_JOBS = 1000
+MAX_REQUEST_SIZE = 64 * 1024
+MAX_WAIT = 300
+JOBS_PATH = "/jobs"
+HEALTH_PATH = "/health"
+ARCHIVE_FORMATS = ["zip", "tar", "tgz", "tzst"]
+STRING_TYPES = (str, type(u""))
+# Modules imported by the pipeline stages, which the CLI imports lazily (see benchmarks/bench_import.py) but the
+# service loads up front.
+WARM_MODULES = ["bdbag.bdbag_api", "bdbag.bdbag_ro", "encode2bag.ro_manifest", "encode2bag.archive_stream"]
+
+# Build options a job may set, with their accepted types. The output path is set by the service, so that jobs can only
+# create bags in the service's output directory.
+JOB_OPTIONS = {"output_name": STRING_TYPES,
+               "archive_format": STRING_TYPES,
+               "creator_name": STRING_TYPES,
+               "creator_orcid": STRING_TYPES,
+               "create_ro_manifest": bool,
+               "materialize": bool,
+               "materialize_workers": int,
+               "max_bandwidth": int,
+               "compression_level": int,
+               "compression_workers": int,
+               "decompress_metadata": bool,
+               "resume": bool,
+               "use_search_api": bool,
+               "include": list,
+               "exclude": list,
+               "min_file_size": int,
+               "max_file_size": int}
+ROW_FILTER_OPTIONS = ["include", "exclude", "min_file_size", "max_file_size"]
+URL_ONLY_OPTIONS = ["use_search_api"]
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class ServiceError(RuntimeError):
+    def __init__(self, message, status_code=400):
+        super(ServiceError, self).__init__(message)
+        self.status_code = status_code
+
+
+class BuildJob(object):
+
+    def __init__(self, job_id, source, options, key):
+        self.id = job_id
+        self.source = source
+        self.options = options
+        self.key = key
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.stages = list()
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {"id": self.id,
+                "source": self.source,
+                "options": self.options,
+                "status": self.status,
+                "submitted": self.submitted,
+                "started": self.started,
+                "finished": self.finished,
+                "result": self.result,
+                "error": self.error,
+                "stages": self.stages}
+
+
+class BagBuildService(object):
+    """
+    Runs create_bag_from_url and create_bag_from_metadata_file jobs on a bounded pool of worker threads, within one
+    long-running process whose pooled HTTP session, metadata cache, payload store and imported modules stay warm
+    between jobs. A job identical to one that is still queued or running is not queued again; the submitter receives
+    the in-flight job instead. Finished jobs are kept, up to max_finished_jobs, for status queries.
+    """
+    def __init__(self,
+                 output_path,
+                 workers=DEFAULT_WORKERS,
+                 max_queued_jobs=DEFAULT_MAX_QUEUED_JOBS,
+                 max_finished_jobs=DEFAULT_MAX_FINISHED_JOBS,
+                 payload_store=None,
+                 downloader=None):
+        self.output_path = osp.abspath(output_path)
+        self.workers = workers
+        self.max_queued_jobs = max_queued_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self.payload_store = payload_store
+        self.downloader = downloader
+        self.jobs = OrderedDict()
+        self.in_flight = dict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        if not osp.isdir(self.output_path):
+            os.makedirs(self.output_path)
+
+    def warm_up(self):
+        # Loads the modules and opens the HTTP session that the first job would otherwise wait for.
+        for module in WARM_MODULES:
+            importlib.import_module(module)
+        return (self.downloader or http.get_default_downloader()).session
+
+    @staticmethod
+    def parse_request(request):
+        # Validates a job request, e.g. {"url": "<search url>", "archive_format": "zip"}, and returns the job source
+        # and options.
+        if not isinstance(request, dict):
+            raise ServiceError("A job request must be a JSON object.")
+        request = dict(request)
+        sources = [request.pop(name) for name in ("url", "metadata_file") if name in request]
+        if len(sources) != 1 or not isinstance(sources[0], STRING_TYPES) or not sources[0]:
+            raise ServiceError("A job request must specify exactly one of \"url\" or \"metadata_file\".")
+        source = sources[0]
+        if not batch.is_url(source):
+            source = osp.abspath(source)
+            if not osp.isfile(source):
+                raise ServiceError("Metadata file %s not found." % source)
+        for name, value in request.items():
+            if name not in JOB_OPTIONS:
+                raise ServiceError("Unknown job option \"%s\", expected one of %s." % (name, sorted(JOB_OPTIONS)))
+            if not isinstance(value, JOB_OPTIONS[name]) or (isinstance(value, bool) and JOB_OPTIONS[name] is int) \
+                    or (isinstance(value, list) and not all(isinstance(v, STRING_TYPES) for v in value)):
+                raise ServiceError("Invalid value %s for job option \"%s\"." % (json.dumps(value), name))
+            if name in URL_ONLY_OPTIONS and not batch.is_url(source):
+                raise ServiceError("The job option \"%s\" only applies to url jobs." % name)
+        output_name = request.get("output_name")
+        if output_name is not None and (osp.basename(output_name) != output_name or output_name in ("", ".", "..")):
+            raise ServiceError("Invalid output name \"%s\"." % output_name)
+        if request.get("archive_format") not in [None] + ARCHIVE_FORMATS:
+            raise ServiceError("Unsupported archive format \"%s\", expected one of %s." %
+                               (request["archive_format"], ARCHIVE_FORMATS))
+        return source, request
+
+    @staticmethod
+    def get_build_kwargs(options):
+        kwargs = dict((name, value) for name, value in options.items()
+                      if name not in ROW_FILTER_OPTIONS and name != "output_name")
+        if any(name in options for name in ROW_FILTER_OPTIONS):
+            try:
+                kwargs["row_filter"] = filters.RowFilter(include=options.get("include"),
+                                                         exclude=options.get("exclude"),
+                                                         min_size=options.get("min_file_size"),
+                                                         max_size=options.get("max_file_size"))
+            except RuntimeError as e:
+                raise ServiceError(str(e))
+        return kwargs
+
+    def submit(self, request):
+        """
+        Queues a job request and returns (job, created). created is False when the request is identical to a job that
+        is still queued or running, which is returned instead.
+        """
+        source, options = self.parse_request(request)
+        key = json.dumps({"source": source, "options": options}, sort_keys=True)
+        kwargs = self.get_build_kwargs(options)
+        with self._lock:
+            job = self.in_flight.get(key)
+            if job is not None:
+                logger.info("Job request for %s is identical to in-flight job %s." % (source, job.id))
+                return job, False
+            job_id = uuid.uuid4().hex[:16]
+            output_name = options.get("output_name") or ''.join(["encode_bag_", job_id])
+            for other in self.in_flight.values():
+                if (other.options.get("output_name") or ''.join(["encode_bag_", other.id])) == output_name:
+                    raise ServiceError("The in-flight job %s is already building %s." % (other.id, output_name), 409)
+            if sum(1 for j in self.in_flight.values() if j.status == QUEUED) >= self.max_queued_jobs:
+                raise ServiceError("The job queue is full, try again later.", 503)
+            job = BuildJob(job_id, source, options, key)
+            self.jobs[job.id] = job
+            self.in_flight[key] = job
+        logger.info("Queued job %s for %s." % (job.id, source))
+        self._pool.submit(self.run_job, job, output_name, kwargs)
+        return job, True
+
+    def run_job(self, job, output_name, kwargs):
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            if self.downloader is not None:
+                kwargs["downloader"] = self.downloader
+            result = batch.create_bag_from_batch_item({"source": job.source, "output_name": output_name},
+                                                      self.output_path, payload_store=self.payload_store, **kwargs)
+            job.stages = result.get("stages", list())
+            if result["status"] == "success":
+                job.result = result["bag_path"]
+            else:
+                job.error = result["error"]
+        except Exception as e:
+            job.error = gne(e)
+        job.finished = time.time()
+        job.status = FAILED if job.error else SUCCEEDED
+        logger.info("Job %s %s in %.3f seconds." % (job.id, job.status, job.finished - job.started))
+        with self._lock:
+            self.in_flight.pop(job.key, None)
+            finished = [j for j in self.jobs.values() if j.done.is_set()]
+            for old in finished[:max(0, len(finished) + 1 - self.max_finished_jobs)]:
+                del self.jobs[old.id]
+        job.done.set()
+
+    def get_job(self, job_id, wait=None):
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise ServiceError("Job %s not found." % job_id, 404)
+        if wait:
+            job.done.wait(min(wait, MAX_WAIT))
+        return job
+
+    def list_jobs(self):
+        with self._lock:
+            return list(self.jobs.values())
+
+    def health(self):
+        with self._lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {"status": "ok",
+                "workers": self.workers,
+                "queued": statuses.count(QUEUED),
+                "running": statuses.count(RUNNING)}
+
+    def close(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+class BagBuildRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of the service:
+
+        POST /jobs                  queue a job, e.g. {"url": "<search url>", "archive_format": "zip"}
+        GET  /jobs                  list jobs
+        GET  /jobs/<id>[?wait=<s>]  job status and result path, optionally waiting up to s seconds for the job to end
+        GET  /health                service status
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("BagBuildService: " + format % args)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address[0] if self.client_address else "unix"
+
+    def do_GET(self):
+        service = self.server.service
+        parts = urlsplit(self.path)
+        try:
+            if parts.path == HEALTH_PATH:
+                return self.send_json(service.health())
+            if parts.path.rstrip("/") == JOBS_PATH:
+                return self.send_json({"jobs": [job.to_dict() for job in service.list_jobs()]})
+            if parts.path.startswith(JOBS_PATH + "/"):
+                wait = dict(parse_qsl(parts.query)).get("wait")
+                job = service.get_job(parts.path[len(JOBS_PATH) + 1:].strip("/"), float(wait) if wait else None)
+                return self.send_json(job.to_dict())
+            raise ServiceError("Not found.", 404)
+        except (ServiceError, ValueError) as e:
+            self.send_error_json(e)
+
+    def do_POST(self):
+        service = self.server.service
+        try:
+            if urlsplit(self.path).path.rstrip("/") != JOBS_PATH:
+                raise ServiceError("Not found.", 404)
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_REQUEST_SIZE:
+                raise ServiceError("Job request too large.", 413)
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            job, created = service.submit(request)
+            response = job.to_dict()
+            response["deduplicated"] = not created
+            self.send_json(response, status=202 if created else 200)
+        except (ServiceError, ValueError) as e:
+            self.send_error_json(e)
+
+    def send_error_json(self, e):
+        self.send_json({"error": str(e)}, status=getattr(e, "status_code", 400))
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value, sort_keys=True).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BagBuildHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, service, address):
+        self.service = service
+        HTTPServer.__init__(self, address, BagBuildRequestHandler)
+
+
+class BagBuildUnixServer(BagBuildHTTPServer):
+    # Serves the same API on a Unix domain socket, whose file permissions control access to the service.
+    address_family = getattr(socket, "AF_UNIX", None)
+
+    def server_bind(self):
+        if osp.exists(self.server_address):
+            os.remove(self.server_address)
+        TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def server_close(self):
+        BagBuildHTTPServer.server_close(self)
+        if osp.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def create_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    if socket_path:
+        if BagBuildUnixServer.address_family is None:
+            raise RuntimeError("Unix domain sockets are not supported on this platform.")
+        return BagBuildUnixServer(service, osp.abspath(socket_path))
+    return BagBuildHTTPServer(service, (host, port))
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(
+        description="Service building ENCODE bags for jobs submitted over HTTP or a Unix domain socket, keeping HTTP "
+                    "sessions and caches warm between jobs.")
+    parser.add_argument(
+        '--output-path', metavar="<path>", required=True,
+        help="Base directory in which the bags of all jobs are created.")
+    parser.add_argument(
+        '--host', metavar="<address>", default=DEFAULT_HOST,
+        help="Address to listen on. Default is %(default)s.")
+    parser.add_argument(
+        '--port', metavar="<port>", type=int, default=DEFAULT_PORT,
+        help="Port to listen on. Default is %(default)s.")
+    parser.add_argument(
+        '--socket', metavar="<path>",
+        help="Listen on a Unix domain socket at the given path instead of a TCP port.")
+    parser.add_argument(
+        '--workers', metavar="<count>", type=int, default=DEFAULT_WORKERS,
+        help="Number of jobs built concurrently. Default is %(default)s.")
+    parser.add_argument(
+        '--max-queued-jobs', metavar="<count>", type=int, default=DEFAULT_MAX_QUEUED_JOBS,
+        help="Number of queued jobs above which new jobs are rejected. Default is %(default)s.")
+    parser.add_argument(
+        '--max-finished-jobs', metavar="<count>", type=int, default=DEFAULT_MAX_FINISHED_JOBS,
+        help="Number of finished jobs whose status is kept. Default is %(default)s.")
+    parser.add_argument(
+        '--payload-store', metavar="<path>", nargs="?", const=store.DEFAULT_STORE_DIR,
+        help="Share the materialized payload files of all jobs through a content-addressed store. Default directory "
+             "is %(const)s.")
+    parser.add_argument(
+        '--no-cache', action="store_true",
+        help="Bypass the cache and always retrieve ENCODE manifests and metadata files from the server.")
+    parser.add_argument(
+        '--cache-dir', metavar="<path>", default=cache.DEFAULT_CACHE_DIR,
+        help="Directory of the metadata cache. Default is %(default)s.")
+    parser.add_argument(
+        '--quiet', action="store_true", help="Suppress logging output.")
+    parser.add_argument(
+        '--debug', action="store_true", help="Enable debug logging output.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cli()
+    e2b.configure_logging(level=logging.ERROR if args.quiet else (logging.DEBUG if args.debug else logging.INFO))
+    cache.configure_default_cache(enabled=not args.no_cache, cache_dir=args.cache_dir)
+    service = BagBuildService(args.output_path,
+                              workers=args.workers,
+                              max_queued_jobs=args.max_queued_jobs,
+                              max_finished_jobs=args.max_finished_jobs,
+                              payload_store=store.PayloadStore(args.payload_store) if args.payload_store else None)
+    service.warm_up()
+    server = create_server(service, args.host, args.port, args.socket)
+    logger.info("encode2bag service listening on %s, building bags in %s" %
+                (args.socket or "http://%s:%d" % (args.host, server.server_address[1]), service.output_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close(wait=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+import os
+import os.path as osp
+import json
+import logging
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from bdbag import bdbag_api as bdb
+from encode2bag import encode2bag_api as e2b
+from encode2bag import batch
+from encode2bag import instrumentation as inst
+from encode2bag import compression
+from encode2bag import journal as jnl
+from encode2bag.filters import iter_metadata_records, parse_metadata_line
+
+logger = logging.getLogger(__name__)
+
+SHARD_INDEX_FILE = "shard-index.json"
+MAX_OPEN_SHARD_FILES = 128
+
+
+class Shard(object):
+
+    def __init__(self, index, name, metadata_file_path):
+        self.index = index
+        self.name = name
+        self.metadata_file_path = metadata_file_path
+        self.files = 0
+        self.bytes = 0
+        self.groups = list()
+        self._group_set = set()
+
+    def add_group(self, group):
+        if group not in self._group_set:
+            self._group_set.add(group)
+            self.groups.append(group)
+
+    def to_dict(self):
+        shard = OrderedDict([("index", self.index), ("name", self.name), ("files", self.files), ("bytes", self.bytes)])
+        if self.groups:
+            shard["groups"] = self.groups
+        return shard
+
+    @classmethod
+    def from_dict(cls, shard, metadata_file_path):
+        result = cls(shard["index"], shard["name"], metadata_file_path)
+        result.files = shard["files"]
+        result.bytes = shard["bytes"]
+        for group in shard.get("groups", list()):
+            result.add_group(group)
+        return result
+
+
+def parse_size(value, line_number):
+    try:
+        return int(value or 0)
+    except ValueError:
+        raise RuntimeError("Metadata row at line %d has an invalid %s value: %s" %
+                           (line_number, e2b.ENCODE_FILE_SIZE, value))
+
+
+def assign_groups(metadata_file_path, group_column, max_files=None, max_bytes=None):
+    # First pass over the metadata: totals per group, in order of first appearance, packed into shards so that no
+    # shard exceeds the limits unless a single group does. Without limits every group gets its own shard.
+    groups = OrderedDict()
+    with compression.open_text(metadata_file_path) as metadata:
+        header = parse_metadata_line(metadata.readline().rstrip("\r\n"))
+        if group_column not in header:
+            raise RuntimeError("The shard grouping column %s was not found in the column header %s" %
+                               (group_column, str(header)))
+        group_index = header.index(group_column)
+        size_index = header.index(e2b.ENCODE_FILE_SIZE)
+        field_count = max(group_index, size_index) + 1
+        for line_number, fields, _ in iter_metadata_records(metadata, field_count, len(header)):
+            totals = groups.setdefault(fields[group_index], [0, 0])
+            totals[0] += 1
+            totals[1] += parse_size(fields[size_index], line_number)
+
+    assignments = dict()
+    shard, files, size = -1, 0, 0
+    for group, (group_files, group_bytes) in groups.items():
+        full = (max_files is None and max_bytes is None) or \
+            (max_files is not None and files + group_files > max_files) or \
+            (max_bytes is not None and size + group_bytes > max_bytes)
+        if shard < 0 or (full and files > 0):
+            shard, files, size = shard + 1, 0, 0
+        assignments[group] = shard
+        files += group_files
+        size += group_bytes
+    return assignments
+
+
+def partition_metadata_file(metadata_file_path, output_dir, output_name, max_files=None, max_bytes=None,
+                            group_by=None):
+    # Splits the metadata file into per-shard metadata files (each with the original header and file name) under
+    # output_dir, preserving the original record text. Returns the list of Shard objects.
+    if max_files is None and max_bytes is None and group_by is None:
+        raise RuntimeError("At least one of a maximum file count, a maximum size or a grouping column is required "
+                           "to shard a bag.")
+    assignments = assign_groups(metadata_file_path, group_by, max_files, max_bytes) if group_by else None
+    # Shard metadata files are written uncompressed, so they are named without any compression extension.
+    metadata_name = e2b.get_bag_metadata_file_name(metadata_file_path, decompress=True)
+    shards = list()
+    handles = OrderedDict()
+
+    def get_shard(index):
+        while len(shards) <= index:
+            number = len(shards) + 1
+            shard_dir = osp.join(output_dir, "shard-%05d" % number)
+            os.makedirs(shard_dir)
+            shards.append(Shard(number, "%s_shard-%05d" % (output_name, number), osp.join(shard_dir, metadata_name)))
+        return shards[index]
+
+    def write_record(shard, text):
+        handle = handles.get(shard.index)
+        if handle is None:
+            if len(handles) >= MAX_OPEN_SHARD_FILES:
+                handles.popitem(last=False)[1].close()
+            new_file = not osp.isfile(shard.metadata_file_path)
+            handle = handles[shard.index] = open(shard.metadata_file_path, "a")
+            if new_file:
+                handle.write(header_line)
+        handle.write(text)
+
+    try:
+        with compression.open_text(metadata_file_path) as metadata:
+            header_line = metadata.readline()
+            header = parse_metadata_line(header_line.rstrip("\r\n"))
+            if e2b.ENCODE_FILE_SIZE not in header:
+                raise RuntimeError("The required column name %s was not found in the column header %s" %
+                                   (e2b.ENCODE_FILE_SIZE, str(header)))
+            size_index = header.index(e2b.ENCODE_FILE_SIZE)
+            group_index = header.index(group_by) if group_by else None
+            field_count = max(size_index, group_index if group_by else 0) + 1
+            current = None
+            for line_number, fields, text in iter_metadata_records(metadata, field_count, len(header)):
+                size = parse_size(fields[size_index], line_number)
+                if assignments is not None:
+                    shard = get_shard(assignments[fields[group_index]])
+                    shard.add_group(fields[group_index])
+                else:
+                    if current is None or current.files > 0 and (
+                            (max_files is not None and current.files + 1 > max_files) or
+                            (max_bytes is not None and current.bytes + size > max_bytes)):
+                        current = get_shard(len(shards))
+                    shard = current
+                shard.files += 1
+                shard.bytes += size
+                write_record(shard, text if text.endswith("\n") else text + "\n")
+    finally:
+        for handle in handles.values():
+            handle.close()
+    logger.info("Partitioned %s into %d shards." % (metadata_file_path, len(shards)))
+    return shards
+
+
+def write_index_bag(bag_path, metadata_file_path, index, creator_name=None, creator_orcid=None):
+    e2b.ensure_bag_path_exists(bag_path)
+    shutil.copy(osp.abspath(metadata_file_path), bag_path)
+    with open(osp.join(bag_path, SHARD_INDEX_FILE), "w") as index_file:
+        json.dump(index, index_file, indent=4)
+    bag_metadata = dict()
+    if creator_name:
+        bag_metadata["Contact-Name"] = creator_name
+    if creator_orcid:
+        bag_metadata["Contact-Orcid"] = creator_orcid
+    bag_metadata["External-Description"] = "Index of %d encode2bag shard bags." % len(index["shards"])
+    with e2b.BAG_BUILD_LOCK:
+        bdb.make_bag(bag_path, algs=e2b.BAG_ALGORITHMS, metadata=bag_metadata)
+    return bag_path
+
+
+def get_shard_stage(shard_name):
+    return "shard:%s" % shard_name
+
+
+def get_shard_build_id(source, shard, max_files=None, max_bytes=None, group_by=None):
+    # Identifies the build of a shard independently of where its metadata file was partitioned to, so that the journal
+    # of an interrupted shard build is found again by the same sharded build.
+    return "%s#shard-%05d;max_files=%s;max_bytes=%s;group_by=%s" % (source, shard.index, max_files, max_bytes,
+                                                                    group_by)
+
+
+def create_sharded_bags_from_metadata_file(metadata_file_path,
+                                           output_name=None,
+                                           output_path=None,
+                                           max_files=None,
+                                           max_bytes=None,
+                                           group_by=None,
+                                           workers=batch.DEFAULT_BATCH_WORKERS,
+                                           executor="thread",
+                                           resume=False,
+                                           journal=None,
+                                           **kwargs):
+    # Builds one bag per shard concurrently and ties them together with an index bag named output_name, whose
+    # payload is the complete metadata file and a shard-index.json listing every shard bag. Returns the index bag path.
+    # With the journal of a resumable build, the partition is kept in the journal, completed shard bags are recorded
+    # in it and not built again, and the remaining shards are built with resume from their own journals.
+    index_bag_path = e2b.get_target_bag_path(output_name=output_name, output_path=output_path)
+    output_name = osp.basename(index_bag_path)
+    output_path = osp.dirname(index_bag_path)
+    temp_path = None if journal else tempfile.mkdtemp(prefix="encode2bag_")
+    try:
+        if jnl.completed(journal, "shard_partition"):
+            shards = [Shard.from_dict(shard, shard["metadata_file"])
+                      for shard in journal.result("shard_partition", "shards")]
+        else:
+            with jnl.checkpoint(journal, "shard_partition") as partition, inst.stage("shard_partition") as stage:
+                shard_path = journal.working_path("shards") if journal else temp_path
+                if journal and osp.isdir(shard_path):
+                    # Shard metadata files are appended to, so those of an interrupted partition are discarded.
+                    shutil.rmtree(shard_path)
+                shards = partition_metadata_file(metadata_file_path, shard_path, output_name, max_files, max_bytes,
+                                                 group_by)
+                partition["shards"] = [dict(shard.to_dict(), metadata_file=shard.metadata_file_path)
+                                       for shard in shards]
+                stage.rows = sum(shard.files for shard in shards)
+                stage.bytes = osp.getsize(metadata_file_path)
+
+        results = list()
+        items = list()
+        for shard in shards:
+            item = {"line": shard.index, "source": shard.metadata_file_path, "output_name": shard.name}
+            if jnl.completed(journal, get_shard_stage(shard.name)):
+                logger.info("Skipping shard bag %s, which was completed by an interrupted build." % shard.name)
+                item.update({"status": "success", "bag_path": journal.result(get_shard_stage(shard.name), "bag_path")})
+                results.append(item)
+                continue
+            if journal:
+                item["build_id"] = get_shard_build_id(journal.parameters.get("source"), shard, max_files, max_bytes,
+                                                      group_by)
+            items.append(item)
+
+        def record_shard(result):
+            if journal and result["status"] == "success":
+                journal.complete(get_shard_stage(result["output_name"]), bag_path=result["bag_path"])
+
+        results.extend(batch.create_bags_from_batch(items, output_path=output_path, workers=workers, executor=executor,
+                                                    callback=record_shard, resume=resume, **kwargs))
+        results.sort(key=lambda r: r["line"])
+    finally:
+        if temp_path:
+            shutil.rmtree(temp_path)
+
+    failed = [r for r in results if r["status"] != "success"]
+    if failed:
+        raise RuntimeError("Failed to create %d of %d shard bags: %s" %
+                           (len(failed), len(results), ", ".join("%s (%s)" % (r["output_name"], r["error"])
+                                                                  for r in failed)))
+    index = OrderedDict([("created", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                         ("metadata_file", osp.basename(metadata_file_path)),
+                         ("max_files", max_files),
+                         ("max_bytes", max_bytes),
+                         ("group_by", group_by),
+                         ("total_files", sum(shard.files for shard in shards)),
+                         ("total_bytes", sum(shard.bytes for shard in shards)),
+                         ("shards", list())])
+    for shard, result in zip(shards, results):
+        entry = shard.to_dict()
+        entry["path"] = osp.relpath(result["bag_path"], output_path)
+        index["shards"].append(entry)
+    write_index_bag(index_bag_path, metadata_file_path, index, kwargs.get("creator_name"),
+                    kwargs.get("creator_orcid"))
+    logger.info("Created %d shard bags indexed by %s" % (len(shards), index_bag_path))
+    return index_bag_path
@@ -0,0 +1,111 @@
+import hashlib
+import random
+import string
+
+ENCODE_METADATA_COLUMNS = [
+    "File accession", "File format", "Output type", "Experiment accession", "Assay", "Biosample term id",
+    "Biosample term name", "Biosample type", "Biosample life stage", "Biosample sex", "Biosample organism",
+    "Biosample treatments", "Biosample subcellular fraction term name", "Biosample phase",
+    "Biosample synchronization stage", "Experiment target", "Antibody accession", "Library made from",
+    "Library depleted in", "Library extraction method", "Library lysis method", "Library crosslinking method",
+    "Experiment date released", "Project", "RBNS protein concentration", "Library fragmentation method",
+    "Library size range", "Biosample Age", "Biological replicate(s)", "Technical replicate", "Read length",
+    "Run type", "Paired end", "Paired with", "Derived from", "Size", "Lab", "md5sum", "File download URL",
+    "Assembly", "Platform"]
+
+# (file format, file extension, output type, relative weight, (min size, max size)) roughly following the mix of
+# file formats in a typical ENCODE query result.
+FILE_FORMATS = [
+    ("fastq", "fastq.gz", "reads", 46, (100 * 1024 ** 2, 4 * 1024 ** 3)),
+    ("bigWig", "bigWig", "signal of unique reads", 13, (10 * 1024 ** 2, 2 * 1024 ** 3)),
+    ("bam", "bam", "alignments", 12, (500 * 1024 ** 2, 20 * 1024 ** 3)),
+    ("bed narrowPeak", "bed.gz", "peaks", 12, (1024 ** 2, 100 * 1024 ** 2)),
+    ("bigBed narrowPeak", "bigBed", "peaks", 8, (1024 ** 2, 100 * 1024 ** 2)),
+    ("bigBed broadPeak", "bigBed", "peaks", 4, (1024 ** 2, 100 * 1024 ** 2)),
+    ("bed broadPeak", "bed.gz", "peaks", 4, (1024 ** 2, 100 * 1024 ** 2)),
+    ("tagAlign", "tagAlign.gz", "alignments", 1, (100 * 1024 ** 2, 1024 ** 3))]
+ASSAYS = ["RNA-seq", "ChIP-seq", "DNase-seq", "ATAC-seq", "eCLIP", "WGBS"]
+BIOSAMPLES = [("EFO:0001086", "A549", "immortalized cell line"),
+              ("EFO:0002067", "K562", "immortalized cell line"),
+              ("CL:0002399", "CD1c-positive myeloid dendritic cell", "primary cell"),
+              ("UBERON:0000955", "brain", "tissue"),
+              ("EFO:0003042", "H1-hESC", "stem cell")]
+LABS = ["Richard Myers, HAIB", "John Stamatoyannopoulos, UW", "Michael Snyder, Stanford", "Bradley Bernstein, Broad"]
+ASSEMBLIES = ["GRCh38", "hg19", "mm10", ""]
+PLATFORMS = ["HiSeq 2500", "HiSeq 4000", "NovaSeq 6000", ""]
+BASE_URL = "https://www.encodeproject.org"
+
+
+def make_accession(prefix, number):
+    letters = ''.join(string.ascii_uppercase[(number // 26 ** i) % 26] for i in range(3))
+    return "%s%03d%s" % (prefix, number // 26 ** 3 % 1000, letters)
+
+
+def make_payload(accession, size):
+    # Deterministic file content for a synthetic accession, so that payload servers need no storage.
+    block = hashlib.sha256(accession.encode("utf-8")).digest() * 128
+    return (block * (size // len(block) + 1))[:size]
+
+
+def generate_metadata_rows(rows, seed=0, base_url=BASE_URL, payload_size_range=None):
+    # With payload_size_range, sizes are drawn from that (min, max) range and md5sums are computed from make_payload,
+    # so the rows describe files that can actually be served; otherwise sizes are realistic and md5sums random.
+    rng = random.Random(seed)
+    weights = [f[3] for f in FILE_FORMATS]
+    total_weight = sum(weights)
+    for i in range(rows):
+        pick = rng.uniform(0, total_weight)
+        for file_format in FILE_FORMATS:
+            pick -= file_format[3]
+            if pick <= 0:
+                break
+        name, extension, output_type, _, (min_size, max_size) = file_format
+        if payload_size_range:
+            min_size, max_size = payload_size_range
+        accession = make_accession("ENCFF", i)
+        experiment = make_accession("ENCSR", i // 8)
+        term_id, term_name, biosample_type = BIOSAMPLES[(i // 8) % len(BIOSAMPLES)]
+        row = dict.fromkeys(ENCODE_METADATA_COLUMNS, "")
+        row.update({
+            "File accession": accession,
+            "File format": name,
+            "Output type": output_type,
+            "Experiment accession": experiment,
+            "Assay": ASSAYS[(i // 8) % len(ASSAYS)],
+            "Biosample term id": term_id,
+            "Biosample term name": term_name,
+            "Biosample type": biosample_type,
+            "Biosample life stage": "adult",
+            "Biosample sex": rng.choice(["male", "female", "unknown"]),
+            "Biosample organism": "Homo sapiens",
+            "Library made from": "DNA" if name != "fastq" else "polyadenylated mRNA",
+            "Experiment date released": "20%02d-%02d-%02d" % (rng.randint(10, 24), rng.randint(1, 12),
+                                                             rng.randint(1, 28)),
+            "Project": "ENCODE",
+            "Biological replicate(s)": str(rng.randint(1, 2)),
+            "Technical replicate": "1",
+            "Read length": "36" if name == "fastq" else "",
+            "Run type": "paired-ended" if name == "fastq" else "",
+            "Size": str(rng.randint(min_size, max_size)),
+            "Lab": LABS[(i // 8) % len(LABS)],
+            "md5sum": "%032x" % rng.getrandbits(128),
+            "File download URL": "%s/files/%s/@@download/%s.%s" % (base_url, accession, accession, extension),
+            "Assembly": ASSEMBLIES[i % len(ASSEMBLIES)] if name != "fastq" else "",
+            "Platform": PLATFORMS[i % len(PLATFORMS)] if name == "fastq" else ""})
+        if payload_size_range:
+            row["md5sum"] = hashlib.md5(make_payload(accession, int(row["Size"]))).hexdigest()
+        yield row
+
+
+def format_metadata_rows(rows):
+    yield "\t".join(ENCODE_METADATA_COLUMNS) + "\n"
+    for row in rows:
+        yield "\t".join(row[column] for column in ENCODE_METADATA_COLUMNS) + "\n"
+
+
+def write_metadata_file(output_path, rows, seed=0, base_url=BASE_URL, payload_size_range=None):
+    with open(output_path, "w") as metadata:
+        for line in format_metadata_rows(generate_metadata_rows(rows, seed=seed, base_url=base_url,
+                                                                payload_size_range=payload_size_range)):
+            metadata.write(line)
+    return output_path
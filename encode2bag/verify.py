@@ -0,0 +1,229 @@
+import os
+import os.path as osp
+import hashlib
+import json
+import logging
+import mmap
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from encode2bag import encode2bag_api as e2b
+from encode2bag import bag_utils
+from encode2bag import compression
+from encode2bag.metadata_reader import MetadataReader
+
+logger = logging.getLogger(__name__)
+
+try:
+    DEFAULT_VERIFY_WORKERS = os.cpu_count() or 1
+except AttributeError:
+    import multiprocessing
+    DEFAULT_VERIFY_WORKERS = multiprocessing.cpu_count()
+DEFAULT_CHECKSUM_CACHE = osp.join(osp.expanduser("~"), ".encode2bag", "checksum-cache.json")
+READ_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+class ChecksumCache(object):
+    """
+    Persistent cache of file md5 checksums keyed by (real path, size, mtime), so that repeated verifications only
+    rehash files that were added or modified since. A cached checksum is only trusted while the size and modification
+    time of the file are unchanged. Entries of files that no longer exist are dropped when the cache is saved.
+    """
+    def __init__(self, path=DEFAULT_CHECKSUM_CACHE):
+        self.path = osp.abspath(path)
+        self.entries = dict()
+        self.modified = False
+        self._lock = threading.Lock()
+        if osp.isfile(self.path):
+            try:
+                with open(self.path) as cache_file:
+                    self.entries = json.load(cache_file)
+            except ValueError:
+                logger.warning("Ignoring corrupt checksum cache: %s" % self.path)
+
+    @staticmethod
+    def make_key(path):
+        stat = os.stat(path)
+        return osp.realpath(path), stat.st_size, getattr(stat, "st_mtime_ns", int(stat.st_mtime * 1e9))
+
+    def get(self, key):
+        entry = self.entries.get(key[0])
+        if entry and entry["size"] == key[1] and entry["mtime"] == key[2]:
+            return entry["md5"]
+        return None
+
+    def put(self, key, md5):
+        with self._lock:
+            self.entries[key[0]] = {"size": key[1], "mtime": key[2], "md5": md5}
+            self.modified = True
+
+    def save(self):
+        with self._lock:
+            missing = [path for path in self.entries if not osp.isfile(path)]
+            for path in missing:
+                del self.entries[path]
+            self.modified = self.modified or bool(missing)
+        if not self.modified:
+            return
+        bag_utils.ensure_dir(osp.dirname(self.path))
+        temp_path = ''.join([self.path, ".tmp"])
+        with open(temp_path, "w") as cache_file:
+            json.dump(self.entries, cache_file, sort_keys=True)
+        bag_utils.replace_file(temp_path, self.path)
+        self.modified = False
+
+
+def compute_md5(path):
+    # Hashes the whole file in a single call on a memory map, during which hashlib releases the GIL, so that files
+    # hashed by concurrent threads are processed in parallel. Falls back to large buffered reads where a file cannot be
+    # mapped (e.g. empty files).
+    hasher = hashlib.md5()
+    with open(path, "rb") as data_file:
+        try:
+            mapped = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            mapped = None
+        if mapped is not None:
+            try:
+                hasher.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            while True:
+                block = data_file.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                hasher.update(block)
+    return hasher.hexdigest()
+
+
+def read_metadata_entries(metadata_file_path):
+    # Returns the remote file entries the converter derives from the metadata file, indexed by payload path, or None
+    # if the file is not an ENCODE metadata table (e.g. a binary or compressed payload file).
+    entries = OrderedDict()
+    try:
+        with compression.open_text(metadata_file_path) as metadata:
+            reader = MetadataReader(metadata, [e2b.ENCODE_FILE_URL, e2b.ENCODE_FILE_SIZE, e2b.ENCODE_FILE_MD5SUM])
+            for url, length, md5 in reader:
+                path = ''.join(["data/", url.split("/")[-1]])
+                entries.setdefault(path, {"url": url, "length": length, "md5": md5})
+    except (RuntimeError, ValueError, IOError, OSError, EOFError, zlib.error) as e:
+        logger.debug("%s is not an ENCODE metadata file: %s" % (metadata_file_path, e))
+        return None
+    return entries
+
+
+def find_metadata_file(bag_path, local_paths):
+    # The bundled metadata file is the local payload file that is an ENCODE metadata table. Files named like the
+    # ENCODE metadata file are tried first. Returns its payload path and entries.
+    for path in sorted(local_paths, key=lambda p: not osp.basename(p).startswith("metadata")):
+        full_path = osp.join(bag_path, path)
+        if osp.isfile(full_path):
+            entries = read_metadata_entries(full_path)
+            if entries is not None:
+                return path, entries
+    return None, None
+
+
+def verify_bag(bag_path,
+               metadata_name=None,
+               remote_file_manifest=None,
+               workers=DEFAULT_VERIFY_WORKERS,
+               checksum_cache=None):
+    """
+    Verifies an encode2bag bag without rehashing unchanged files: fetch.txt and the md5 payload manifest (and the
+    optional remote file manifest) are cross-checked against the bundled ENCODE metadata file using path-indexed
+    lookups, and only payload files present on disk are hashed. Returns a report dict; the bag is valid if its
+    "errors" list is empty.
+    """
+    bag_path = osp.abspath(bag_path)
+    if not osp.isfile(osp.join(bag_path, "bagit.txt")):
+        raise RuntimeError("The directory %s is not a bag and cannot be verified." % bag_path)
+    errors = list()
+    manifest = bag_utils.read_payload_manifests(bag_path).get("md5")
+    if manifest is None:
+        raise RuntimeError("The bag %s has no md5 payload manifest." % bag_path)
+    fetch = bag_utils.read_fetch_file(bag_path)
+
+    local_paths = [path for path in manifest if path not in fetch]
+    if metadata_name:
+        metadata_path = ''.join(["data/", metadata_name])
+        expected = read_metadata_entries(osp.join(bag_path, metadata_path)) \
+            if osp.isfile(osp.join(bag_path, metadata_path)) else None
+    else:
+        metadata_path, expected = find_metadata_file(bag_path, local_paths)
+    if expected is None:
+        raise RuntimeError("Unable to locate the ENCODE metadata file in the payload of bag %s" % bag_path)
+
+    for path, entry in expected.items():
+        if path not in fetch:
+            errors.append("%s is listed in the metadata file but not in fetch.txt" % path)
+        elif fetch[path] != (entry["url"], entry["length"]):
+            errors.append("%s has fetch.txt entry %s but the metadata file lists %s" %
+                          (path, " ".join(fetch[path]), " ".join((entry["url"], entry["length"]))))
+        if manifest.get(path) != entry["md5"]:
+            errors.append("%s has manifest md5 %s but the metadata file lists %s" %
+                          (path, manifest.get(path), entry["md5"]))
+    for path in fetch:
+        if path not in expected:
+            errors.append("%s is listed in fetch.txt but not in the metadata file" % path)
+    for path in local_paths:
+        if path != metadata_path:
+            errors.append("%s is listed in the payload manifest but not in the metadata file" % path)
+
+    if remote_file_manifest:
+        with open(remote_file_manifest) as rfm:
+            for entry in json.load(rfm):
+                path = ''.join(["data/", entry["filename"]])
+                known = expected.get(path)
+                if known is None or (entry["url"], str(entry["length"]), entry.get("md5")) != \
+                        (known["url"], known["length"], known["md5"]):
+                    errors.append("%s does not match the metadata file in the remote file manifest" % path)
+
+    # Only files present on disk are hashed: the metadata file, and whichever remote files have been materialized.
+    present = [path for path in manifest if osp.isfile(osp.join(bag_path, path))]
+    data_path = osp.join(bag_path, "data")
+    for root, _, files in os.walk(data_path):
+        for filename in files:
+            path = osp.relpath(osp.join(root, filename), bag_path).replace(os.sep, "/")
+            if path not in manifest:
+                errors.append("%s is present in the payload but not listed in the payload manifest" % path)
+
+    counts = {"hashed": 0, "cached": 0, "bytes_hashed": 0}
+    counts_lock = threading.Lock()
+
+    def check(path):
+        full_path = osp.join(bag_path, path)
+        key = ChecksumCache.make_key(full_path)
+        md5 = checksum_cache.get(key) if checksum_cache else None
+        with counts_lock:
+            counts["cached" if md5 else "hashed"] += 1
+            if not md5:
+                counts["bytes_hashed"] += key[1]
+        if md5 is None:
+            md5 = compute_md5(full_path)
+            if checksum_cache:
+                checksum_cache.put(key, md5)
+        if md5 != manifest[path]:
+            return "%s has md5 %s but the payload manifest lists %s" % (path, md5, manifest[path])
+        return None
+
+    logger.info("Verifying %d local payload files of %s using %d workers..." % (len(present), bag_path, workers))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        errors.extend(error for error in pool.map(check, present) if error)
+    if checksum_cache:
+        checksum_cache.save()
+
+    for error in errors:
+        logger.error(error)
+    logger.info("Verified bag %s: %d remote files, %d local files (%d hashed, %d from checksum cache), %d errors." %
+                (bag_path, len(fetch), len(present), counts["hashed"], counts["cached"], len(errors)))
+    return OrderedDict([("bag_path", bag_path),
+                        ("metadata_file", metadata_path),
+                        ("remote_files", len(fetch)),
+                        ("local_files", len(present)),
+                        ("hashed", counts["hashed"]),
+                        ("cached", counts["cached"]),
+                        ("bytes_hashed", counts["bytes_hashed"]),
+                        ("errors", errors)])
@@ -19,7 +19,8 @@ setup(
     test_suite='test',
     entry_points={
         'console_scripts': [
-            'encode2bag = encode2bag.encode2bag_cli:main'
+            'encode2bag = encode2bag.encode2bag_cli:main',
+            'encode2bag-service = encode2bag.service:main'
         ]
     },
     requires=[
@@ -34,7 +35,12 @@ setup(
         'urlparse'],
     install_requires=['requests',
                       'certifi',
-                      'bdbag==1.0.0'],
+                      'bdbag==1.0.0',
+                      'futures; python_version < "3"'],
+    extras_require={
+        'zstd': ['zstandard'],
+        'async': ['aiohttp; python_version >= "3.5"']
+    },
     dependency_links=[
          "http://github.com/ini-bdds/bdbag/archive/master.zip#egg=bdbag-1.0.0"
     ],
@@ -47,6 +47,8 @@ class TestAPI(unittest.TestCase):
                 with open(validation_path) as in_rmf:
                     input_json = json.load(in_rmf)
                     self.assertEqual(input_json, output_json, "Expected JSON output to match test validation input")
+            with open(output_path, "rb") as out_rmf, open(validation_path, "rb") as in_rmf:
+                self.assertEqual(in_rmf.read(), out_rmf.read(), "Expected output bytes to match test validation input")
         except Exception as e:
             self.fail(gne(e))
 
@@ -72,6 +74,53 @@ class TestAPI(unittest.TestCase):
         except Exception as e:
             self.fail(gne(e))
 
+    def testWriteJSONArray(self):
+        try:
+            for entries in ([], [{"b": "2", "a": "1"}], [{"url": "x"}, {"url": "y", "md5": "z"}]):
+                output = StringIO()
+                count = e2b.write_json_array(iter(entries), output)
+                self.assertEqual(len(entries), count)
+                self.assertEqual(json.dumps(entries, sort_keys=True, indent=4, separators=(',', ': ')),
+                                 output.getvalue())
+        except Exception as e:
+            self.fail(gne(e))
+
+    def _writeMetadataWithRepeatedRows(self, modify=None):
+        with open(osp.join("test", "test_data", "metadata-1.tsv")) as metadata:
+            lines = metadata.readlines()
+        repeated = [modify(line) if modify else line for line in lines[1:4]]
+        input_path = osp.join(self.tmpdir, "metadata-1.tsv")
+        with open(input_path, "w") as metadata:
+            metadata.writelines(lines[:3] + repeated + lines[3:])
+        return input_path
+
+    def testConvertMetadataWithDuplicateRows(self):
+        try:
+            input_path = self._writeMetadataWithRepeatedRows()
+            output_path = osp.join(self.tmpdir, "remote-file-manifest.json")
+            summary = e2b.convert_tsv_metadata_to_remote_file_manifest(input_path, output_path)
+            self.assertEqual(28, summary["entries"])
+            self.assertEqual(3, summary["duplicate_rows"])
+            with open(input_path) as metadata:
+                sizes = [int(line.split("\t")[35]) for line in metadata.readlines()[3:6]]
+            self.assertEqual(sum(sizes), summary["duplicate_bytes"])
+            with open(output_path, "rb") as out_rmf, \
+                    open(osp.join("test", "test_data", "rfm-1.json"), "rb") as in_rmf:
+                self.assertEqual(in_rmf.read(), out_rmf.read())
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testConvertMetadataWithConflictingRows(self):
+        def change_md5(line):
+            fields = line.split("\t")
+            fields[37] = "0" * 32
+            return "\t".join(fields)
+        input_path = self._writeMetadataWithRepeatedRows(change_md5)
+        output_path = osp.join(self.tmpdir, "rfm.json")
+        with self.assertRaises(RuntimeError):
+            e2b.convert_tsv_metadata_to_remote_file_manifest(input_path, output_path)
+        self.assertEqual(["metadata-1.tsv"], os.listdir(self.tmpdir))
+
     def testRetrieveMetadataFileByURL1(self):
         try:
             url = "https://www.encodeproject.org/search/" \
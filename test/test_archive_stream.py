@@ -0,0 +1,155 @@
+import os
+import os.path as osp
+import io
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+import bagit
+from bdbag import bdbag_api as bdb
+from encode2bag import encode2bag_api as e2b
+from encode2bag import bag_utils
+from encode2bag import archive_stream
+from encode2bag import compression
+from encode2bag.mock_server import MockENCODEServer
+from encode2bag import get_named_exception as gne
+
+
+class UnseekableOutput(io.RawIOBase):
+    # A write-only file object that cannot seek or tell, like a pipe or stdout.
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+class TestArchiveStream(unittest.TestCase):
+
+    def setUp(self):
+        super(TestArchiveStream, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.metadata_file = osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestArchiveStream, self).tearDown()
+
+    def extract(self, archive_path, name):
+        output_path = osp.join(self.tmpdir, name)
+        bag_path = bdb.extract_bag(archive_path, output_path=output_path)
+        return bag_path
+
+    def assertBagsEquivalent(self, expected_path, actual_path):
+        for tag_file in ["bagit.txt", "fetch.txt", "manifest-md5.txt", "manifest-sha256.txt", "data/metadata-1.tsv"]:
+            with open(osp.join(expected_path, tag_file)) as expected, open(osp.join(actual_path, tag_file)) as actual:
+                self.assertEqual(expected.read(), actual.read(), tag_file)
+        expected_info = bag_utils.read_bag_info(expected_path)
+        actual_info = bag_utils.read_bag_info(actual_path)
+        for key in ("Bagging-Date", "Bagging-Time"):
+            expected_info.pop(key)
+            actual_info.pop(key)
+        self.assertEqual(expected_info, actual_info)
+        for alg in e2b.BAG_ALGORITHMS:
+            with open(osp.join(actual_path, "tagmanifest-%s.txt" % alg)) as tag_manifest:
+                for line in tag_manifest:
+                    checksum, path = line.split()
+                    self.assertEqual(checksum, bag_utils.compute_file_checksums(osp.join(actual_path, path),
+                                                                                [alg])[alg])
+
+    def _test_stream_archive(self, archive_format):
+        try:
+            expected_path = e2b.create_bag_from_metadata_file(self.metadata_file,
+                                                              output_path=osp.join(self.tmpdir, "staged"),
+                                                              output_name="bag",
+                                                              creator_name="encode2bag unit test",
+                                                              create_ro_manifest=True)
+            archive_path = e2b.create_bag_from_metadata_file(self.metadata_file,
+                                                             output_path=osp.join(self.tmpdir, "streamed"),
+                                                             output_name="bag",
+                                                             archive_format=archive_format,
+                                                             creator_name="encode2bag unit test",
+                                                             create_ro_manifest=True,
+                                                             stream_archive=True)
+            self.assertEqual(osp.join(self.tmpdir, "streamed", "bag.%s" % archive_format), archive_path)
+            self.assertFalse(osp.exists(osp.join(self.tmpdir, "streamed", "bag")))
+            bag_path = self.extract(archive_path, "extracted")
+            bdb.validate_bag_structure(bag_path, skip_remote=True)
+            self.assertBagsEquivalent(expected_path, bag_path)
+            self.assertTrue(osp.isfile(osp.join(bag_path, "metadata", "manifest.json")))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testStreamArchiveZip(self):
+        self._test_stream_archive("zip")
+
+    def testStreamArchiveTar(self):
+        self._test_stream_archive("tar")
+
+    def testStreamArchiveTgz(self):
+        self._test_stream_archive("tgz")
+
+    def testParallelDeflateZipMember(self):
+        try:
+            data = b"".join(b"%08d ACGTACGTACGT\n" % i for i in range(3 * compression.COMPRESSION_BLOCK_SIZE // 22))
+            archive_path = osp.join(self.tmpdir, "bag.zip")
+            writer = archive_stream.BagArchiveWriter(archive_path, "zip", "bag", e2b.BAG_ALGORITHMS,
+                                                     compression_workers=2)
+            writer.add_stream("data/large.txt", io.BytesIO(data), len(data))
+            writer.add_stream("data/small.txt", io.BytesIO(b"ACGT"), 4)
+            writer.close()
+            self.assertEqual(1, writer.parallel_members)
+            with zipfile.ZipFile(archive_path) as archive:
+                self.assertIsNone(archive.testzip())
+                self.assertEqual(data, archive.read("bag/data/large.txt"))
+                self.assertLess(archive.getinfo("bag/data/large.txt").compress_size, len(data))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testStreamArchiveToUnseekableOutput(self):
+        try:
+            for archive_format in ("tgz", "zip"):
+                output = UnseekableOutput()
+                result = e2b.create_bag_from_metadata_file(self.metadata_file,
+                                                           output_name="piped_bag",
+                                                           archive_format=archive_format,
+                                                           archive_output=output)
+                self.assertIsNone(result)
+                if archive_format == "zip":
+                    names = zipfile.ZipFile(io.BytesIO(output.buffer.getvalue())).namelist()
+                else:
+                    names = tarfile.open(fileobj=io.BytesIO(output.buffer.getvalue()), mode="r:gz").getnames()
+                self.assertIn("piped_bag/fetch.txt", names)
+                self.assertEqual("piped_bag/tagmanifest-sha256.txt", names[-1])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testStreamArchiveWithMaterialize(self):
+        try:
+            with MockENCODEServer(payload_size_range=(1024, 8 * 1024)) as server:
+                archive_path = e2b.create_bag_from_url(server.search_url("type=Experiment&mock_rows=6"),
+                                                       output_path=self.tmpdir,
+                                                       output_name="materialized",
+                                                       archive_format="tgz",
+                                                       use_cache=False,
+                                                       materialize=True,
+                                                       materialize_workers=2,
+                                                       stream_archive=True)
+            bag_path = self.extract(archive_path, "extracted")
+            bagit.Bag(bag_path).validate()
+            self.assertEqual(7, len(bag_utils.read_payload_manifests(bag_path)["sha256"]))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testStreamArchiveRequiresFormat(self):
+        with self.assertRaises(RuntimeError):
+            e2b.create_bag_from_metadata_file(self.metadata_file, output_path=self.tmpdir, stream_archive=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import os.path as osp
+import sys
+import shutil
+import tempfile
+import unittest
+import zipfile
+import bagit
+from encode2bag import bag_utils
+from encode2bag.payload_store import PayloadStore
+from encode2bag.mock_server import MockENCODEServer
+from encode2bag import get_named_exception as gne
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from encode2bag import async_api
+else:
+    async_api = None
+
+QUERY = "type=Experiment&assay_title=ChIP-seq&mock_rows=12"
+
+
+@unittest.skipIf(async_api is None or async_api.aiohttp is None, "aiohttp is not installed")
+class TestAsyncAPI(unittest.TestCase):
+
+    def setUp(self):
+        super(TestAsyncAPI, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop()
+        self.loop.close()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestAsyncAPI, self).tearDown()
+
+    def start_server(self, **kwargs):
+        self.server = MockENCODEServer(payload_size_range=(1024, 16 * 1024), **kwargs)
+        self.server.start()
+        return self.server
+
+    def testCreateBagFromURL(self):
+        try:
+            server = self.start_server()
+            bag_path = self.loop.run_until_complete(
+                async_api.create_bag_from_url(server.search_url(QUERY),
+                                              use_cache=False,
+                                              output_path=self.tmpdir,
+                                              output_name="async_bag",
+                                              create_ro_manifest=True))
+            bag = bagit.Bag(bag_path)
+            self.assertEqual(12, len(list(bag.files_to_be_fetched())))
+            self.assertTrue(osp.isfile(osp.join(bag_path, "metadata", "manifest.json")))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testDownloaderCreatedOutsideEventLoop(self):
+        try:
+            server = self.start_server()
+            _, rows = server.generate_metadata(QUERY)
+            downloader = async_api.AsyncHTTPDownloader(concurrency=2)
+
+            async def download_files():
+                async with downloader:
+                    await asyncio.gather(*[downloader.download(row["File download URL"], osp.join(self.tmpdir, str(i)))
+                                           for i, row in enumerate(rows)])
+            self.loop.run_until_complete(download_files())
+            self.assertEqual([int(row["Size"]) for row in rows],
+                             [osp.getsize(osp.join(self.tmpdir, str(i))) for i in range(len(rows))])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateMaterializedBagWithFaults(self):
+        try:
+            server = self.start_server(error_rate=0.2, drop_rate=0.2, seed=7)
+            downloader = async_api.AsyncHTTPDownloader(max_retries=10, backoff_factor=0.01, chunk_size=1024,
+                                                       concurrency=4)
+            try:
+                bag_path = self.loop.run_until_complete(
+                    async_api.create_bag_from_url(server.search_url(QUERY),
+                                                  use_cache=False,
+                                                  output_path=self.tmpdir,
+                                                  output_name="async_bag",
+                                                  downloader=downloader,
+                                                  materialize=True))
+            finally:
+                self.loop.run_until_complete(downloader.close())
+            bagit.Bag(bag_path).validate()
+            for path in bag_utils.read_payload_manifests(bag_path)["md5"]:
+                self.assertTrue(osp.isfile(osp.join(bag_path, path)))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateArchivedMaterializedBag(self):
+        try:
+            server = self.start_server()
+            archive_path = self.loop.run_until_complete(
+                async_api.create_bag_from_url(server.search_url(QUERY),
+                                              use_cache=False,
+                                              output_path=self.tmpdir,
+                                              output_name="async_bag",
+                                              materialize=True,
+                                              archive_format="zip"))
+            self.assertEqual(osp.join(self.tmpdir, "async_bag.zip"), archive_path)
+            with zipfile.ZipFile(archive_path) as archive:
+                payload = [name for name in archive.namelist()
+                           if name.startswith("async_bag/data/") and not name.endswith("/")]
+            self.assertEqual(13, len(payload))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateMaterializedBagsFromPayloadStore(self):
+        try:
+            server = self.start_server()
+            store = PayloadStore(osp.join(self.tmpdir, "store"))
+            for name in ("first", "second"):
+                bag_path = self.loop.run_until_complete(
+                    async_api.create_bag_from_url(server.search_url(QUERY),
+                                                  use_cache=False,
+                                                  output_path=self.tmpdir,
+                                                  output_name=name,
+                                                  materialize=True,
+                                                  payload_store=store))
+                bagit.Bag(bag_path).validate()
+            self.assertEqual(12, len([r for r in server.request_log if r.startswith("/files/")]))
+            self.assertEqual([2] * 12, [len(entry["refs"]) for _, entry in store.entries()])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCancelMaterialization(self):
+        server = self.start_server(rows=4, bandwidth=16 * 1024)
+        scratch_path = osp.join(self.tmpdir, "scratch")
+        os.mkdir(scratch_path)
+        tempdir = tempfile.tempdir
+        tempfile.tempdir = scratch_path
+        try:
+            task = self.loop.create_task(async_api.create_bag_from_url(server.search_url("type=Experiment"),
+                                                                       use_cache=False,
+                                                                       output_path=self.tmpdir,
+                                                                       output_name="async_bag",
+                                                                       materialize=True))
+            while not any(r.startswith("/files/") for r in server.request_log):
+                self.loop.run_until_complete(asyncio.sleep(0.05))
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                self.loop.run_until_complete(task)
+            self.assertEqual([], os.listdir(scratch_path))
+        finally:
+            tempfile.tempdir = tempdir
+
+
+if __name__ == '__main__':
+    unittest.main()
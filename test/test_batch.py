@@ -0,0 +1,55 @@
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+import json
+import bagit
+from encode2bag import batch
+from encode2bag import get_named_exception as gne
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.batch_file = osp.join(self.tmpdir, "batch.txt")
+        with open(self.batch_file, "w") as f:
+            f.write("# ENCODE batch\n")
+            f.write("%s\tbag-1\n" % osp.abspath(osp.join("test", "test_data", "metadata-1.tsv")))
+            f.write("%s\tbag-2\n" % osp.abspath(osp.join("test", "test_data", "does-not-exist.tsv")))
+            f.write("\n")
+            f.write("%s\tbag-3\n" % osp.abspath(osp.join("test", "test_data", "metadata-2.tsv")))
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestBatch, self).tearDown()
+
+    def testReadBatchFile(self):
+        items = batch.read_batch_file(self.batch_file)
+        self.assertEqual(["bag-1", "bag-2", "bag-3"], [item["output_name"] for item in items])
+        self.assertEqual([2, 3, 5], [item["line"] for item in items])
+
+    def testCreateBagsFromBatch(self):
+        try:
+            output_path = osp.join(self.tmpdir, "bags")
+            results = batch.create_bags_from_batch(batch.read_batch_file(self.batch_file),
+                                                   output_path=output_path,
+                                                   workers=3)
+            self.assertEqual(["success", "failure", "success"], [r["status"] for r in results])
+            for r in results[0], results[2]:
+                self.assertIsInstance(bagit.Bag(r["bag_path"]), bagit.Bag)
+            report_path = osp.join(self.tmpdir, "report.json")
+            batch.write_batch_report(results, report_path)
+            with open(report_path) as f:
+                report = json.load(f)
+            self.assertEqual(2, report["succeeded"])
+            self.assertEqual(1, report["failed"])
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import os.path as osp
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from encode2bag import cache
+from encode2bag import http_client as http
+from encode2bag import get_named_exception as gne
+
+if sys.version_info > (3,):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+PAYLOAD = b"File download URL\tSize\tmd5sum\n"
+ETAG = '"encode2bag-test"'
+
+
+class ConditionalHandler(BaseHTTPRequestHandler):
+    requests_seen = list()
+    send_validators = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        ConditionalHandler.requests_seen.append(self.path)
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if ConditionalHandler.send_validators:
+            self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestCache, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        ConditionalHandler.requests_seen = list()
+        ConditionalHandler.send_validators = True
+        self.server = HTTPServer(("127.0.0.1", 0), ConditionalHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.downloader = http.HTTPDownloader(max_retries=0)
+        self.output_path = osp.join(self.tmpdir, "metadata.tsv")
+
+    def tearDown(self):
+        self.downloader.close()
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestCache, self).tearDown()
+
+    def testNormalizeURL(self):
+        self.assertEqual(cache.normalize_url("https://www.ENCODEproject.org/batch_download/b=2&a=1"),
+                         cache.normalize_url("https://www.encodeproject.org/batch_download/a=1&b=2"))
+        self.assertEqual(cache.normalize_url("https://www.encodeproject.org/metadata/?b=2&a=1"),
+                         cache.normalize_url("https://www.encodeproject.org/metadata/?a=1&b=2"))
+        self.assertNotEqual(cache.normalize_url("https://www.encodeproject.org/batch_download/a=1"),
+                            cache.normalize_url("https://www.encodeproject.org/batch_download/a=2"))
+
+    def testFetchFreshEntrySkipsNetwork(self):
+        try:
+            metadata_cache = cache.MetadataCache(osp.join(self.tmpdir, "cache"), ttl=60 * 60)
+            url = "/".join([self.base_url, "batch_download", "type=Experiment"])
+            self.assertFalse(metadata_cache.fetch(url, self.output_path, self.downloader))
+            self.assertTrue(metadata_cache.fetch(url, self.output_path, self.downloader))
+            self.assertEqual(1, len(ConditionalHandler.requests_seen))
+            with open(self.output_path, "rb") as f:
+                self.assertEqual(PAYLOAD, f.read())
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testFetchStaleEntryRevalidates(self):
+        try:
+            # Entries are revalidated on every use by default.
+            metadata_cache = cache.MetadataCache(osp.join(self.tmpdir, "cache"))
+            url = "/".join([self.base_url, "batch_download", "type=Experiment"])
+            self.assertFalse(metadata_cache.fetch(url, self.output_path, self.downloader))
+            os.remove(self.output_path)
+            self.assertTrue(metadata_cache.fetch(url, self.output_path, self.downloader))
+            self.assertEqual(2, len(ConditionalHandler.requests_seen))
+            with open(self.output_path, "rb") as f:
+                self.assertEqual(PAYLOAD, f.read())
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testResponseWithoutValidatorsIsNotCached(self):
+        try:
+            ConditionalHandler.send_validators = False
+            metadata_cache = cache.MetadataCache(osp.join(self.tmpdir, "cache"))
+            url = "/".join([self.base_url, "batch_download", "type=Experiment"])
+            for _ in range(2):
+                self.assertFalse(metadata_cache.fetch(url, self.output_path, self.downloader))
+                with open(self.output_path, "rb") as f:
+                    self.assertEqual(PAYLOAD, f.read())
+            self.assertEqual(0, metadata_cache.size())
+
+            # With a TTL the response is served from the cache until it expires.
+            metadata_cache = cache.MetadataCache(osp.join(self.tmpdir, "cache"), ttl=60 * 60)
+            self.assertFalse(metadata_cache.fetch(url, self.output_path, self.downloader))
+            self.assertTrue(metadata_cache.fetch(url, self.output_path, self.downloader))
+            self.assertEqual(3, len(ConditionalHandler.requests_seen))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testEvictLeastRecentlyUsed(self):
+        try:
+            metadata_cache = cache.MetadataCache(osp.join(self.tmpdir, "cache"), max_size=len(PAYLOAD) * 2)
+            for query in ("a=1", "a=2", "a=1", "a=3"):
+                url = "/".join([self.base_url, "batch_download", query])
+                metadata_cache.fetch(url, self.output_path, self.downloader)
+            urls = set(entry["url"].split("/")[-1] for _, entry in metadata_cache.entries())
+            self.assertEqual({"a=1", "a=3"}, urls)
+            metadata_cache.purge()
+            self.assertEqual(0, metadata_cache.size())
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
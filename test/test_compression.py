@@ -0,0 +1,194 @@
+import os
+import os.path as osp
+import io
+import bz2
+import gzip
+import hashlib
+import json
+import random
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+import zipfile
+import zlib
+from encode2bag import encode2bag_api as e2b
+from encode2bag import compression
+from encode2bag import bag_utils
+from encode2bag import get_named_exception as gne
+
+
+def make_data(size, seed=0):
+    # Compressible but non-trivial data: random words from a small vocabulary.
+    rng = random.Random(seed)
+    words = [b"ACGT", b"TTAGGG", b"chr1", b"\t", b"\n", b"ENCFF000AAA", b"12345", b"peak"]
+    chunks = list()
+    total = 0
+    while total < size:
+        word = rng.choice(words)
+        chunks.append(word)
+        total += len(word)
+    return b''.join(chunks)[:size]
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        super(TestCompression, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.metadata_file = osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestCompression, self).tearDown()
+
+    def testParallelDeflateRoundTrip(self):
+        data = make_data(5 * 1024 * 1024 + 123)
+        for workers in (1, 4):
+            compressor = compression.ParallelDeflateCompressor(level=6, workers=workers, block_size=256 * 1024)
+            compressed = b''.join(compressor.compress(data[i:i + 100000]) for i in range(0, len(data), 100000))
+            compressed += compressor.flush()
+            self.assertEqual(data, zlib.decompress(compressed, -zlib.MAX_WBITS))
+            self.assertLess(len(compressed), len(data) // 2)
+
+    def testParallelGzipReadableByGzip(self):
+        data = make_data(3 * 1024 * 1024)
+        output = io.BytesIO()
+        writer = compression.ParallelGzipWriter(output, level=1, workers=4, block_size=128 * 1024)
+        writer.write(data[:1000])
+        writer.write(data[1000:])
+        writer.close()
+        self.assertEqual(data, gzip.GzipFile(fileobj=io.BytesIO(output.getvalue())).read())
+        path = osp.join(self.tmpdir, "data.gz")
+        with open(path, "wb") as f:
+            f.write(output.getvalue())
+        try:
+            self.assertEqual(data, subprocess.check_output(["gzip", "-dc", path]))
+        except OSError:
+            pass
+
+    def _create_archive(self, archive_format, stream_archive, level=None):
+        return e2b.create_bag_from_metadata_file(self.metadata_file,
+                                                 output_path=self.tmpdir,
+                                                 output_name="bag_%s_%s" % (archive_format, stream_archive),
+                                                 archive_format=archive_format,
+                                                 create_ro_manifest=True,
+                                                 stream_archive=stream_archive,
+                                                 compression_level=level,
+                                                 compression_workers=4)
+
+    def testParallelTgzArchive(self):
+        try:
+            for stream_archive in (False, True):
+                archive_path = self._create_archive("tgz", stream_archive, level=9)
+                names = tarfile.open(archive_path, "r:gz").getnames()
+                self.assertIn("bag_tgz_%s/data/metadata-1.tsv" % stream_archive, names)
+                self.assertIn("bag_tgz_%s/metadata/manifest.json" % stream_archive, names)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testParallelZipArchive(self):
+        try:
+            metadata_file = osp.join(self.tmpdir, "metadata-large.tsv")
+            with open(self.metadata_file, "rb") as source, open(metadata_file, "wb") as target:
+                header = source.readline()
+                rows = source.read()
+                target.write(header)
+                # Repeat the rows to get a payload file spanning several compression blocks.
+                for _ in range(3 * compression.COMPRESSION_BLOCK_SIZE // len(rows) + 1):
+                    target.write(rows)
+            self.metadata_file = metadata_file
+            archive_path = self._create_archive("zip", True)
+            with zipfile.ZipFile(archive_path) as archive:
+                self.assertIsNone(archive.testzip())
+                with open(metadata_file, "rb") as f:
+                    self.assertEqual(f.read(), archive.read("bag_zip_True/data/metadata-large.tsv"))
+        except Exception as e:
+            self.fail(gne(e))
+
+    @unittest.skipIf(compression.zstandard is None, "zstandard is not installed")
+    def testZstdArchive(self):
+        try:
+            archive_path = self._create_archive("tzst", False)
+            with open(archive_path, "rb") as f:
+                data = compression.zstandard.ZstdDecompressor().stream_reader(f).read()
+            self.assertIn("bag_tzst_False/fetch.txt",
+                          tarfile.open(fileobj=io.BytesIO(data), mode="r:").getnames())
+        except Exception as e:
+            self.fail(gne(e))
+
+
+    def _write_compressed_metadata(self, name, opener):
+        with open(self.metadata_file, "rb") as source:
+            data = source.read()
+        path = osp.join(self.tmpdir, name)
+        with opener(path, "wb") as output:
+            output.write(data)
+        return path, data
+
+    def testConvertCompressedMetadata(self):
+        try:
+            openers = [("metadata-1.tsv.gz", gzip.open, "gzip"), ("metadata-1.tsv.bz2", bz2.BZ2File, "bz2")]
+            if compression.lzma is not None:
+                openers.append(("metadata-1.tsv.xz", compression.lzma.open, "xz"))
+            with open(osp.join("test", "test_data", "rfm-1.json"), "rb") as f:
+                expected = f.read()
+            for name, opener, expected_compression in openers:
+                path, _ = self._write_compressed_metadata(name, opener)
+                self.assertEqual(expected_compression, compression.get_file_compression(path))
+                output_path = osp.join(self.tmpdir, "rfm.json")
+                e2b.convert_tsv_metadata_to_remote_file_manifest(path, output_path)
+                with open(output_path, "rb") as f:
+                    self.assertEqual(expected, f.read())
+            self.assertIsNone(compression.get_file_compression(self.metadata_file))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateBagFromCompressedMetadata(self):
+        try:
+            path, data = self._write_compressed_metadata("metadata-1.tsv.gz", gzip.open)
+            bag_path = e2b.create_bag_from_metadata_file(path, output_path=self.tmpdir, output_name="original")
+            manifest = bag_utils.read_payload_manifests(bag_path)["md5"]
+            self.assertIn("data/metadata-1.tsv.gz", manifest)
+            self.assertEqual(bag_utils.compute_file_checksums(path, ["md5"])["md5"],
+                             manifest["data/metadata-1.tsv.gz"])
+            bag_path = e2b.create_bag_from_metadata_file(path, output_path=self.tmpdir, output_name="decompressed",
+                                                         create_ro_manifest=True, decompress_metadata=True)
+            with open(osp.join(bag_path, "data", "metadata-1.tsv"), "rb") as f:
+                self.assertEqual(data, f.read())
+            self.assertIn("data/metadata-1.tsv", bag_utils.read_payload_manifests(bag_path)["md5"])
+            with open(osp.join(bag_path, "metadata", "manifest.json")) as f:
+                self.assertEqual("../data/metadata-1.tsv", json.load(f)["annotations"][0]["content"])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateBagFromStream(self):
+        try:
+            path, _ = self._write_compressed_metadata("metadata-1.tsv.gz", gzip.open)
+            with open(path, "rb") as f:
+                bag_path = e2b.create_bag_from_metadata_file(e2b.STDIN_PATH, output_path=self.tmpdir,
+                                                             output_name="stdin", metadata_stream=f)
+            self.assertEqual(28, len(bag_utils.read_fetch_file(bag_path)))
+            with open(osp.join(bag_path, "data", "metadata.tsv.gz"), "rb") as f, open(path, "rb") as g:
+                self.assertEqual(g.read(), f.read())
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testStreamArchiveDecompressedMetadata(self):
+        try:
+            path, data = self._write_compressed_metadata("metadata-1.tsv.bz2", bz2.BZ2File)
+            archive_path = e2b.create_bag_from_metadata_file(path, output_path=self.tmpdir, output_name="streamed",
+                                                             archive_format="tgz", stream_archive=True,
+                                                             decompress_metadata=True)
+            with tarfile.open(archive_path) as archive:
+                self.assertEqual(data, archive.extractfile("streamed/data/metadata-1.tsv").read())
+                manifest = archive.extractfile("streamed/manifest-md5.txt").read().decode("utf-8")
+            self.assertIn("%s  data/metadata-1.tsv\n" % hashlib.md5(data).hexdigest(), manifest)
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
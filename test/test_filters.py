@@ -0,0 +1,121 @@
+import os
+import os.path as osp
+import csv
+import json
+import shutil
+import tempfile
+import unittest
+from encode2bag import encode2bag_api as e2b
+from encode2bag import bag_utils
+from encode2bag import filters
+from encode2bag import get_named_exception as gne
+
+
+class TestFilters(unittest.TestCase):
+
+    def setUp(self):
+        super(TestFilters, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.metadata_file = osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))
+        with open(self.metadata_file) as metadata:
+            self.rows = list(csv.DictReader(metadata, delimiter='\t'))
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestFilters, self).tearDown()
+
+    def testColumnPredicate(self):
+        try:
+            predicate = filters.ColumnPredicate.parse("Output type=reads, raw *")
+            self.assertEqual("Output type", predicate.column)
+            self.assertTrue(predicate.matches("reads"))
+            self.assertTrue(predicate.matches("raw signal"))
+            self.assertFalse(predicate.matches("alignments"))
+            self.assertFalse(predicate.matches("Reads"))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testInvalidExpression(self):
+        with self.assertRaises(RuntimeError):
+            filters.RowFilter(include=["fastq"])
+
+    def testFilterMetadataFile(self):
+        try:
+            row_filter = filters.RowFilter(include=["File format=fastq"], max_size=2 * 1024 ** 3)
+            output_path = osp.join(self.tmpdir, "metadata-1.tsv")
+            count = filters.filter_metadata_file(self.metadata_file, output_path, row_filter)
+            expected = [row for row in self.rows if row["File format"] == "fastq" and int(row["Size"]) <= 2 * 1024 ** 3]
+            self.assertEqual(11, count)
+            with open(output_path) as metadata:
+                self.assertEqual(expected, list(csv.DictReader(metadata, delimiter='\t')))
+            self.assertEqual(expected, [row for row in self.rows if row_filter.matches(row)])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testFilterQuotedMultiLineRecords(self):
+        try:
+            with open(self.metadata_file) as metadata:
+                lines = metadata.readlines()
+            header = lines[0].rstrip("\n").split("\t")
+            fields = lines[1].rstrip("\n").split("\t")
+            fields[0] = '"%s\nsecond line"' % fields[0]
+            quoted_path = osp.join(self.tmpdir, "quoted.tsv")
+            with open(quoted_path, "w") as metadata:
+                metadata.writelines([lines[0], "\t".join(fields) + "\n"] + lines[2:])
+            row_filter = filters.RowFilter(include=["File format=%s" % fields[header.index("File format")]])
+            output_path = osp.join(self.tmpdir, "filtered.tsv")
+            count = filters.filter_metadata_file(quoted_path, output_path, row_filter)
+            with open(quoted_path) as metadata:
+                expected = [row for row in csv.DictReader(metadata, delimiter='\t') if row_filter.matches(row)]
+            self.assertEqual(len(expected), count)
+            with open(output_path) as metadata:
+                self.assertEqual(expected, list(csv.DictReader(metadata, delimiter='\t')))
+            self.assertIn("\nsecond line", expected[0][header[0]])
+
+            # A short row is reported with its line number.
+            with open(quoted_path, "a") as metadata:
+                metadata.write("a\n")
+            with self.assertRaises(RuntimeError) as context:
+                filters.filter_metadata_file(quoted_path, output_path, row_filter)
+            self.assertIn("line %d " % (len(lines) + 2), str(context.exception))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testConvertWithFilter(self):
+        try:
+            row_filter = filters.RowFilter(exclude=["Output type=reads,alignments"], min_size=10 * 1024 ** 2)
+            rfm_path = osp.join(self.tmpdir, "remote-file-manifest.json")
+            e2b.convert_tsv_metadata_to_remote_file_manifest(self.metadata_file, rfm_path, row_filter=row_filter)
+            with open(rfm_path) as rfm:
+                entries = json.load(rfm)
+            expected = [row[e2b.ENCODE_FILE_URL] for row in self.rows
+                        if row["Output type"] not in ("reads", "alignments") and int(row["Size"]) >= 10 * 1024 ** 2]
+            self.assertEqual(expected, [entry["url"] for entry in entries])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateBagWithFilter(self):
+        try:
+            bag_path = e2b.create_bag_from_metadata_file(self.metadata_file,
+                                                         output_path=self.tmpdir,
+                                                         output_name="filtered",
+                                                         create_ro_manifest=True,
+                                                         row_filter=filters.RowFilter(include=["File format=bam"]))
+            fetch = bag_utils.read_fetch_file(bag_path)
+            self.assertEqual(4, len(fetch))
+            with open(osp.join(bag_path, "data", "metadata-1.tsv")) as metadata:
+                self.assertEqual(["bam"] * 4, [row["File format"] for row in csv.DictReader(metadata, delimiter='\t')])
+            with open(osp.join(bag_path, "metadata", "manifest.json")) as ro_manifest:
+                self.assertEqual(4, len(json.load(ro_manifest)["aggregates"]))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testUnknownColumn(self):
+        with self.assertRaises(RuntimeError):
+            e2b.create_bag_from_metadata_file(self.metadata_file, output_path=self.tmpdir,
+                                              row_filter=filters.RowFilter(include=["File Status=released"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import os
+import os.path as osp
+import sys
+import logging
+import shutil
+import tempfile
+import threading
+import unittest
+from encode2bag import http_client as http
+from encode2bag import get_named_exception as gne
+
+if sys.version_info > (3,):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger()
+
+PAYLOAD = b"0123456789" * 1000
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    failures = 0
+    truncate_once = False
+    requests_seen = list()
+    etag = None
+    etag_after_truncate = None
+    if_ranges_seen = list()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        FlakyHandler.requests_seen.append(self.headers.get("Range"))
+        if FlakyHandler.failures > 0:
+            FlakyHandler.failures -= 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start = 0
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        FlakyHandler.if_ranges_seen.append(if_range)
+        if range_header and (if_range is None or if_range == FlakyHandler.etag):
+            start = int(range_header.split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(PAYLOAD) - 1, len(PAYLOAD)))
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:]
+        if FlakyHandler.etag:
+            self.send_header("ETag", FlakyHandler.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if FlakyHandler.truncate_once:
+            FlakyHandler.truncate_once = False
+            FlakyHandler.etag = FlakyHandler.etag_after_truncate or FlakyHandler.etag
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class TestHTTP(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHTTP, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        FlakyHandler.failures = 0
+        FlakyHandler.truncate_once = False
+        FlakyHandler.requests_seen = list()
+        FlakyHandler.etag = None
+        FlakyHandler.etag_after_truncate = None
+        FlakyHandler.if_ranges_seen = list()
+        self.server = HTTPServer(("127.0.0.1", 0), FlakyHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/files/payload.bin" % self.server.server_address[1]
+        self.downloader = http.HTTPDownloader(connect_timeout=2, read_timeout=2, max_retries=3, backoff_factor=0.01,
+                                              chunk_size=1024)
+
+    def tearDown(self):
+        self.downloader.close()
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestHTTP, self).tearDown()
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def testDownload(self):
+        try:
+            output_path = osp.join(self.tmpdir, "payload.bin")
+            self.downloader.download(self.url, output_path)
+            self.assertEqual(PAYLOAD, self._read(output_path))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testDownloadRetryOnServerError(self):
+        try:
+            FlakyHandler.failures = 2
+            output_path = osp.join(self.tmpdir, "payload.bin")
+            self.downloader.download(self.url, output_path)
+            self.assertEqual(PAYLOAD, self._read(output_path))
+            self.assertEqual(3, len(FlakyHandler.requests_seen))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testDownloadRetriesExhausted(self):
+        FlakyHandler.failures = 10
+        output_path = osp.join(self.tmpdir, "payload.bin")
+        self.assertRaises(http.HTTPTransferError, self.downloader.download, self.url, output_path)
+
+    def testDownloadResumePartialFile(self):
+        try:
+            output_path = osp.join(self.tmpdir, "payload.bin")
+            with open(output_path, "wb") as f:
+                f.write(PAYLOAD[:1234])
+            self.downloader.download(self.url, output_path, resume=True)
+            self.assertEqual(PAYLOAD, self._read(output_path))
+            self.assertEqual(["bytes=1234-"], FlakyHandler.requests_seen)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testDownloadResumeAfterTruncatedTransfer(self):
+        try:
+            FlakyHandler.truncate_once = True
+            output_path = osp.join(self.tmpdir, "payload.bin")
+            self.downloader.download(self.url, output_path)
+            self.assertEqual(PAYLOAD, self._read(output_path))
+            self.assertEqual(2, len(FlakyHandler.requests_seen))
+            self.assertIsNotNone(FlakyHandler.requests_seen[1])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testDownloadResumeWithIfRange(self):
+        try:
+            FlakyHandler.truncate_once = True
+            FlakyHandler.etag = '"v1"'
+            output_path = osp.join(self.tmpdir, "payload.bin")
+            self.downloader.download(self.url, output_path)
+            self.assertEqual(PAYLOAD, self._read(output_path))
+            self.assertEqual([None, '"v1"'], FlakyHandler.if_ranges_seen)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testDownloadRestartsWhenFileChanged(self):
+        try:
+            # The file changes on the server after the first transfer is interrupted, so the resumed request is
+            # answered with the whole new file, which replaces the partial one.
+            FlakyHandler.truncate_once = True
+            FlakyHandler.etag = '"v1"'
+            FlakyHandler.etag_after_truncate = '"v2"'
+            output_path = osp.join(self.tmpdir, "payload.bin")
+            self.downloader.download(self.url, output_path)
+            self.assertEqual(PAYLOAD, self._read(output_path))
+            self.assertEqual([None, '"v1"'], FlakyHandler.if_ranges_seen)
+            self.assertIsNotNone(FlakyHandler.requests_seen[1])
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import os.path as osp
+import sys
+import json
+import subprocess
+import unittest
+from encode2bag import get_named_exception as gne
+
+STARTUP_SCRIPT = """
+import sys
+import json
+sys.argv = ["encode2bag", "--help"]
+from encode2bag import encode2bag_cli
+try:
+    encode2bag_cli.parse_cli()
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+"""
+
+
+class TestImports(unittest.TestCase):
+
+    def testCLIStartupDoesNotImportStageDependencies(self):
+        try:
+            env = dict(os.environ)
+            env["PYTHONPATH"] = os.pathsep.join(filter(None, [osp.abspath("."), env.get("PYTHONPATH")]))
+            process = subprocess.Popen([sys.executable, "-c", STARTUP_SCRIPT], env=env,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _, err = process.communicate()
+            modules = set(json.loads(err.decode("utf-8")))
+            self.assertIn("encode2bag.encode2bag_api", modules)
+            for module in ("requests", "bdbag", "bdbag.bdbag_ro", "encode2bag.archive_stream",
+                           "encode2bag.ro_manifest"):
+                self.assertNotIn(module, modules)
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
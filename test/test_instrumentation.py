@@ -0,0 +1,91 @@
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+import json
+from encode2bag import encode2bag_api as e2b
+from encode2bag import instrumentation as inst
+from encode2bag import batch
+from encode2bag.mock_server import MockENCODEServer
+from encode2bag import get_named_exception as gne
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        super(TestInstrumentation, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.metadata_file = osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestInstrumentation, self).tearDown()
+
+    def testStagesFromMetadataFile(self):
+        try:
+            with inst.collect() as metrics:
+                e2b.create_bag_from_metadata_file(self.metadata_file,
+                                                  output_path=self.tmpdir,
+                                                  archive_format="tgz",
+                                                  create_ro_manifest=True)
+            stages = dict((record.name, record) for record in metrics.stages)
+            self.assertEqual(["tsv_parse", "rfm_write", "ro_build", "make_bag", "ro_update", "archive"],
+                             [record.name for record in metrics.stages])
+            self.assertEqual(28, stages["tsv_parse"].rows)
+            self.assertEqual(osp.getsize(self.metadata_file), stages["tsv_parse"].bytes)
+            self.assertEqual(28, stages["ro_build"].rows)
+            self.assertTrue(stages["archive"].bytes > 0)
+            for record in metrics.stages:
+                self.assertTrue(record.wall_time >= 0)
+            self.assertIsNone(inst.get_metrics())
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testStagesFromURL(self):
+        try:
+            with MockENCODEServer(rows=5) as server, inst.collect() as metrics:
+                e2b.create_bag_from_url(server.search_url("type=Experiment"), output_path=self.tmpdir,
+                                        use_cache=False)
+            stages = dict((record.name, record) for record in metrics.stages)
+            self.assertTrue(stages["manifest_fetch"].bytes > 0)
+            self.assertTrue(stages["metadata_fetch"].bytes > 0)
+            self.assertEqual(5, stages["rfm_write"].rows)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testReports(self):
+        try:
+            with inst.collect() as metrics:
+                e2b.create_bag_from_metadata_file(self.metadata_file, output_path=self.tmpdir)
+                inst.record("make_bag", 0.5, bytes=10)
+            report_path = osp.join(self.tmpdir, "report.json")
+            metrics.write_json_report(report_path)
+            with open(report_path) as f:
+                report = json.load(f)
+            self.assertEqual(len(metrics.stages), len(report["stages"]))
+            textfile_path = osp.join(self.tmpdir, "encode2bag.prom")
+            metrics.write_prometheus_textfile(textfile_path)
+            with open(textfile_path) as f:
+                lines = f.read().splitlines()
+            self.assertIn("# TYPE encode2bag_stage_duration_seconds gauge", lines)
+            make_bag_bytes = [line for line in lines if line.startswith('encode2bag_stage_bytes{stage="make_bag"}')]
+            self.assertEqual(['encode2bag_stage_bytes{stage="make_bag"} 10'], make_bag_bytes)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testBatchStagesMerged(self):
+        try:
+            items = [{"line": 1, "source": self.metadata_file, "output_name": "bag1"},
+                     {"line": 2, "source": self.metadata_file, "output_name": "bag2"}]
+            with inst.collect() as metrics:
+                results = batch.create_bags_from_batch(items, output_path=self.tmpdir, workers=2)
+            self.assertEqual(["tsv_parse", "rfm_write", "make_bag"], [s["stage"] for s in results[0]["stages"]])
+            self.assertEqual(2, len([record for record in metrics.stages if record.name == "make_bag"]))
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
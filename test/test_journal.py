@@ -0,0 +1,167 @@
+import os
+import os.path as osp
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import bagit
+from encode2bag import encode2bag_api as e2b
+from encode2bag import http_client as http
+from encode2bag import journal as jnl
+from encode2bag.mock_server import MockENCODEServer
+from encode2bag import get_named_exception as gne
+
+QUERY = "type=Experiment&mock_rows=6"
+
+
+class InterruptingDownloader(http.HTTPDownloader):
+    # Interrupts every payload transfer after the first chunk, leaving a partial file behind.
+
+    def download(self, url, output_path, resume=False, headers=None, callback=None, offset_callback=None):
+        if "/files/" not in url:
+            return super(InterruptingDownloader, self).download(url, output_path, resume, headers, callback,
+                                                                offset_callback)
+
+        def interrupt(chunk):
+            raise RuntimeError("Interrupted transfer of %s" % url)
+        return super(InterruptingDownloader, self).download(url, output_path, resume, headers, interrupt,
+                                                            offset_callback)
+
+
+class LimitedDownloader(InterruptingDownloader):
+    # Completes the first `limit` payload transfers and interrupts the rest.
+
+    def __init__(self, limit, **kwargs):
+        super(LimitedDownloader, self).__init__(**kwargs)
+        self.limit = limit
+        self.lock = threading.Lock()
+
+    def download(self, url, output_path, resume=False, headers=None, callback=None, offset_callback=None):
+        with self.lock:
+            interrupt = "/files/" in url and self.limit <= 0
+            if "/files/" in url:
+                self.limit -= 1
+        download = super(LimitedDownloader, self).download if interrupt else \
+            super(InterruptingDownloader, self).download
+        return download(url, output_path, resume, headers, callback, offset_callback)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.bag_path = osp.join(self.tmpdir, "bag")
+        self.journal_path = jnl.get_journal_path(self.bag_path)
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestJournal, self).tearDown()
+
+    def readJournal(self):
+        with open(osp.join(self.journal_path, jnl.JOURNAL_FILE_NAME)) as journal:
+            return json.load(journal)
+
+    def createBag(self, server, **kwargs):
+        return e2b.create_bag_from_url(server.search_url(QUERY), output_path=self.tmpdir, output_name="bag",
+                                       use_cache=False, materialize=True, create_ro_manifest=True, **kwargs)
+
+    def testResumeMaterializedBag(self):
+        try:
+            with MockENCODEServer(payload_size_range=(4096, 16 * 1024)) as server:
+                with self.assertRaises(RuntimeError):
+                    self.createBag(server, resume=True, downloader=InterruptingDownloader(chunk_size=1024))
+                state = self.readJournal()
+                self.assertEqual({"metadata_fetch", "convert", "bag_path", "make_bag", "ro_update"},
+                                 set(state["stages"].keys()))
+                offsets = state["partial"]["materialize"]
+                self.assertEqual(6, len(offsets))
+                self.assertEqual([1024] * 6, list(offsets.values()))
+
+                manifest_requests = len([r for r in server.request_log if r.startswith("/batch_download/")])
+                bag_path = self.createBag(server, resume=True)
+                self.assertEqual(manifest_requests,
+                                 len([r for r in server.request_log if r.startswith("/batch_download/")]))
+            self.assertEqual(self.bag_path, bag_path)
+            bagit.Bag(bag_path).validate()
+            self.assertTrue(osp.isfile(osp.join(bag_path, "metadata", "manifest.json")))
+            self.assertFalse(osp.exists(self.journal_path))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testNoJournalWithoutResume(self):
+        try:
+            with MockENCODEServer(payload_size_range=(4096, 16 * 1024)) as server:
+                with self.assertRaises(RuntimeError):
+                    self.createBag(server, downloader=InterruptingDownloader(chunk_size=1024))
+            self.assertFalse(osp.exists(self.journal_path))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testResumeRequiresMatchingBuild(self):
+        try:
+            with MockENCODEServer(payload_size_range=(4096, 16 * 1024)) as server:
+                with self.assertRaises(RuntimeError):
+                    self.createBag(server, resume=True, downloader=InterruptingDownloader(chunk_size=1024))
+                self.assertTrue(self.readJournal()["stages"])
+                # A different build of the same bag discards the journal and starts over.
+                with self.assertRaises(RuntimeError):
+                    self.createBag(server, archive_format="zip", resume=True,
+                                   downloader=InterruptingDownloader(chunk_size=1024))
+                state = self.readJournal()
+                self.assertEqual("zip", state["parameters"]["archive_format"])
+                # The bag directory of the discarded build is moved aside like any existing bag.
+                self.assertTrue(any(name.startswith("bag_") for name in os.listdir(self.tmpdir)))
+                archive_path = self.createBag(server, archive_format="zip", resume=True)
+            self.assertEqual(''.join([self.bag_path, ".zip"]), archive_path)
+            self.assertTrue(osp.isfile(archive_path))
+            self.assertFalse(osp.exists(self.journal_path))
+            with self.assertRaises(RuntimeError):
+                e2b.create_bag_from_metadata_file(osp.join("test", "test_data", "metadata-1.tsv"), resume=True)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testResumeShardedBags(self):
+        try:
+            with MockENCODEServer(payload_size_range=(4096, 16 * 1024)) as server:
+                metadata_path = osp.join(self.tmpdir, "metadata")
+                os.makedirs(metadata_path)
+                metadata_file = e2b.retrieve_encode_metadata_file_by_url(server.search_url(QUERY), metadata_path,
+                                                                         use_cache=False)
+
+                def create_bags(**kwargs):
+                    return e2b.create_bag_from_metadata_file(metadata_file, output_path=self.tmpdir,
+                                                             output_name="bag", materialize=True, shard_max_files=2,
+                                                             shard_workers=1, resume=True, **kwargs)
+                # With a single shard worker, the first shard completes and the other two are interrupted.
+                with self.assertRaises(RuntimeError):
+                    create_bags(downloader=LimitedDownloader(2, chunk_size=1024))
+                state = self.readJournal()
+                self.assertIn("shard_partition", state["stages"])
+                self.assertEqual(["shard:bag_shard-00001"], [s for s in state["stages"] if s.startswith("shard:")])
+                first_shard = osp.join(self.tmpdir, "bag_shard-00001")
+                first_shard_mtime = os.stat(osp.join(first_shard, "bagit.txt")).st_mtime
+                for number in (2, 3):
+                    with open(osp.join(jnl.get_journal_path(osp.join(self.tmpdir, "bag_shard-%05d" % number)),
+                                       jnl.JOURNAL_FILE_NAME)) as journal:
+                        self.assertEqual(2, len(json.load(journal)["partial"]["materialize"]))
+
+                del server.request_log[:]
+                bag_path = create_bags()
+                # Only the payload of the two interrupted shards is transferred again.
+                self.assertEqual(4, len([r for r in server.request_log if r.startswith("/files/")]))
+            self.assertEqual(self.bag_path, bag_path)
+            self.assertEqual(first_shard_mtime, os.stat(osp.join(first_shard, "bagit.txt")).st_mtime)
+            # No shard bag was moved aside, and all journals are removed.
+            self.assertEqual(sorted(["bag", "bag_shard-00001", "bag_shard-00002", "bag_shard-00003",
+                                     "metadata"]), sorted(os.listdir(self.tmpdir)))
+            for number in (1, 2, 3):
+                bagit.Bag(osp.join(self.tmpdir, "bag_shard-%05d" % number)).validate()
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
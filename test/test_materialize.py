@@ -0,0 +1,129 @@
+import os
+import os.path as osp
+import sys
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import bagit
+from encode2bag import encode2bag_api as e2b
+from encode2bag import http_client as http
+from encode2bag import materialize as mat
+from encode2bag import get_named_exception as gne
+
+if sys.version_info > (3,):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+FILES = {"ENCFF000AAA.fastq.gz": b"@read1\nACGT\n+\nIIII\n" * 500,
+         "ENCFF000AAB.bam": b"BAM\x01" + b"\x00\x01\x02\x03" * 3000,
+         "ENCFF000AAC.bigWig": b"bigwig" * 700}
+
+
+class FileHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = FILES.get(self.path.split("/")[-1])
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        range_header = self.headers.get("Range")
+        if range_header:
+            start = int(range_header.split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(body) - 1, len(body)))
+            body = body[start:]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestMaterialize(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMaterialize, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.server = HTTPServer(("127.0.0.1", 0), FileHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = "http://127.0.0.1:%d/files" % self.server.server_address[1]
+        self.downloader = http.HTTPDownloader(max_retries=0)
+
+    def tearDown(self):
+        self.downloader.close()
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestMaterialize, self).tearDown()
+
+    def _write_metadata(self, corrupt=None):
+        metadata_file = osp.join(self.tmpdir, "metadata.tsv")
+        with open(metadata_file, "w") as f:
+            f.write("File accession\tFile format\tSize\tmd5sum\tFile download URL\n")
+            for filename, body in sorted(FILES.items()):
+                md5 = hashlib.md5(body).hexdigest() if filename != corrupt else "0" * 32
+                f.write("%s\t%s\t%d\t%s\t%s/%s\n" %
+                        (filename.split(".")[0], filename.split(".", 1)[1], len(body), md5, self.base_url, filename))
+        return metadata_file
+
+    def testCreateMaterializedBag(self):
+        try:
+            bag_path = e2b.create_bag_from_metadata_file(self._write_metadata(),
+                                                         output_name="materialized",
+                                                         output_path=self.tmpdir,
+                                                         downloader=self.downloader,
+                                                         materialize=True,
+                                                         materialize_workers=2)
+            for filename, body in FILES.items():
+                with open(osp.join(bag_path, "data", filename), "rb") as f:
+                    self.assertEqual(body, f.read())
+            bagit.Bag(bag_path).validate()
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testMaterializeResumesPartialFile(self):
+        try:
+            e2b.convert_tsv_metadata_to_remote_file_manifest(self._write_metadata(),
+                                                             osp.join(self.tmpdir, "rfm.json"))
+            data_path = osp.join(self.tmpdir, "bag", "data")
+            os.makedirs(data_path)
+            with open(osp.join(data_path, "ENCFF000AAB.bam"), "wb") as f:
+                f.write(FILES["ENCFF000AAB.bam"][:5000])
+            summary = mat.materialize_bag_payload(osp.join(self.tmpdir, "bag"), osp.join(self.tmpdir, "rfm.json"),
+                                                  downloader=self.downloader)
+            self.assertEqual(3, summary["files"])
+            self.assertEqual(sum(len(b) for b in FILES.values()) - 5000, summary["bytes_transferred"])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testMaterializeChecksumMismatch(self):
+        e2b.convert_tsv_metadata_to_remote_file_manifest(self._write_metadata(corrupt="ENCFF000AAC.bigWig"),
+                                                         osp.join(self.tmpdir, "rfm.json"))
+        bag_path = osp.join(self.tmpdir, "bag")
+        self.assertRaises(RuntimeError, mat.materialize_bag_payload, bag_path, osp.join(self.tmpdir, "rfm.json"),
+                          downloader=self.downloader)
+        self.assertFalse(osp.exists(osp.join(bag_path, "data", "ENCFF000AAC.bigWig")))
+        self.assertTrue(osp.isfile(osp.join(bag_path, "data", "ENCFF000AAB.bam")))
+
+    def testRateLimiter(self):
+        limiter = mat.RateLimiter(100000)
+        start = time.time()
+        for _ in range(5):
+            limiter.consume(50000)
+        self.assertGreaterEqual(time.time() - start, 1.4)
+
+
+if __name__ == '__main__':
+    unittest.main()
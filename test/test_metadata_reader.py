@@ -0,0 +1,119 @@
+import os
+import os.path as osp
+import csv
+import io
+import json
+import shutil
+import tempfile
+import unittest
+from encode2bag import encode2bag_api as e2b
+from encode2bag import filters
+from encode2bag.metadata_reader import MetadataReader
+from encode2bag import get_named_exception as gne
+
+COLUMNS = [e2b.ENCODE_FILE_URL, e2b.ENCODE_FILE_SIZE, e2b.ENCODE_FILE_MD5SUM, e2b.ENCODE_FILE_FORMAT]
+
+
+class TestMetadataReader(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMetadataReader, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.metadata_file = osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestMetadataReader, self).tearDown()
+
+    def readDictRows(self, path):
+        with open(path) as metadata:
+            return [tuple(row[c] for c in COLUMNS) for row in csv.DictReader(metadata, delimiter='\t')]
+
+    def testProjectedRecords(self):
+        try:
+            with open(self.metadata_file) as metadata:
+                records = list(MetadataReader(metadata, COLUMNS, e2b.REQUIRED_COLUMNS))
+            self.assertEqual(self.readDictRows(self.metadata_file), records)
+            with open(self.metadata_file) as metadata:
+                self.assertEqual([(r[2],) for r in records], list(MetadataReader(metadata, [e2b.ENCODE_FILE_MD5SUM])))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testQuotedFields(self):
+        try:
+            with open(self.metadata_file) as metadata:
+                lines = metadata.readlines()
+            header = lines[0].rstrip("\n").split("\t")
+            fields = lines[1].rstrip("\n").split("\t")
+            fields[header.index(e2b.ENCODE_FILE_FORMAT)] = '"bed\tnarrowPeak"'
+            quoted_path = osp.join(self.tmpdir, "quoted.tsv")
+            with open(quoted_path, "w") as metadata:
+                metadata.writelines([lines[0], "\t".join(fields) + "\n", "\n"] + lines[2:])
+            with open(quoted_path) as metadata:
+                records = list(MetadataReader(metadata, COLUMNS))
+            self.assertEqual(self.readDictRows(quoted_path), records)
+            self.assertEqual("bed\tnarrowPeak", records[0][3])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testQuotedMultiLineFields(self):
+        try:
+            with open(self.metadata_file) as metadata:
+                lines = metadata.readlines()
+            header = lines[0].rstrip("\n").split("\t")
+            fields = lines[1].rstrip("\n").split("\t")
+            fields[header.index(e2b.ENCODE_FILE_FORMAT)] = '"bed\nnarrowPeak"'
+            fields[0] = '"%s\n\nsecond ""line"""' % fields[0]
+            quoted_path = osp.join(self.tmpdir, "quoted.tsv")
+            with open(quoted_path, "w") as metadata:
+                metadata.writelines([lines[0], "\t".join(fields) + "\n"] + lines[2:])
+            with open(quoted_path) as metadata:
+                records = list(MetadataReader(metadata, COLUMNS))
+            self.assertEqual(self.readDictRows(quoted_path), records)
+            self.assertEqual(len(lines) - 1, len(records))
+            self.assertEqual("bed\nnarrowPeak", records[0][3])
+
+            # Rows after a multi-line field are reported at their physical line number.
+            with open(quoted_path, "a") as metadata:
+                metadata.write("a\tb\n")
+            with open(quoted_path) as metadata:
+                with self.assertRaises(RuntimeError) as context:
+                    list(MetadataReader(metadata, COLUMNS))
+            self.assertIn("line %d " % (len(lines) + 4), str(context.exception))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testFilteredRecords(self):
+        try:
+            row_filter = filters.RowFilter(include=["File format=fastq"], min_size=900000000)
+            with open(self.metadata_file) as metadata:
+                records = list(MetadataReader(metadata, COLUMNS, row_filter=row_filter))
+            expected = [r for r in self.readDictRows(self.metadata_file) if r[3] == "fastq" and int(r[1]) >= 900000000]
+            self.assertTrue(expected)
+            self.assertEqual(expected, records)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testInvalidMetadata(self):
+        with self.assertRaises(RuntimeError):
+            MetadataReader(io.StringIO(u"File accession\tSize\tmd5sum\n"), COLUMNS, e2b.REQUIRED_COLUMNS)
+        reader = MetadataReader(io.StringIO(u"md5sum\tSize\tFile download URL\na\t1\thttp://x/a\nb\t2\n"),
+                                [e2b.ENCODE_FILE_URL])
+        with self.assertRaises(RuntimeError):
+            list(reader)
+
+    def testEncodeRemoteFileEntry(self):
+        try:
+            for entry in [("https://www.encodeproject.org/files/ENCFF001/@@download/ENCFF001.bam", "1024",
+                           "ENCFF001.bam", "e6b2f8a365e9845c4d22e8bef0a48c39"),
+                          (u"http://x/a \"b\"\\é", "", u"a \"b\"\\é", "")]:
+                expected = json.dumps({"url": entry[0], "length": entry[1], "filename": entry[2], "md5": entry[3]},
+                                      sort_keys=True, indent=4, separators=(',', ': '))
+                self.assertEqual(expected, e2b.encode_remote_file_entry(entry))
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
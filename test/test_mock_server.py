@@ -0,0 +1,99 @@
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+import json
+import bagit
+import requests
+from encode2bag import encode2bag_api as e2b
+from encode2bag import http_client as http
+from encode2bag import bag_utils
+from encode2bag import synthetic
+from encode2bag.mock_server import MockENCODEServer
+from encode2bag import get_named_exception as gne
+
+QUERY = "type=Experiment&assay_title=ChIP-seq&mock_rows=12"
+
+
+class TestMockServer(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMockServer, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestMockServer, self).tearDown()
+
+    def start_server(self, **kwargs):
+        self.server = MockENCODEServer(payload_size_range=(1024, 16 * 1024), **kwargs)
+        self.server.start()
+        return self.server
+
+    def testBatchDownloadContract(self):
+        try:
+            server = self.start_server()
+            for endpoint in ("search", "report", "matrix"):
+                self.assertEqual(200, requests.get(server.search_url(QUERY, endpoint)).status_code)
+            lines = requests.get(e2b.get_batch_download_url(server.search_url(QUERY))).text.splitlines()
+            self.assertEqual("%s/metadata/%s/metadata.tsv" % (server.base_url, QUERY), lines[0])
+            self.assertEqual(13, len(lines))
+            metadata = requests.get(lines[0]).text.splitlines()
+            self.assertEqual(synthetic.ENCODE_METADATA_COLUMNS, metadata[0].split("\t"))
+            self.assertEqual(metadata, requests.get(lines[0]).text.splitlines())
+            payload = requests.get(lines[1], headers={"Range": "bytes=100-"})
+            self.assertEqual(206, payload.status_code)
+            self.assertEqual(requests.get(lines[1]).content[100:], payload.content)
+            self.assertEqual(404, requests.get(server.base_url + "/files/ENCFF999ZZZ/@@download/x.bam").status_code)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testMetadataETagRevalidation(self):
+        try:
+            server = self.start_server()
+            url = "%s/metadata/%s/metadata.tsv" % (server.base_url, QUERY)
+            etag = requests.get(url).headers["ETag"]
+            self.assertEqual(304, requests.get(url, headers={"If-None-Match": etag}).status_code)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateBagFromURL(self):
+        try:
+            server = self.start_server()
+            bag_path = e2b.create_bag_from_url(server.search_url(QUERY),
+                                               output_path=self.tmpdir,
+                                               output_name="mock_bag",
+                                               create_ro_manifest=True,
+                                               use_cache=False)
+            bag = bagit.Bag(bag_path)
+            self.assertEqual(12, len(list(bag.files_to_be_fetched())))
+            with open(osp.join(bag_path, "metadata", "manifest.json")) as f:
+                self.assertEqual(12, len(json.load(f)["aggregates"]))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateBagFromURLWithFaults(self):
+        try:
+            server = self.start_server(error_rate=0.2, drop_rate=0.2, seed=7)
+            downloader = http.HTTPDownloader(max_retries=10, backoff_factor=0.01, chunk_size=1024)
+            bag_path = e2b.create_bag_from_url(server.search_url(QUERY),
+                                               output_path=self.tmpdir,
+                                               output_name="mock_bag",
+                                               downloader=downloader,
+                                               use_cache=False,
+                                               materialize=True)
+            bagit.Bag(bag_path).validate()
+            for path in bag_utils.read_payload_manifests(bag_path)["md5"]:
+                self.assertTrue(osp.isfile(osp.join(bag_path, path)))
+            self.assertTrue(any(r.startswith("/files/") for r in server.request_log))
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
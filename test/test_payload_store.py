@@ -0,0 +1,138 @@
+import os
+import os.path as osp
+import hashlib
+import shutil
+import tempfile
+import unittest
+import zipfile
+import bagit
+from encode2bag import encode2bag_api as e2b
+from encode2bag import bag_utils
+from encode2bag.payload_store import PayloadStore
+from encode2bag.mock_server import MockENCODEServer
+from encode2bag import get_named_exception as gne
+
+QUERY = "type=Experiment&mock_rows=6"
+
+
+class TestPayloadStore(unittest.TestCase):
+
+    def setUp(self):
+        super(TestPayloadStore, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.store = PayloadStore(osp.join(self.tmpdir, "store"))
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestPayloadStore, self).tearDown()
+
+    @staticmethod
+    def file_requests(server):
+        return [r for r in server.request_log if r.startswith("/files/")]
+
+    def createBag(self, server, name, **kwargs):
+        return e2b.create_bag_from_url(server.search_url(QUERY), output_path=self.tmpdir, output_name=name,
+                                       use_cache=False, materialize=True, payload_store=self.store, **kwargs)
+
+    def testSharedPayloadAcrossBags(self):
+        try:
+            with MockENCODEServer(payload_size_range=(1024, 16 * 1024)) as server:
+                first = self.createBag(server, "first")
+                self.assertEqual(6, len(self.file_requests(server)))
+                second = self.createBag(server, "second")
+                self.assertEqual(6, len(self.file_requests(server)))
+            for bag_path in (first, second):
+                bagit.Bag(bag_path).validate()
+            self.assertEqual(6, len(self.store.entries()))
+            for key, entry in self.store.entries():
+                self.assertEqual(2, len(entry["refs"]))
+                for path, mode in entry["refs"].items():
+                    self.assertIn(mode, ("reflink", "copy"))
+                    self.assertFalse(osp.samefile(path, self.store.object_path(key)))
+                    self.assertTrue(os.access(path, os.W_OK))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testModifiedObjectIsFetchedAgain(self):
+        try:
+            self.store = PayloadStore(osp.join(self.tmpdir, "store"), link_mode="hardlink")
+            with MockENCODEServer(payload_size_range=(1024, 16 * 1024)) as server:
+                first = self.createBag(server, "first")
+                payload = sorted(name for name in os.listdir(osp.join(first, "data")) if name != "metadata.tsv")
+                # Modifying a hardlinked payload file in place modifies the store object.
+                with open(osp.join(first, "data", payload[0]), "ab") as f:
+                    f.write(b"modified")
+                second = self.createBag(server, "second")
+                self.assertEqual(7, len(self.file_requests(server)))
+            bagit.Bag(second).validate()
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCollectGarbage(self):
+        try:
+            with MockENCODEServer(payload_size_range=(1024, 16 * 1024)) as server:
+                first = self.createBag(server, "first")
+                second = self.createBag(server, "second")
+            shutil.rmtree(first)
+            summary = self.store.collect_garbage(max_size=0)
+            self.assertEqual((6, 0), (summary["objects"], summary["removed"]))
+            for _, entry in self.store.entries():
+                self.assertEqual([osp.join(second, "data")], [osp.dirname(p) for p in entry["refs"]])
+
+            os.remove(osp.join(second, "data", sorted(os.listdir(osp.join(second, "data")))[0]))
+            self.assertEqual(1, self.store.collect_garbage(max_size=0)["removed"])
+            size = self.store.size()
+            self.assertEqual(0, self.store.collect_garbage(max_size=size)["removed"])
+            shutil.rmtree(second)
+            self.assertEqual(0, self.store.collect_garbage(max_size=size)["removed"])
+            summary = self.store.collect_garbage(max_size=0)
+            self.assertEqual((0, 5, size), (summary["objects"], summary["removed"], summary["bytes_freed"]))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testLinkModes(self):
+        try:
+            data = b"ACGT" * 1000
+            key = hashlib.md5(data).hexdigest()
+            path = osp.join(self.tmpdir, "download.part")
+            with open(path, "wb") as f:
+                f.write(data)
+            self.store.add(key, path)
+            for mode in ("copy", "symlink", "hardlink"):
+                destination = osp.join(self.tmpdir, mode)
+                self.assertEqual(mode, PayloadStore(self.store.store_dir, link_mode=mode).link(key, destination))
+                with open(destination, "rb") as f:
+                    self.assertEqual(data, f.read())
+            self.assertEqual(["copy", "hardlink", "symlink"], sorted(self.store.entries()[0][1]["refs"].values()))
+            os.remove(osp.join(self.tmpdir, "copy"))
+            os.remove(osp.join(self.tmpdir, "symlink"))
+            self.assertEqual(0, self.store.collect_garbage(max_size=0)["removed"])
+            self.assertEqual({osp.join(self.tmpdir, "hardlink"): "hardlink"}, self.store.entries()[0][1]["refs"])
+            os.remove(osp.join(self.tmpdir, "hardlink"))
+            self.assertEqual(1, self.store.collect_garbage(max_size=0)["removed"])
+            self.assertFalse(self.store.contains(key))
+            self.assertEqual([], os.listdir(osp.join(self.store.store_dir, "locks")))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testStreamArchiveFromStore(self):
+        try:
+            with MockENCODEServer(payload_size_range=(1024, 16 * 1024)) as server:
+                self.createBag(server, "bag")
+                archive_path = self.createBag(server, "archive", archive_format="zip", stream_archive=True)
+                self.assertEqual(6, len(self.file_requests(server)))
+            with zipfile.ZipFile(archive_path) as archive:
+                payload = [name for name in archive.namelist()
+                           if name.startswith("archive/data/") and not name.endswith("/")]
+            self.assertEqual(7, len(payload))
+            self.assertEqual(6, len(self.store.entries()))
+            manifest = bag_utils.read_payload_manifests(osp.join(self.tmpdir, "bag"))["md5"]
+            for key, _ in self.store.entries():
+                self.assertIn(key, manifest.values())
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+from encode2bag import encode2bag_api as e2b
+from encode2bag import refresh
+from encode2bag import get_named_exception as gne
+
+
+class TestRefresh(unittest.TestCase):
+
+    def setUp(self):
+        super(TestRefresh, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        with open(osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))) as f:
+            self.lines = f.readlines()
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestRefresh, self).tearDown()
+
+    def _write_metadata(self, name, lines):
+        path = osp.join(self.tmpdir, name, "metadata.tsv")
+        os.makedirs(osp.dirname(path))
+        with open(path, "w") as f:
+            f.writelines(lines)
+        return path
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def testUpdateBagFromMetadataFile(self):
+        try:
+            old_metadata = self._write_metadata("old", self.lines[:20])
+            changed = self.lines[5].split("\t")
+            changed[37] = "0" * 32
+            new_lines = self.lines[:3] + self.lines[4:5] + ["\t".join(changed)] + self.lines[6:]
+            new_metadata = self._write_metadata("new", new_lines)
+
+            bag_path = e2b.create_bag_from_metadata_file(old_metadata, output_path=self.tmpdir, output_name="bag")
+            result = refresh.update_bag_from_metadata_file(bag_path, new_metadata)
+            self.assertEqual({"added": 9, "removed": 1, "changed": 1, "unchanged": 17}, result)
+
+            expected_path = e2b.create_bag_from_metadata_file(new_metadata, output_path=self.tmpdir,
+                                                              output_name="expected")
+            for name in ("fetch.txt", "manifest-md5.txt", "manifest-sha256.txt", "data/metadata.tsv"):
+                self.assertEqual(self._read(osp.join(expected_path, name)), self._read(osp.join(bag_path, name)))
+            self.assertEqual(refresh.read_bag_info(expected_path)["Payload-Oxum"],
+                             refresh.read_bag_info(bag_path)["Payload-Oxum"])
+            with open(osp.join(bag_path, "tagmanifest-md5.txt")) as f:
+                for line in f:
+                    checksum, path = line.split()
+                    self.assertEqual(checksum, refresh.compute_file_checksums(osp.join(bag_path, path), ["md5"])["md5"])
+
+            result = refresh.update_bag_from_metadata_file(bag_path, new_metadata)
+            self.assertEqual({"added": 0, "removed": 0, "changed": 0, "unchanged": 27}, result)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testAddROManifest(self):
+        try:
+            metadata = self._write_metadata("old", self.lines[:10])
+            bag_path = e2b.create_bag_from_metadata_file(metadata, output_path=self.tmpdir, output_name="bag")
+            self.assertNotEqual(e2b.BDBAG_RO_PROFILE_ID, refresh.read_bag_info(bag_path).get("BagIt-Profile-Identifier"))
+            refresh.update_bag_from_metadata_file(bag_path, metadata, create_ro_manifest=True)
+            self.assertTrue(osp.isfile(osp.join(bag_path, "metadata", "manifest.json")))
+            self.assertEqual(e2b.BDBAG_RO_PROFILE_ID, refresh.read_bag_info(bag_path)["BagIt-Profile-Identifier"])
+            with open(osp.join(bag_path, "tagmanifest-md5.txt")) as f:
+                for line in f:
+                    checksum, path = line.split()
+                    self.assertEqual(checksum, refresh.compute_file_checksums(osp.join(bag_path, path), ["md5"])["md5"])
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
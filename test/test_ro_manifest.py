@@ -0,0 +1,72 @@
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+import json
+from encode2bag import encode2bag_api as e2b
+from encode2bag import bag_utils
+from encode2bag.ro_manifest import ROManifestBuilder
+from encode2bag import get_named_exception as gne
+
+
+class TestROManifest(unittest.TestCase):
+
+    def setUp(self):
+        super(TestROManifest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestROManifest, self).tearDown()
+
+    def testBuilderIndexesAggregates(self):
+        builder = ROManifestBuilder()
+        builder.add_file("ENCFF000MPQ.bam", "bam")
+        builder.add_file("ENCFF000MPQ.bam", "bam")
+        builder.add_file("ENCFF000MPX.bigWig", "bigWig")
+        builder.add_files_annotation("../data/metadata.tsv")
+        manifest = builder.to_dict()
+        self.assertEqual(["../data/ENCFF000MPQ.bam", "../data/ENCFF000MPX.bigWig"],
+                         [a["uri"] for a in manifest["aggregates"]])
+        self.assertEqual("application/x-bam", manifest["aggregates"][0]["mediatype"])
+        self.assertEqual([{"about": ["../data/ENCFF000MPQ.bam", "../data/ENCFF000MPX.bigWig"],
+                           "content": "../data/metadata.tsv"}], manifest["annotations"])
+
+    def testWriteMatchesJSONDump(self):
+        try:
+            builder = ROManifestBuilder(e2b.init_ro_manifest(creator_name="encode2bag unit test",
+                                                             creator_orcid="0000-0003-2280-917X"))
+            input_path = osp.abspath(osp.join("test", "test_data", "metadata-2.tsv"))
+            e2b.convert_tsv_metadata_to_remote_file_manifest(input_path, osp.join(self.tmpdir, "rfm.json"), builder)
+            output_path = osp.join(self.tmpdir, "manifest.json")
+            builder.write(output_path)
+            with open(output_path) as f:
+                self.assertEqual(json.dumps(builder.to_dict(), sort_keys=True, indent=4, separators=(',', ': ')),
+                                 f.read())
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateBagWithROManifestUpdatesTagManifests(self):
+        try:
+            metadata_file = osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))
+            bag_path = e2b.create_bag_from_metadata_file(metadata_file,
+                                                         output_path=self.tmpdir,
+                                                         output_name="ro_bag",
+                                                         create_ro_manifest=True)
+            with open(osp.join(bag_path, "metadata", "manifest.json")) as f:
+                self.assertEqual(28, len(json.load(f)["aggregates"]))
+            for alg in e2b.BAG_ALGORITHMS:
+                with open(osp.join(bag_path, "tagmanifest-%s.txt" % alg)) as f:
+                    entries = dict(reversed(line.split()) for line in f)
+                self.assertEqual(bag_utils.compute_file_checksums(
+                    osp.join(bag_path, "metadata", "manifest.json"), [alg])[alg], entries["metadata/manifest.json"])
+            self.assertEqual(e2b.BDBAG_RO_PROFILE_ID,
+                             bag_utils.read_bag_info(bag_path)["BagIt-Profile-Identifier"])
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import os.path as osp
+import csv
+import shutil
+import tempfile
+import unittest
+import bagit
+from encode2bag import encode2bag_api as e2b
+from encode2bag import search_api
+from encode2bag.mock_server import MockENCODEServer
+from encode2bag import get_named_exception as gne
+
+COLUMNS = [column for column, _ in search_api.FILE_COLUMNS]
+
+
+class TestSearchAPI(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSearchAPI, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestSearchAPI, self).tearDown()
+
+    @staticmethod
+    def readRows(path):
+        with open(path) as metadata:
+            return [[row[column] for column in COLUMNS] for row in csv.DictReader(metadata, delimiter='\t')]
+
+    def testSearchMetadataMatchesBatchDownloadFileColumns(self):
+        try:
+            with MockENCODEServer(payload_size_range=(1024, 4096)) as server:
+                for query, pages in [("type=Experiment&mock_rows=50", 1), ("type=File&mock_rows=50", 8)]:
+                    search_dir = osp.join(self.tmpdir, "search")
+                    batch_dir = osp.join(self.tmpdir, "batch")
+                    for path in (search_dir, batch_dir):
+                        os.makedirs(path)
+                    del server.request_log[:]
+                    search_file = search_api.retrieve_encode_metadata_file_by_search(
+                        server.search_url(query, endpoint="report"), search_dir, page_size=7, workers=3)
+                    requests = [r for r in server.request_log if "format=json" in r]
+                    self.assertEqual(pages, len(requests))
+                    self.assertTrue(all("&field=" in r for r in requests))
+                    batch_file = e2b.retrieve_encode_metadata_file_by_url(server.search_url(query), batch_dir,
+                                                                          use_cache=False)
+                    # The search metadata has the reduced schema of FILE_COLUMNS, whose values match those of the
+                    # batch download metadata.
+                    with open(search_file) as metadata:
+                        self.assertEqual(COLUMNS, next(csv.reader(metadata, delimiter='\t')))
+                    self.assertEqual(self.readRows(batch_file), self.readRows(search_file))
+
+                    for path in (search_file, batch_file):
+                        e2b.convert_tsv_metadata_to_remote_file_manifest(path, ''.join([path, ".json"]))
+                    with open(''.join([search_file, ".json"])) as search_rfm, \
+                            open(''.join([batch_file, ".json"])) as batch_rfm:
+                        self.assertEqual(batch_rfm.read(), search_rfm.read())
+                    shutil.rmtree(search_dir)
+                    shutil.rmtree(batch_dir)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testSearchFiltersEmbeddedFiles(self):
+        try:
+            os.makedirs(osp.join(self.tmpdir, "batch"))
+            with MockENCODEServer(payload_size_range=(1024, 4096)) as server:
+                query = "type=Experiment&files.file_type=bam&files.output_type!=reads&mock_rows=50"
+                search_file = search_api.retrieve_encode_metadata_file_by_search(server.search_url(query),
+                                                                                 self.tmpdir, page_size=3)
+                batch_file = e2b.retrieve_encode_metadata_file_by_url(server.search_url(query),
+                                                                      osp.join(self.tmpdir, "batch"), use_cache=False)
+            index = COLUMNS.index("File format")
+            expected = [row for row in self.readRows(batch_file) if row[index] == "bam"]
+            self.assertTrue(expected)
+            self.assertEqual(expected, self.readRows(search_file))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateBagFromSearchAPI(self):
+        try:
+            with MockENCODEServer(payload_size_range=(1024, 4096)) as server:
+                bag_path = e2b.create_bag_from_url(server.search_url("type=Experiment&mock_rows=20"),
+                                                   output_path=self.tmpdir, output_name="bag", materialize=True,
+                                                   use_search_api=True, search_page_size=1)
+                self.assertFalse([r for r in server.request_log if r.startswith("/batch_download/")])
+            bagit.Bag(bag_path).validate()
+            with open(osp.join(bag_path, "data", "metadata.tsv")) as metadata:
+                self.assertEqual(COLUMNS, next(csv.reader(metadata, delimiter='\t')))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testMakeMetadataRow(self):
+        file_object = {"accession": "ENCFF001AAA",
+                       "dataset": "/experiments/ENCSR001AAA/",
+                       "lab": "/labs/some-lab/",
+                       "biological_replicates": [1, 2],
+                       "file_size": 1024,
+                       "href": "/files/ENCFF001AAA/@@download/ENCFF001AAA.bam",
+                       "platform": {"title": "HiSeq 4000"}}
+        row = dict(zip(COLUMNS, search_api.make_metadata_row(file_object, "https://www.encodeproject.org")))
+        self.assertEqual("ENCSR001AAA", row["Experiment accession"])
+        self.assertEqual("/labs/some-lab/", row["Lab"])
+        self.assertEqual("1, 2", row["Biological replicate(s)"])
+        self.assertEqual("1024", row["Size"])
+        self.assertEqual("https://www.encodeproject.org/files/ENCFF001AAA/@@download/ENCFF001AAA.bam",
+                         row["File download URL"])
+        self.assertEqual("HiSeq 4000", row["Platform"])
+        self.assertEqual("", row["md5sum"])
+
+    def testFileFilters(self):
+        file_filters = search_api.get_file_filters(
+            "type=Experiment&files.file_type=bam&files.file_type=fastq&files.lab.title!=Lab A&files.assembly=*",
+            "Experiment")
+        self.assertEqual({("file_type", False): {"bam", "fastq"}, ("lab.title", True): {"Lab A"},
+                          ("assembly", False): {"*"}}, dict(file_filters))
+        self.assertIn("files.file_type", search_api.get_fields("Experiment", file_filters))
+        self.assertTrue(search_api.file_matches({"file_type": "bam", "lab": {"title": "Lab B"}, "assembly": "GRCh38"},
+                                                file_filters))
+        self.assertFalse(search_api.file_matches({"file_type": "bam", "lab": {"title": "Lab A"}, "assembly": "GRCh38"},
+                                                 file_filters))
+        self.assertFalse(search_api.file_matches({"file_type": "bam", "lab": {"title": "Lab B"}}, file_filters))
+        self.assertFalse(search_api.get_file_filters("type=File&files.file_type=bam", "File"))
+
+
+if __name__ == '__main__':
+    unittest.main()
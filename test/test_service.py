@@ -0,0 +1,150 @@
+import os
+import os.path as osp
+import sys
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import bagit
+from encode2bag import service
+from encode2bag.mock_server import MockENCODEServer
+from encode2bag import get_named_exception as gne
+
+if sys.version_info > (3,):
+    from http.client import HTTPConnection
+else:
+    from httplib import HTTPConnection
+
+
+class UnixHTTPConnection(HTTPConnection):
+
+    def __init__(self, socket_path):
+        HTTPConnection.__init__(self, "localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class TestService(unittest.TestCase):
+
+    def setUp(self):
+        super(TestService, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.service = service.BagBuildService(osp.join(self.tmpdir, "bags"), workers=2)
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        self.service.close()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestService, self).tearDown()
+
+    def startServer(self, **kwargs):
+        self.server = service.create_server(self.service, port=0, **kwargs)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def connect(self):
+        if isinstance(self.server.server_address, tuple):
+            return HTTPConnection(*self.server.server_address)
+        return UnixHTTPConnection(self.server.server_address)
+
+    def request(self, method, path, body=None):
+        connection = self.connect()
+        try:
+            connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                               headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            return response.status, json.loads(response.read().decode("utf-8"))
+        finally:
+            connection.close()
+
+    def testSubmitJobs(self):
+        try:
+            self.startServer()
+            with MockENCODEServer(payload_size_range=(1024, 4096), latency=0.2) as encode:
+                job = {"url": encode.search_url("type=Experiment&mock_rows=12"), "materialize": True,
+                       "output_name": "bag"}
+                status, first = self.request("POST", "/jobs", job)
+                self.assertEqual(202, status)
+                self.assertFalse(first["deduplicated"])
+                status, second = self.request("POST", "/jobs", job)
+                self.assertEqual(200, status)
+                self.assertTrue(second["deduplicated"])
+                self.assertEqual(first["id"], second["id"])
+                status, conflict = self.request("POST", "/jobs", dict(job, archive_format="zip"))
+                self.assertEqual(409, status)
+                status, other = self.request("POST", "/jobs", {"url": encode.search_url("type=File&mock_rows=4"),
+                                                               "archive_format": "zip"})
+                self.assertEqual(202, status)
+
+                status, result = self.request("GET", "/jobs/%s?wait=60" % first["id"])
+                self.assertEqual(200, status)
+                self.assertEqual(service.SUCCEEDED, result["status"], result["error"])
+                self.assertEqual(osp.join(self.service.output_path, "bag"), result["result"])
+                bagit.Bag(result["result"]).validate()
+                self.assertTrue(any(stage["stage"] == "materialize" for stage in result["stages"]))
+                status, result = self.request("GET", "/jobs/%s?wait=60" % other["id"])
+                self.assertEqual(service.SUCCEEDED, result["status"], result["error"])
+                self.assertTrue(result["result"].endswith(".zip"))
+
+                # A finished job is no longer in flight, so an identical request builds the bag again.
+                status, third = self.request("POST", "/jobs", job)
+                self.assertEqual(202, status)
+                self.assertNotEqual(first["id"], third["id"])
+                self.service.get_job(third["id"], wait=60)
+
+            status, jobs = self.request("GET", "/jobs")
+            self.assertEqual(3, len(jobs["jobs"]))
+            status, health = self.request("GET", "/health")
+            self.assertEqual({"status": "ok", "workers": 2, "queued": 0, "running": 0}, health)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testInvalidRequests(self):
+        try:
+            self.startServer()
+            for request in [{}, {"url": "http://x/search/?type=File", "metadata_file": "metadata.tsv"},
+                            {"metadata_file": osp.join(self.tmpdir, "missing.tsv")},
+                            {"url": "http://x/search/?type=File", "output_path": "/tmp"},
+                            {"url": "http://x/search/?type=File", "output_name": "../bag"},
+                            {"url": "http://x/search/?type=File", "materialize": "yes"},
+                            {"url": "http://x/search/?type=File", "archive_format": "rar"},
+                            {"url": "http://x/search/?type=File", "include": ["no separator"]},
+                            {"metadata_file": osp.join("test", "test_data", "metadata-1.tsv"),
+                             "use_search_api": True}]:
+                status, response = self.request("POST", "/jobs", request)
+                self.assertEqual(400, status, request)
+                self.assertIn("error", response)
+            self.assertEqual(404, self.request("GET", "/jobs/unknown")[0])
+            self.assertEqual(404, self.request("GET", "/unknown")[0])
+            self.assertFalse(self.service.list_jobs())
+        except Exception as e:
+            self.fail(gne(e))
+
+    @unittest.skipIf(not hasattr(socket, "AF_UNIX"), "Unix domain sockets are not supported.")
+    def testUnixSocket(self):
+        try:
+            socket_path = osp.join(self.tmpdir, "encode2bag.sock")
+            self.startServer(socket_path=socket_path)
+            status, response = self.request("POST", "/jobs", {"metadata_file": osp.join("test", "test_data",
+                                                                                        "metadata-1.tsv")})
+            self.assertEqual(202, status)
+            status, result = self.request("GET", "/jobs/%s?wait=60" % response["id"])
+            self.assertEqual(service.SUCCEEDED, result["status"], result["error"])
+            self.assertTrue(osp.isdir(result["result"]))
+            self.assertTrue(osp.basename(result["result"]).startswith("encode_bag_"))
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import os.path as osp
+import csv
+import shutil
+import tempfile
+import unittest
+import json
+from encode2bag import encode2bag_api as e2b
+from encode2bag import bag_utils
+from encode2bag import sharding
+from encode2bag import get_named_exception as gne
+
+
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSharding, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.metadata_file = osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))
+        with open(self.metadata_file) as metadata:
+            self.rows = list(csv.DictReader(metadata, delimiter='\t'))
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestSharding, self).tearDown()
+
+    def read_shard_rows(self, shard):
+        with open(shard.metadata_file_path) as metadata:
+            return list(csv.DictReader(metadata, delimiter='\t'))
+
+    def testPartitionByFileCount(self):
+        try:
+            shards = sharding.partition_metadata_file(self.metadata_file, self.tmpdir, "bag", max_files=10)
+            self.assertEqual([10, 10, 8], [shard.files for shard in shards])
+            self.assertEqual(self.rows, sum((self.read_shard_rows(shard) for shard in shards), list()))
+            self.assertEqual("bag_shard-00002", shards[1].name)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testPartitionBySize(self):
+        try:
+            max_bytes = 5 * 1024 ** 3
+            shards = sharding.partition_metadata_file(self.metadata_file, self.tmpdir, "bag", max_bytes=max_bytes)
+            self.assertEqual(sum(int(row["Size"]) for row in self.rows), sum(shard.bytes for shard in shards))
+            for shard in shards:
+                self.assertTrue(shard.bytes <= max_bytes or shard.files == 1)
+                self.assertEqual(shard.bytes, sum(int(row["Size"]) for row in self.read_shard_rows(shard)))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testPartitionByGroup(self):
+        try:
+            column = "Experiment accession"
+            experiments = set(row[column] for row in self.rows)
+            shards = sharding.partition_metadata_file(self.metadata_file, self.tmpdir, "bag", group_by=column)
+            self.assertEqual(len(experiments), len(shards))
+            for shard in shards:
+                self.assertEqual(1, len(set(row[column] for row in self.read_shard_rows(shard))))
+            packed = sharding.partition_metadata_file(self.metadata_file, osp.join(self.tmpdir, "packed"), "bag",
+                                                      max_files=10, group_by=column)
+            seen = set()
+            for shard in packed:
+                groups = set(row[column] for row in self.read_shard_rows(shard))
+                self.assertFalse(groups & seen)
+                seen |= groups
+            self.assertEqual(experiments, seen)
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testPartitionQuotedMultiLineRecords(self):
+        try:
+            column = "Experiment accession"
+            with open(self.metadata_file) as metadata:
+                lines = metadata.readlines()
+            fields = lines[1].rstrip("\n").split("\t")
+            fields[0] = '"%s\nsecond line"' % fields[0]
+            quoted_path = osp.join(self.tmpdir, "quoted.tsv")
+            with open(quoted_path, "w") as metadata:
+                metadata.writelines([lines[0], "\t".join(fields) + "\n"] + lines[2:])
+            with open(quoted_path) as metadata:
+                rows = list(csv.DictReader(metadata, delimiter='\t'))
+            shards = sharding.partition_metadata_file(quoted_path, osp.join(self.tmpdir, "shards"), "bag",
+                                                      group_by=column)
+            self.assertEqual(len(set(row[column] for row in rows)), len(shards))
+            self.assertEqual(sorted(row[column] + row["File accession"] for row in rows),
+                             sorted(row[column] + row["File accession"]
+                                    for shard in shards for row in self.read_shard_rows(shard)))
+
+            # A short row is reported with its line number.
+            with open(quoted_path, "a") as metadata:
+                metadata.write("a\tb\n")
+            with self.assertRaises(RuntimeError) as context:
+                sharding.partition_metadata_file(quoted_path, osp.join(self.tmpdir, "short"), "bag", group_by=column)
+            self.assertIn("line %d " % (len(lines) + 2), str(context.exception))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateShardedBags(self):
+        try:
+            index_bag_path = e2b.create_bag_from_metadata_file(self.metadata_file,
+                                                               output_path=self.tmpdir,
+                                                               output_name="sharded",
+                                                               create_ro_manifest=True,
+                                                               archive_format="zip",
+                                                               shard_max_files=10,
+                                                               shard_workers=2)
+            self.assertEqual(osp.join(self.tmpdir, "sharded"), index_bag_path)
+            with open(osp.join(index_bag_path, "data", sharding.SHARD_INDEX_FILE)) as f:
+                index = json.load(f)
+            self.assertEqual(28, index["total_files"])
+            self.assertEqual(["sharded_shard-00001.zip", "sharded_shard-00002.zip", "sharded_shard-00003.zip"],
+                             [shard["path"] for shard in index["shards"]])
+            for shard in index["shards"]:
+                self.assertTrue(osp.isfile(osp.join(self.tmpdir, shard["path"])))
+            self.assertIn("data/metadata-1.tsv", bag_utils.read_payload_manifests(index_bag_path)["md5"])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testCreateShardedBagsUnknownColumn(self):
+        with self.assertRaises(RuntimeError):
+            e2b.create_bag_from_metadata_file(self.metadata_file, output_path=self.tmpdir, shard_group_by="Nope")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+import csv
+import json
+from encode2bag import encode2bag_api as e2b
+from encode2bag import synthetic
+from encode2bag import get_named_exception as gne
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSynthetic, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestSynthetic, self).tearDown()
+
+    def testGeneratedMetadataMatchesENCODEHeader(self):
+        with open(osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))) as f:
+            header = f.readline().rstrip("\n").split("\t")
+        self.assertEqual(header, synthetic.ENCODE_METADATA_COLUMNS)
+
+    def testConvertGeneratedMetadata(self):
+        try:
+            metadata_file = synthetic.write_metadata_file(osp.join(self.tmpdir, "metadata.tsv"), 5000, seed=1)
+            with open(metadata_file) as f:
+                rows = list(csv.DictReader(f, delimiter="\t"))
+            self.assertEqual(5000, len(rows))
+            self.assertEqual(5000, len(set(row["File accession"] for row in rows)))
+            output_path = osp.join(self.tmpdir, "remote-file-manifest.json")
+            e2b.convert_tsv_metadata_to_remote_file_manifest(metadata_file, output_path)
+            with open(output_path) as f:
+                self.assertEqual(5000, len(json.load(f)))
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import os.path as osp
+import gzip
+import hashlib
+import shutil
+import tempfile
+import unittest
+from encode2bag import encode2bag_api as e2b
+from encode2bag import verify
+from encode2bag.mock_server import MockENCODEServer
+from encode2bag import get_named_exception as gne
+
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        super(TestVerify, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix="encode2bag_test_")
+        self.metadata_file = osp.abspath(osp.join("test", "test_data", "metadata-1.tsv"))
+
+    def tearDown(self):
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        super(TestVerify, self).tearDown()
+
+    def rewrite(self, path, old, new):
+        with open(path) as f:
+            content = f.read()
+        self.assertIn(old, content)
+        with open(path, "w") as f:
+            f.write(content.replace(old, new, 1))
+
+    def testComputeMD5(self):
+        try:
+            for data in (b"", b"ACGT" * 100000):
+                path = osp.join(self.tmpdir, "data.bin")
+                with open(path, "wb") as f:
+                    f.write(data)
+                self.assertEqual(hashlib.md5(data).hexdigest(), verify.compute_md5(path))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testFindMetadataFileAmongBinaryFiles(self):
+        try:
+            data_path = osp.join(self.tmpdir, "data")
+            os.mkdir(data_path)
+            binary = bytes(bytearray(range(256))) * 64
+            with open(osp.join(data_path, "reads.bam"), "wb") as f:
+                f.write(binary)
+            with gzip.open(osp.join(data_path, "signal.bigWig.gz"), "wb") as f:
+                f.write(binary)
+            shutil.copy(self.metadata_file, osp.join(data_path, "files.tsv"))
+            for name in ("reads.bam", "signal.bigWig.gz"):
+                self.assertIsNone(verify.read_metadata_entries(osp.join(data_path, name)))
+            path, entries = verify.find_metadata_file(self.tmpdir, ["data/reads.bam", "data/signal.bigWig.gz",
+                                                                    "data/files.tsv"])
+            self.assertEqual("data/files.tsv", path)
+            self.assertEqual(28, len(entries))
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testVerifyRemoteBag(self):
+        try:
+            bag_path = e2b.create_bag_from_metadata_file(self.metadata_file, output_path=self.tmpdir)
+            report = verify.verify_bag(bag_path)
+            self.assertEqual([], report["errors"])
+            self.assertEqual("data/metadata-1.tsv", report["metadata_file"])
+            self.assertEqual(28, report["remote_files"])
+            self.assertEqual(1, report["hashed"])
+
+            self.rewrite(osp.join(bag_path, "fetch.txt"), "\t865341224\t", "\t865341225\t")
+            self.rewrite(osp.join(bag_path, "manifest-md5.txt"), "e6b2f8a365e9845c4d22e8bef0a48c39",
+                         "00000000000000000000000000000000")
+            errors = verify.verify_bag(bag_path)["errors"]
+            self.assertEqual(2, len(errors))
+            self.assertIn("fetch.txt entry", errors[0])
+            self.assertIn("manifest md5", errors[1])
+        except Exception as e:
+            self.fail(gne(e))
+
+    def testVerifyMaterializedBagWithChecksumCache(self):
+        try:
+            with MockENCODEServer(rows=6, payload_size_range=(1024, 16 * 1024)) as server:
+                bag_path = e2b.create_bag_from_url(server.search_url("type=Experiment"), output_path=self.tmpdir,
+                                                   use_cache=False, materialize=True)
+            cache_path = osp.join(self.tmpdir, "checksums.json")
+            report = verify.verify_bag(bag_path, workers=2, checksum_cache=verify.ChecksumCache(cache_path))
+            self.assertEqual([], report["errors"])
+            self.assertEqual((7, 0), (report["hashed"], report["cached"]))
+            report = verify.verify_bag(bag_path, workers=2, checksum_cache=verify.ChecksumCache(cache_path))
+            self.assertEqual((0, 7), (report["hashed"], report["cached"]))
+
+            payload = sorted(name for name in os.listdir(osp.join(bag_path, "data")) if name != "metadata.tsv")
+            with open(osp.join(bag_path, "data", payload[0]), "ab") as f:
+                f.write(b"corrupt")
+            report = verify.verify_bag(bag_path, workers=2, checksum_cache=verify.ChecksumCache(cache_path))
+            self.assertEqual((1, 6), (report["hashed"], report["cached"]))
+            self.assertEqual(1, len(report["errors"]))
+            self.assertIn(payload[0], report["errors"][0])
+
+            # Entries of deleted files are dropped when the cache is saved.
+            os.remove(osp.join(bag_path, "data", payload[0]))
+            checksum_cache = verify.ChecksumCache(cache_path)
+            checksum_cache.save()
+            self.assertEqual(6, len(verify.ChecksumCache(cache_path).entries))
+        except Exception as e:
+            self.fail(gne(e))
+
+
+if __name__ == '__main__':
+    unittest.main()